@@ -3,114 +3,213 @@
 """
 服务器启动脚本
 用于初始化所有依赖并启动FastAPI服务器
+
+开发：python Start.py --reload
+生产：python Start.py --workers 4（默认取环境变量WEB_CONCURRENCY），
+      向主进程发送SIGHUP可逐个平滑重启工作进程（如更新代码或配置后）。
+也可以直接用uvicorn启动：uvicorn Start:create_app --factory --workers 4
+
+多进程部署时每个工作进程各自调用create_app，在lifespan中初始化数据库连接和变更通知；
+以下状态是按进程各自持有的，不能也不需要在进程间共享：
+- response_cache（响应缓存）：通过ChangeFeed在其他进程写入后失效
+- config.Container中的mapper、聊天引擎（langchain客户端）、Neo4j驱动、SQLite连接，GroupAgentEngine的agent池
+- SceneTurnLock的进程内排队队列及/api/chat/queues的指标：只反映本进程的轮次
+以下状态由所有进程共享，只能有一份：
+- SQLite数据库文件（WAL模式，同一时刻只有一个写事务）及其中的change_feed序号、scene_journal情景图增量日志
+- 对话归档的段文件（追加写入时加文件锁）
+- ChangeFeed的通知套接字目录（每个进程一个套接字文件）
+- 指标目录（METRICS_DIR，默认在ChangeFeed目录下）：每个进程一个指标文件，/metrics合并所有进程；
+  已退出进程的文件在工作进程启动时合并，python Start.py启动时清空（直接用uvicorn启动时不清空）
+- SceneTurnLock的锁文件目录（SCENE_LOCK_DIR）：同一情景的对话轮次在所有进程间串行，
+  Windows没有flock，只能单进程部署
 """
 
+import argparse
+import importlib.util
+import os
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
+from config.Container import Container
 from service.ChatService import ChatService
 from service.CharacterService import CharacterService
 from service.SceneService import SceneService
-from core.chat.LangchainEngine import LangchainEngine
-from mapper.ConversationMapper import ConversationMapper
-from core.PrepareChatHistory import PrepareChatHistory
-from mapper.SceneMapper import SceneMapper
-from mapper.CharacterMapper import CharacterMapper
-from mapper.CharacterSceneMapper import CharacterSceneMapper
 from controller.ChatController import create_chat_controller
 from controller.CharacterController import create_character_controller
 from controller.SceneController import create_scene_controller
 from controller.ConversationController import create_conversation_controller
+from controller.StoryController import create_story_controller
+from controller.BulkIngestController import create_bulk_ingest_controller
+from controller.ArchiveController import create_archive_controller
+from controller.MetricsController import create_metrics_controller
 from service.ConversationService import ConversationService
+from service.StoryService import StoryService
+from service.BulkIngestService import BulkIngestService
+from service.ArchiveService import ArchiveService
+from utils.FastResponse import EntityJSONResponse, EntityRoute
+from entity.BaseModel import BaseDtoModel
+from mapper.config.Migrations import run_migrations, check_query_plans
+from mapper.config.LoadDB import install_cypher_metrics, uninstall_cypher_metrics
+from utils.ChangeFeed import change_feed
+from utils.Metrics import registry
 
 
-def init_chat_service() -> ChatService:
+def init_chat_service(container: Container) -> ChatService:
     """
     初始化聊天服务
     """
     try:
-        # 初始化依赖
-        prepare_chat_history = PrepareChatHistory(
-            SceneMapper(),
-            ConversationMapper(),
-            CharacterMapper(),
-            CharacterSceneMapper()
-        )
-        chat_core = LangchainEngine(prepare_chat_history)
-        conversation_mapper = ConversationMapper()
-        character_mapper = CharacterMapper()
-        character_scene_mapper = CharacterSceneMapper()
-        scene_mapper = SceneMapper()
-
         # 创建ChatService实例
-        chat_service = ChatService(chat_core, conversation_mapper, character_mapper, character_scene_mapper, scene_mapper)
+        chat_service = ChatService(container.chat_core, container.conversation_mapper, container.character_mapper,
+                                   container.character_scene_mapper, container.scene_mapper)
         return chat_service
     except Exception as e:
         raise Exception(f"初始化ChatService失败: {str(e)}")
 
 
-def init_character_service() -> CharacterService:
+def init_character_service(container: Container) -> CharacterService:
     """
     初始化角色服务
     """
     try:
-        # 初始化依赖
-        character_mapper = CharacterMapper()
-
         # 创建CharacterService实例
-        character_service = CharacterService(character_mapper)
+        character_service = CharacterService(container.character_mapper)
         return character_service
     except Exception as e:
         raise Exception(f"初始化CharacterService失败: {str(e)}")
 
 
-def init_scene_service() -> SceneService:
+def init_scene_service(container: Container) -> SceneService:
     """
     初始化场景服务
     """
     try:
-        # 初始化依赖
-        scene_mapper = SceneMapper()
-        character_mapper = CharacterMapper()
-        character_scene_mapper = CharacterSceneMapper()
-
         # 创建SceneService实例
         scene_service = SceneService(
-            scene_mapper=scene_mapper,
-            character_mapper=character_mapper,
-            character_scene_mapper=character_scene_mapper
+            scene_mapper=container.scene_mapper,
+            character_mapper=container.character_mapper,
+            character_scene_mapper=container.character_scene_mapper
         )
         return scene_service
     except Exception as e:
         raise Exception(f"初始化SceneService失败: {str(e)}")
 
 
-def init_conversation_service() -> ConversationService:
+def init_conversation_service(container: Container) -> ConversationService:
     """
     初始化对话服务
     """
     try:
-        # 初始化依赖
-        conversation_mapper = ConversationMapper()
-
         # 创建ConversationService实例
-        conversation_service = ConversationService(conversation_mapper)
+        conversation_service = ConversationService(
+            container.conversation_mapper,
+            scene_mapper=container.scene_mapper,
+            event_mapper=container.conversation_event_mapper
+        )
         return conversation_service
     except Exception as e:
         raise Exception(f"初始化ConversationService失败: {str(e)}")
 
 
+def init_bulk_ingest_service(container: Container) -> BulkIngestService:
+    """
+    初始化批量写入服务
+    """
+    try:
+        # 创建BulkIngestService实例
+        bulk_ingest_service = BulkIngestService(
+            scene_mapper=container.scene_mapper,
+            character_mapper=container.character_mapper,
+            character_scene_mapper=container.character_scene_mapper,
+            conversation_mapper=container.conversation_mapper
+        )
+        return bulk_ingest_service
+    except Exception as e:
+        raise Exception(f"初始化BulkIngestService失败: {str(e)}")
+
+
+def init_story_service(container: Container, bulk_ingest_service: BulkIngestService) -> StoryService:
+    """
+    初始化故事导入导出服务
+    """
+    try:
+        # 创建StoryService实例，导入复用批量写入服务
+        story_service = StoryService(
+            scene_mapper=container.scene_mapper,
+            character_mapper=container.character_mapper,
+            character_scene_mapper=container.character_scene_mapper,
+            conversation_mapper=container.conversation_mapper,
+            bulk_ingest_service=bulk_ingest_service
+        )
+        return story_service
+    except Exception as e:
+        raise Exception(f"初始化StoryService失败: {str(e)}")
+
+
+def init_archive_service(container: Container) -> ArchiveService:
+    """
+    初始化对话归档服务
+    """
+    try:
+        # 创建ArchiveService实例
+        archive_service = ArchiveService(container.archive)
+        return archive_service
+    except Exception as e:
+        raise Exception(f"初始化ArchiveService失败: {str(e)}")
+
+
+def metrics_directory() -> str:
+    """
+    所有工作进程共用的指标目录
+    """
+    return os.getenv("METRICS_DIR") or os.path.join(change_feed.directory, "metrics")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    每个工作进程启动和退出时执行
+    """
+    container: Container = app.state.container
+    database = BaseDtoModel._meta.database
+    # 执行数据库结构变更（多个进程同时启动时只有一个会执行），并检查热点查询是否用上了索引
+    run_migrations(database)
+    check_query_plans(database)
+    # 统计neomodel的Cypher查询，在预热连接之前安装
+    install_cypher_metrics()
+    # 各工作进程把指标写入共享目录，/metrics输出所有进程合并后的结果
+    registry.share(metrics_directory())
+    # 监听其他工作进程的变更通知，后台预热Neo4j和LLM连接
+    change_feed.start()
+    container.warm_up()
+    try:
+        yield
+    finally:
+        # 删除本进程的通知套接字，释放容器持有的连接
+        change_feed.stop()
+        container.close()
+        uninstall_cypher_metrics()
+        registry.unshare()
+
+
 def create_app() -> FastAPI:
     """
     创建并配置FastAPI应用
+    只创建对象不连接数据库，可作为uvicorn的factory在每个工作进程中调用
     """
     # 创建FastAPI应用实例
     app = FastAPI(
         title="ReactNovel API",
         description="基于FastAPI的角色扮演聊天API服务，支持场景管理和角色管理",
-        version="1.0.0"
+        version="1.0.0",
+        default_response_class=EntityJSONResponse,
+        lifespan=lifespan
     )
+    # 控制器返回的ResponseEntity直接用orjson序列化，跳过jsonable_encoder
+    app.router.route_class = EntityRoute
 
     # 添加CORS中间件，支持跨域请求
     app.add_middleware(
@@ -126,35 +225,78 @@ def create_app() -> FastAPI:
         allow_headers=["*"],  # 允许所有HTTP头
     )
 
+    # 所有服务共享容器中的mapper和聊天引擎
+    container = app.state.container = Container()
+
     # 初始化服务
-    chat_service = init_chat_service()
-    character_service = init_character_service()
-    scene_service = init_scene_service()
-    conversation_service = init_conversation_service()
+    chat_service = init_chat_service(container)
+    character_service = init_character_service(container)
+    scene_service = init_scene_service(container)
+    conversation_service = init_conversation_service(container)
+    bulk_ingest_service = init_bulk_ingest_service(container)
+    story_service = init_story_service(container, bulk_ingest_service)
+    archive_service = init_archive_service(container)
 
     # 注册控制器路由
     create_chat_controller(app, chat_service)
     create_character_controller(app, character_service)
     create_scene_controller(app, scene_service)
     create_conversation_controller(app, conversation_service)
+    create_story_controller(app, story_service)
+    create_bulk_ingest_controller(app, bulk_ingest_service)
+    create_archive_controller(app, archive_service)
+    create_metrics_controller(app, chat_service)
 
     return app
 
 
-def main():
+def _pick(module: str, preferred: str, fallback: str) -> str:
+    # 可选依赖，未安装（如Windows上没有uvloop）时使用uvicorn自带的实现
+    return preferred if importlib.util.find_spec(module) is not None else fallback
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """
+    解析命令行参数
+    """
+    parser = argparse.ArgumentParser(description="启动TreeNovel API服务器")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"), help="监听地址")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")), help="监听端口")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")),
+                        help="工作进程数，建议与CPU核数相同")
+    parser.add_argument("--reload", action="store_true", help="开发模式，代码修改后自动重启，只能单进程")
+    parser.add_argument("--graceful-timeout", type=int, default=30,
+                        help="退出或重启时等待进行中请求（包括流式响应）完成的秒数")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers必须大于0")
+    if args.reload and args.workers > 1:
+        parser.error("--reload只能与单个工作进程一起使用")
+    return args
+
+
+def main(argv=None):
     """
     主函数：启动服务器
     """
-    # 创建应用
-    app = create_app()
+    args = parse_args(argv)
+    # 冷启动：上一次运行的计数不再延续；SIGHUP平滑重启工作进程不经过这里，合计值保留
+    registry.clear(metrics_directory())
 
-    # 启动服务器
+    # 以factory方式启动，每个工作进程各自创建应用
     uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=8000,
-        log_level="info",
-        reload=False  # 生产环境建议设置为False
+        "Start:create_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        reload=args.reload,
+        loop=_pick("uvloop", "uvloop", "asyncio"),
+        http=_pick("httptools", "utils.ServerProtocol:NoDelayHttpToolsProtocol",
+                   "utils.ServerProtocol:NoDelayH11Protocol"),
+        timeout_graceful_shutdown=args.graceful_timeout,
+        log_level=args.log_level
     )
 
 
@@ -0,0 +1,84 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from neomodel import config
+
+from config.Logger import logger
+from core.PrepareChatHistory import PrepareChatHistory
+from core.chat.ChatCore import ChatCore
+from core.chat.LangchainEngine import LangchainEngine
+from entity.BaseModel import BaseDtoModel
+from mapper.CharacterMapper import CharacterMapper
+from mapper.CharacterSceneMapper import CharacterSceneMapper
+from mapper.ConversationArchive import ConversationArchive, conversation_archive
+from mapper.ConversationEventMapper import ConversationEventMapper
+from mapper.ConversationMapper import ConversationMapper
+from mapper.SceneMapper import SceneMapper
+from mapper.config.LoadDB import close_neo4j, load_neo4j_config
+
+
+@dataclass
+class Container:
+    """
+    应用依赖容器，每个工作进程一份
+    mapper和聊天引擎只创建一次，由所有服务共享；创建时不连接数据库，
+    由lifespan在启动时调用warm_up预热连接、退出时调用close统一释放
+    """
+    scene_mapper: SceneMapper = field(default_factory=SceneMapper)
+    character_mapper: CharacterMapper = field(default_factory=CharacterMapper)
+    character_scene_mapper: CharacterSceneMapper = field(default_factory=CharacterSceneMapper)
+    conversation_event_mapper: ConversationEventMapper = field(default_factory=ConversationEventMapper)
+    conversation_mapper: Optional[ConversationMapper] = None
+    archive: ConversationArchive = field(default_factory=lambda: conversation_archive)
+    chat_core: Optional[ChatCore] = None
+    _warm_up_thread: Optional[threading.Thread] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.conversation_mapper is None:
+            self.conversation_mapper = ConversationMapper(self.conversation_event_mapper)
+        if self.chat_core is None:
+            self.chat_core = LangchainEngine(PrepareChatHistory(
+                self.scene_mapper,
+                self.conversation_mapper,
+                self.character_mapper,
+                self.character_scene_mapper
+            ))
+
+    def warm_up(self):
+        """
+        在后台线程中预热Neo4j连接和LLM客户端，不阻塞工作进程开始接受请求
+        预热失败只记录警告，对应的功能在第一次使用时再连接
+        """
+        self._warm_up_thread = threading.Thread(target=self._warm_up, name="container-warm-up", daemon=True)
+        self._warm_up_thread.start()
+
+    def _warm_up(self):
+        start = time.perf_counter()
+        try:
+            load_neo4j_config()
+            config.DRIVER.verify_connectivity()
+        except Exception as e:
+            logger.warning(f"预热Neo4j连接失败: {e}")
+        try:
+            self.chat_core.warm_up()
+        except Exception as e:
+            logger.warning(f"预热LLM客户端失败: {e}")
+        logger.info(f"连接预热完成，耗时{time.perf_counter() - start:.3f}s")
+
+    def close(self, timeout: float = 5):
+        """
+        释放LLM客户端、Neo4j驱动、归档段文件的映射和所有线程打开的SQLite连接
+        :param timeout: 等待尚未结束的预热的秒数
+        """
+        if self._warm_up_thread is not None:
+            self._warm_up_thread.join(timeout)
+        for name, close in (("LLM客户端", self.chat_core.close), ("Neo4j驱动", close_neo4j),
+                            ("归档段文件映射", self.archive.close)):
+            try:
+                close()
+            except Exception as e:
+                logger.error(f"关闭{name}失败: {e}")
+        closed = BaseDtoModel._meta.database.close_all()
+        logger.info(f"已关闭{closed}个SQLite连接")
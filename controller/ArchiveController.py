@@ -0,0 +1,54 @@
+from typing import Optional
+
+from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+
+from config.Logger import logger
+from entity.ResponseEntity import ResponseEntity
+from service.ArchiveService import ArchiveService
+
+
+def create_archive_controller(app: FastAPI, archive_service: ArchiveService):
+    """注册对话归档路由"""
+
+    @app.post("/api/archive/run")
+    async def archive_inactive_scenes(days: Optional[float] = None, limit: int = 100):
+        """
+        归档超过days天没有写入对话的情景，归档的对话在再次访问时自动恢复
+        """
+        try:
+            result = await run_in_threadpool(archive_service.archive_inactive_scenes, days, limit)
+
+            return ResponseEntity.success(
+                data=result,
+                message="归档完成"
+            )
+        except ValueError as e:
+            return ResponseEntity.error(
+                code=400,
+                message=f"参数错误: {str(e)}"
+            )
+        except Exception as e:
+            logger.error(f"归档失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"归档失败: {str(e)}"
+            )
+
+    @app.get("/api/archive/stats")
+    async def get_archive_stats():
+        """
+        获取归档的情景数、对话数和段文件大小
+        """
+        try:
+            stats = await run_in_threadpool(archive_service.get_stats)
+
+            return ResponseEntity.success(
+                data=stats,
+                message="归档统计获取成功"
+            )
+        except Exception as e:
+            return ResponseEntity.error(
+                code=500,
+                message=f"获取归档统计失败: {str(e)}"
+            )
@@ -0,0 +1,65 @@
+import orjson
+from fastapi import FastAPI, Request
+from starlette.concurrency import run_in_threadpool
+
+from config.Logger import logger
+from entity.ResponseEntity import ResponseEntity
+from service.BulkIngestService import BulkIngestService, BulkIngestError, SCENE, EDGE, CHARACTER, MEMBERSHIP, CONVERSATION
+
+# 请求体中的字段与记录类型，按写入顺序排列
+_BODY_FIELDS = (
+    ("scenes", SCENE),
+    ("edges", EDGE),
+    ("characters", CHARACTER),
+    ("memberships", MEMBERSHIP),
+    ("conversations", CONVERSATION),
+)
+
+
+def _log_progress(stats):
+    logger.debug(f"批量写入进度: {stats}")
+
+
+def create_bulk_ingest_controller(app: FastAPI, bulk_ingest_service: BulkIngestService):
+    """注册批量写入路由"""
+
+    @app.post("/api/bulk/ingest")
+    async def bulk_ingest(request: Request):
+        """
+        批量写入情景、边、角色、角色关联和对话记录
+        请求体：{"scenes": [...], "edges": [{"source", "target"}], "characters": [{"character_id", "name", "prompt", "is_visible"}],
+        "memberships": [{"character_id", "sid", "sort_order", "is_visible"}], "conversations": [{"message", "sid", "sender_id", "role"}]}
+        characters中的character_id是本批数据内的临时id，memberships和conversations可引用它或已存在的角色id。
+        请求体直接用orjson解析，不经过pydantic逐条校验。
+        """
+        try:
+            body = orjson.loads(await request.body())
+            if not isinstance(body, dict):
+                raise ValueError("请求体必须是JSON对象")
+            records = [(kind, item) for field, kind in _BODY_FIELDS for item in body.get(field) or []]
+
+            stats = await run_in_threadpool(bulk_ingest_service.ingest, records, _log_progress)
+
+            return ResponseEntity.success(
+                data=stats,
+                message="批量写入成功"
+            )
+        except BulkIngestError as e:
+            # 失败前已提交的批次不会回滚，返回已写入的数量
+            return ResponseEntity(
+                code=400 if e.invalid else 500,
+                message=f"{'参数错误' if e.invalid else '批量写入失败'}: {str(e)}",
+                data=e.stats
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            # orjson.JSONDecodeError是ValueError的子类
+            return ResponseEntity.error(
+                code=400,
+                message=f"参数错误: {str(e)}"
+            )
+        except Exception as e:
+            logger.error(f"批量写入失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"批量写入失败: {str(e)}"
+            )
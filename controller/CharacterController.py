@@ -1,9 +1,11 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from pydantic import BaseModel, Field
 
 from service.CharacterService import CharacterService
 from entity.BaseModel import Character
 from entity.ResponseEntity import ResponseEntity
+from utils.ChangeCounter import CHARACTER
+from utils.ConditionalResponse import response_cache
 
 
 class CreateCharacterRequest(BaseModel):
@@ -31,16 +33,17 @@ def create_character_controller(app: FastAPI, character_service: CharacterServic
     """注册角色控制器路由"""
 
     @app.get("/api/characters")
-    async def get_all_characters():
+    async def get_all_characters(request: Request):
         """
-        获取所有角色列表
+        获取所有角色列表，支持ETag条件请求
         """
         try:
-            characters = character_service.get_all_characters()
-
-            return ResponseEntity.success(
-                data=characters,
-                message="角色列表获取成功"
+            return response_cache.respond(
+                request, "characters", (CHARACTER,),
+                lambda: ResponseEntity.success(
+                    data=character_service.get_all_characters(),
+                    message="角色列表获取成功"
+                )
             )
         except Exception as e:
             return ResponseEntity.error(
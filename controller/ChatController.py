@@ -1,5 +1,7 @@
 from fastapi import FastAPI, Depends
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
 from pydantic import BaseModel, Field
 import json
 
@@ -7,6 +9,10 @@ from service.ChatService import ChatService
 from entity.BaseModel import Conversation, Character
 from entity.ResponseEntity import ResponseEntity
 from utils.ConvertPydantic import dataclass_to_pydantic
+from utils.Metrics import counter
+
+_SSE_EVENTS = counter("treenovel_sse_events_total", "流式聊天发送的SSE事件数")
+_SSE_BYTES = counter("treenovel_sse_bytes_total", "流式聊天发送的SSE字节数")
 
 # 聊天消息模型
 ConversationRequest = dataclass_to_pydantic(Conversation)
@@ -36,45 +42,40 @@ def create_chat_controller(app: FastAPI, chat_service: ChatService):
                 role=request.conversation.role
             )
 
-            # 调用ChatService的chat方法
-            result = chat_service.chat(
-                roleplay_id=request.roleplay_id,
-                conversation=conversation,
-                stream=request.stream
-            )
-
+            # 流式响应必须在轮次锁内读取到结束（assistant记录在读取结束时写入），
+            # 这里无法持有锁直到客户端读完，由/api/chat/stream处理
             if request.stream:
-                # 流式响应需要特殊处理
-                if "error" in result:
-                    # 错误处理
-                    return {"stream_data": True, "type": "error", "error": result["error"]}
-                else:
-                    # 返回流式数据和conversation_id
-                    return {
-                        "stream_data": True,
-                        "type": "streaming",
+                return ResponseEntity.error(
+                    code=400,
+                    message="参数错误: 流式对话请使用 /api/chat/stream"
+                )
+
+            # 调用ChatService的chat方法，同一情景内的轮次串行执行
+            async with chat_service.scene_turn_lock.turn(conversation.sid):
+                result = await run_in_threadpool(
+                    chat_service.chat,
+                    roleplay_id=request.roleplay_id,
+                    conversation=conversation,
+                    stream=False
+                )
+
+            # 非流式响应 - 使用ResponseEntity
+            if "error" in result:
+                return ResponseEntity.error(
+                    code=500,
+                    message=result["error"]
+                )
+            else:
+                return ResponseEntity.success(
+                    data={
+                        "response": result.get("response"),
                         "user_conversation_id": result.get("user_conversation_id"),
                         "assistant_conversation_id": result.get("assistant_conversation_id"),
-                        "stream": result.get("stream")
-                    }
-            else:
-                # 非流式响应 - 使用ResponseEntity
-                if "error" in result:
-                    return ResponseEntity.error(
-                        code=500,
-                        message=result["error"]
-                    )
-                else:
-                    return ResponseEntity.success(
-                        data={
-                            "response": result.get("response"),
-                            "user_conversation_id": result.get("user_conversation_id"),
-                            "assistant_conversation_id": result.get("assistant_conversation_id"),
-                            "roleplay_id": request.roleplay_id,
-                            "timestamp": int(__import__('time').time())
-                        },
-                        message="对话生成成功"
-                    )
+                        "roleplay_id": request.roleplay_id,
+                        "timestamp": int(__import__('time').time())
+                    },
+                    message="对话生成成功"
+                )
 
         except ValueError as e:
             # 参数错误
@@ -108,19 +109,8 @@ def create_chat_controller(app: FastAPI, chat_service: ChatService):
                 role=request.conversation.role
             )
 
-            # 调用ChatService的chat方法，强制流式响应
-            result = chat_service.chat(
-                roleplay_id=request.roleplay_id,
-                conversation=conversation,
-                stream=True
-            )
-
-            # 提取conversation_id
-            user_conversation_id = result.get("user_conversation_id")
-            assistant_conversation_id = result.get("assistant_conversation_id")
-
             # 定义SSE生成器函数
-            def sse_generator():
+            def sse_generator(result):
                 try:
                     if "error" in result:
                         # 发送错误信息
@@ -132,6 +122,20 @@ def create_chat_controller(app: FastAPI, chat_service: ChatService):
                         yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
                         return
 
+                    # 写库与LLM请求并行进行，等待写库完成后取得conversation_id
+                    try:
+                        user_conversation_id, assistant_conversation_id = result["conversation_ids"].result()
+                    except Exception:
+                        # 写库失败时停止上游请求，错误信息由stream产出
+                        for chunk in result["stream"]:
+                            error_data = {
+                                "error": {
+                                    "message": str(chunk)
+                                }
+                            }
+                            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+                        return
+
                     # 首先发送conversation_id信息
                     id_info_data = {
                         "type": "ids",
@@ -161,10 +165,41 @@ def create_chat_controller(app: FastAPI, chat_service: ChatService):
                     }
                     yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
 
+            # 本次响应创建的流式结果，响应结束或客户端断开时停止读取上游响应
+            results = []
+
+            def close_streams():
+                for result in results:
+                    close = result.get("close")
+                    if close is not None:
+                        close()
+
+            async def sse_generator_with_turn_lock():
+                # 同一情景内的轮次串行执行，锁持有到流式响应结束（assistant记录写入之后）
+                # 在生成器内获取锁，响应未开始时客户端断开也不会遗留锁
+                async with chat_service.scene_turn_lock.turn(conversation.sid):
+                    # 调用ChatService的chat方法，强制流式响应
+                    result = await run_in_threadpool(
+                        chat_service.chat,
+                        roleplay_id=request.roleplay_id,
+                        conversation=conversation,
+                        stream=True
+                    )
+                    results.append(result)
+                    try:
+                        async for event in iterate_in_threadpool(sse_generator(result)):
+                            _SSE_EVENTS.inc()
+                            _SSE_BYTES.inc(len(event.encode("utf-8")))
+                            yield event
+                    finally:
+                        close_streams()
+
             # 返回StreamingResponse，使用SSE格式
             return StreamingResponse(
-                sse_generator(),
+                sse_generator_with_turn_lock(),
                 media_type="text/event-stream",
+                # 生成器被取消时不一定执行finally，响应结束后（包括客户端断开）再关闭一次
+                background=BackgroundTask(close_streams),
                 headers={
                     "Cache-Control": "no-cache",
                     "Connection": "keep-alive",
@@ -190,6 +225,26 @@ def create_chat_controller(app: FastAPI, chat_service: ChatService):
                 message=f"流式聊天处理失败: {str(e)}"
             )
 
+    @app.get("/api/chat/queues")
+    async def get_chat_queues():
+        """
+        获取各情景的对话轮次队列指标
+        """
+        return ResponseEntity.success(
+            data=chat_service.scene_turn_lock.stats(),
+            message="队列指标获取成功"
+        )
+
+    @app.get("/api/chat/connections")
+    async def get_chat_connections():
+        """
+        获取LLM连接池的复用指标
+        """
+        return ResponseEntity.success(
+            data=chat_service.get_connection_stats(),
+            message="连接指标获取成功"
+        )
+
     @app.get("/api/health")
     async def health_check(chat_service: ChatService = Depends(lambda: chat_service)):
         """健康检查接口"""
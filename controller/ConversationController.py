@@ -1,6 +1,7 @@
 from typing import List, Optional
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 
 from service.ConversationService import ConversationService
 from entity.BaseModel import Conversation
@@ -62,6 +63,76 @@ def create_conversation_controller(app: FastAPI, conversation_service: Conversat
                 message=f"获取对话列表失败: {str(e)}"
             )
 
+    @app.get("/api/conversations/search")
+    async def search_conversations(q: str, scene_id: Optional[str] = None, sender_id: Optional[int] = None,
+                                   limit: int = 20, offset: int = 0):
+        """
+        全文搜索对话，可限定在某个场景及其后继场景中、限定发送者
+        结果按相关度排序，snippet中命中的文字用<mark></mark>包裹
+        """
+        try:
+            hits = await run_in_threadpool(
+                conversation_service.search_conversations, q, scene_id, sender_id, limit, offset
+            )
+
+            return ResponseEntity.success(
+                data=hits,
+                message="对话搜索成功"
+            )
+        except ValueError as e:
+            # 参数验证错误
+            return ResponseEntity.error(
+                code=400,
+                message=f"参数错误: {str(e)}"
+            )
+        except Exception as e:
+            return ResponseEntity.error(
+                code=500,
+                message=f"搜索对话失败: {str(e)}"
+            )
+
+    @app.get("/api/conversations/events")
+    async def get_conversation_events(after: int = 0, limit: int = 500, scene_id: Optional[str] = None):
+        """
+        按顺序读取对话的创建、修改、删除事件，下次请求把返回的next作为after
+        """
+        try:
+            result = await run_in_threadpool(conversation_service.get_conversation_events, after, limit, scene_id)
+
+            return ResponseEntity.success(
+                data=result,
+                message="对话事件获取成功"
+            )
+        except ValueError as e:
+            # 参数验证错误
+            return ResponseEntity.error(
+                code=400,
+                message=f"参数错误: {str(e)}"
+            )
+        except Exception as e:
+            return ResponseEntity.error(
+                code=500,
+                message=f"获取对话事件失败: {str(e)}"
+            )
+
+    @app.get("/api/conversations/scene/{scene_id}/history")
+    async def get_scene_history(scene_id: str, at: Optional[int] = None):
+        """
+        由事件日志重建场景在事件at之后的对话列表，不指定at时为最新状态（包括已归档的对话）
+        """
+        try:
+            conversations = await run_in_threadpool(conversation_service.get_scene_history, scene_id, at)
+
+            return ResponseEntity.success(
+                data=conversations,
+                message="对话历史获取成功"
+            )
+        except Exception as e:
+            return ResponseEntity.error(
+                code=500,
+                message=f"获取对话历史失败: {str(e)}"
+            )
+
     @app.post("/api/conversations")
     async def create_conversation(request: CreateConversationRequest):
         """
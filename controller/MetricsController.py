@@ -0,0 +1,26 @@
+from fastapi import FastAPI
+from fastapi.responses import Response
+
+from service.ChatService import ChatService
+from utils.Metrics import gauge, registry
+
+# Prometheus文本格式的Content-Type
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def create_metrics_controller(app: FastAPI, chat_service: ChatService):
+    """注册指标路由"""
+
+    # LLM连接池的统计在采集时读取
+    gauge("treenovel_llm_http_connections", "LLM连接池累计新建的连接数").set_function(
+        lambda: chat_service.get_connection_stats()["connections"])
+    gauge("treenovel_llm_http_reuse_ratio", "LLM对话请求中复用已有连接的比例").set_function(
+        lambda: chat_service.get_connection_stats()["reuse_rate"])
+
+    @app.get("/metrics")
+    async def get_metrics():
+        """
+        以Prometheus文本格式输出指标
+        多工作进程时无论请求落到哪个进程，都返回所有进程合并后的计数和直方图，瞬时值以worker标签区分
+        """
+        return Response(content=registry.render(), media_type=METRICS_CONTENT_TYPE)
@@ -1,11 +1,14 @@
 import uuid
 from typing import List, Optional, Union
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 
 from config.Logger import logger
 from service.SceneService import SceneService
 from entity.Scene import Scene
+from entity.dto.CharacterSceneDTO import CharacterSceneDto
 from entity.ResponseEntity import ResponseEntity
+from utils.ChangeCounter import SCENE, CHARACTER, CHARACTER_SCENE
+from utils.ConditionalResponse import response_cache
 from pydantic import BaseModel, Field
 
 
@@ -44,15 +47,41 @@ class ConnectCharacterRequest(BaseModel):
     is_visible: bool = Field(default=True, description="角色是否可见")
 
 
+# 批量获取场景角色请求模型
+class BatchSceneCharactersRequest(BaseModel):
+    """批量获取场景角色请求模型"""
+    sids: List[str] = Field(..., description="场景ID列表", max_length=1000)
+    include_invisible: bool = Field(default=True, description="是否包含不可见角色")
+
+
+def _character_scene_to_dict(dto: CharacterSceneDto) -> dict:
+    """场景角色关联转换为响应格式，包含完整的角色信息和关联信息；角色已被删除时character为null"""
+    character = dto.character
+    return {
+        "character_id": dto.character_id,
+        "scene_id": dto.sid,
+        "sort_order": dto.sort_order,
+        "is_visible": dto.is_visible,
+        "parent_id": dto.parent_id,
+        "character_scene_id": dto.character_scene_id,
+        "character": {
+            "character_id": character.character_id,
+            "name": character.name,
+            "prompt": character.prompt,
+            "is_visible": character.is_visible
+        } if character is not None else None
+    }
+
+
 def create_scene_controller(app: FastAPI, scene_service: SceneService):
     """注册场景控制器路由"""
 
     @app.get("/api/scenes")
-    async def get_all_scenes():
+    async def get_all_scenes(request: Request):
         """
-        获取所有场景列表
+        获取所有场景列表，支持ETag条件请求
         """
-        try:
+        def build():
             # 从图中获取所有场景
             graph = scene_service.get_all_scenes_graph()
             scene_list = [
@@ -69,6 +98,9 @@ def create_scene_controller(app: FastAPI, scene_service: SceneService):
                 data=scene_list,
                 message="场景列表获取成功"
             )
+
+        try:
+            return response_cache.respond(request, "scenes", (SCENE,), build)
         except Exception as e:
             return ResponseEntity.error(
                 code=500,
@@ -76,16 +108,17 @@ def create_scene_controller(app: FastAPI, scene_service: SceneService):
             )
 
     @app.get("/api/scenes/graph")
-    async def get_scenes_graph():
+    async def get_scenes_graph(request: Request):
         """
-        获取场景关系图
+        获取场景关系图，支持ETag条件请求
         """
         try:
-            graph = scene_service.get_all_scenes_graph()
-
-            return ResponseEntity.success(
-                data=graph,
-                message="场景图获取成功"
+            return response_cache.respond(
+                request, "scenes_graph", (SCENE,),
+                lambda: ResponseEntity.success(
+                    data=scene_service.get_all_scenes_graph(),
+                    message="场景图获取成功"
+                )
             )
         except Exception as e:
             logger.error(f"获取场景图失败: {str(e)}")
@@ -94,6 +127,51 @@ def create_scene_controller(app: FastAPI, scene_service: SceneService):
                 message=f"获取场景图失败: {str(e)}"
             )
 
+    @app.get("/api/scenes/graph/changes")
+    async def get_scenes_graph_changes(since: Optional[int] = None, epoch: Optional[str] = None):
+        """
+        获取场景图的增量变更
+        返回since版本之后新增、更新、删除的节点和边；无法增量同步时返回全图（reset为True）
+        """
+        try:
+            changes = scene_service.get_scene_graph_changes(since, epoch)
+
+            return ResponseEntity.success(
+                data=changes,
+                message="场景图变更获取成功"
+            )
+        except Exception as e:
+            logger.error(f"获取场景图变更失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"获取场景图变更失败: {str(e)}"
+            )
+
+    @app.get("/api/scenes/graph/main")
+    async def get_main_line(request: Request, skip: int = 0, limit: int = 200):
+        """
+        分页获取主线情景，节点只包含sid、名称和标记
+        """
+        try:
+            return response_cache.respond(
+                request, f"main_line:{skip}:{limit}", (SCENE,),
+                lambda: ResponseEntity.success(
+                    data=scene_service.get_main_line(skip, limit),
+                    message="主线情景获取成功"
+                )
+            )
+        except ValueError as e:
+            return ResponseEntity.error(
+                code=400,
+                message=f"参数错误: {str(e)}"
+            )
+        except Exception as e:
+            logger.error(f"获取主线情景失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"获取主线情景失败: {str(e)}"
+            )
+
     @app.get("/api/scenes/{scene_id}")
     async def get_scene_by_id(scene_id: str):
         """
@@ -240,36 +318,26 @@ def create_scene_controller(app: FastAPI, scene_service: SceneService):
             )
 
     @app.get("/api/scenes/{scene_id}/characters")
-    async def get_scene_characters(scene_id: str, include_invisible: bool = True):
+    async def get_scene_characters(request: Request, scene_id: str, include_invisible: bool = True):
         """
-        获取场景的角色列表
+        获取场景的角色列表，支持ETag条件请求
         """
-        try:
+        def build():
             character_scene_dtos = scene_service.get_characters_by_scene(scene_id, include_invisible=include_invisible)
 
             # 转换为响应格式，包含完整的角色信息和关联信息
-            character_list = [
-                {
-                    "character_id": dto.character_id,
-                    "scene_id": dto.sid,
-                    "sort_order": dto.sort_order,
-                    "is_visible": dto.is_visible,
-                    "parent_id": dto.parent_id,
-                    "character_scene_id": dto.character_scene_id,
-                    "character": {
-                        "character_id": dto.character.character_id,
-                        "name": dto.character.name,
-                        "prompt": dto.character.prompt,
-                        "is_visible": dto.character.is_visible
-                    }
-                }
-                for dto in character_scene_dtos
-            ]
+            character_list = [_character_scene_to_dict(dto) for dto in character_scene_dtos]
 
             return ResponseEntity.success(
                 data=character_list,
                 message="场景角色列表获取成功"
             )
+
+        try:
+            return response_cache.respond(
+                request, f"scene_characters:{scene_id}:{include_invisible}",
+                (CHARACTER, CHARACTER_SCENE), build
+            )
         except Exception as e:
             logger.error(f"获取场景角色列表失败: {str(e)}")
             return ResponseEntity.error(
@@ -277,6 +345,29 @@ def create_scene_controller(app: FastAPI, scene_service: SceneService):
                 message=f"获取场景角色列表失败: {str(e)}"
             )
 
+    @app.post("/api/scenes/characters:batch")
+    async def get_scenes_characters_batch(request: BatchSceneCharactersRequest):
+        """
+        批量获取多个场景的角色列表，返回 场景ID -> 角色列表
+        """
+        try:
+            character_scenes = scene_service.get_characters_by_scenes(
+                request.sids, include_invisible=request.include_invisible)
+
+            return ResponseEntity.success(
+                data={
+                    scene_id: [_character_scene_to_dict(dto) for dto in dtos]
+                    for scene_id, dtos in character_scenes.items()
+                },
+                message="场景角色列表获取成功"
+            )
+        except Exception as e:
+            logger.error(f"批量获取场景角色列表失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"批量获取场景角色列表失败: {str(e)}"
+            )
+
     @app.post("/api/scenes/{scene_id}/characters")
     async def connect_character_to_scene(scene_id: str, request: ConnectCharacterRequest):
         """
@@ -318,6 +409,96 @@ def create_scene_controller(app: FastAPI, scene_service: SceneService):
                 message=f"连接角色到场景失败: {str(e)}"
             )
 
+    @app.get("/api/scenes/{scene_id}/neighborhood")
+    async def get_scene_neighborhood(request: Request, scene_id: str, hops: int = 1):
+        """
+        获取场景周围hops跳以内的子图，节点只包含sid、名称和标记
+        """
+        def build():
+            graph = scene_service.get_neighborhood(scene_id, hops)
+            if not graph.nodes:
+                return ResponseEntity.not_found(
+                    message=f"场景 {scene_id} 不存在"
+                )
+            return ResponseEntity.success(
+                data=graph,
+                message="场景邻域获取成功"
+            )
+
+        try:
+            return response_cache.respond(request, f"neighborhood:{scene_id}:{hops}", (SCENE,), build)
+        except ValueError as e:
+            return ResponseEntity.error(
+                code=400,
+                message=f"参数错误: {str(e)}"
+            )
+        except Exception as e:
+            logger.error(f"获取场景邻域失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"获取场景邻域失败: {str(e)}"
+            )
+
+    @app.get("/api/scenes/{scene_id}/descendants")
+    async def get_scene_descendants(request: Request, scene_id: str, depth: int = 1):
+        """
+        获取场景depth层以内的后续场景，节点只包含sid、名称和标记
+        """
+        def build():
+            graph = scene_service.get_descendants(scene_id, depth)
+            if not graph.nodes:
+                return ResponseEntity.not_found(
+                    message=f"场景 {scene_id} 不存在"
+                )
+            return ResponseEntity.success(
+                data=graph,
+                message="后续场景获取成功"
+            )
+
+        try:
+            return response_cache.respond(request, f"descendants:{scene_id}:{depth}", (SCENE,), build)
+        except ValueError as e:
+            return ResponseEntity.error(
+                code=400,
+                message=f"参数错误: {str(e)}"
+            )
+        except Exception as e:
+            logger.error(f"获取后续场景失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"获取后续场景失败: {str(e)}"
+            )
+
+    @app.get("/api/scenes/{scene_id}/ancestors")
+    async def get_scene_ancestors(request: Request, scene_id: str, depth: Optional[int] = None):
+        """
+        获取场景的前情景子图，depth为空时一直找到根场景
+        """
+        def build():
+            graph = scene_service.get_ancestors(scene_id, depth)
+            if not graph.nodes:
+                return ResponseEntity.not_found(
+                    message=f"场景 {scene_id} 不存在"
+                )
+            return ResponseEntity.success(
+                data=graph,
+                message="前情景获取成功"
+            )
+
+        try:
+            return response_cache.respond(request, f"ancestors:{scene_id}:{depth}", (SCENE,), build)
+        except ValueError as e:
+            return ResponseEntity.error(
+                code=400,
+                message=f"参数错误: {str(e)}"
+            )
+        except Exception as e:
+            logger.error(f"获取前情景失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"获取前情景失败: {str(e)}"
+            )
+
     @app.get("/api/scenes/{scene_id}/parents")
     async def get_scene_parents(scene_id: str):
         """
@@ -0,0 +1,79 @@
+import tempfile
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from config.Logger import logger
+from entity.ResponseEntity import ResponseEntity
+from service.BulkIngestService import BulkIngestError
+from service.StoryService import StoryService
+
+# 导入时请求体超过该大小后转存到临时文件
+IMPORT_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def _log_progress(stats):
+    logger.debug(f"故事导入进度: {stats}")
+
+
+def create_story_controller(app: FastAPI, story_service: StoryService):
+    """注册故事导入导出路由"""
+
+    @app.get("/api/scenes/{scene_id}/export")
+    async def export_story(scene_id: str):
+        """
+        以NDJSON流式导出从该场景出发的整个故事（场景、边、角色、角色关联、对话记录）
+        """
+        try:
+            if not await run_in_threadpool(story_service.has_scene, scene_id):
+                return ResponseEntity.not_found(
+                    message=f"场景 {scene_id} 不存在"
+                )
+
+            return StreamingResponse(
+                story_service.export_story(scene_id),
+                media_type="application/x-ndjson",
+                headers={"Content-Disposition": f'attachment; filename="story-{scene_id}.ndjson"'}
+            )
+        except Exception as e:
+            logger.error(f"导出故事失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"导出故事失败: {str(e)}"
+            )
+
+    @app.post("/api/scenes/import")
+    async def import_story(request: Request):
+        """
+        导入export接口导出的NDJSON，请求体即为NDJSON内容
+        """
+        try:
+            with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE) as spool:
+                async for chunk in request.stream():
+                    spool.write(chunk)
+                spool.seek(0)
+                stats = await run_in_threadpool(story_service.import_story, spool, _log_progress)
+
+            return ResponseEntity.success(
+                data=stats,
+                message="故事导入成功"
+            )
+        except BulkIngestError as e:
+            # 失败前已提交的批次不会回滚，返回已写入的数量
+            return ResponseEntity(
+                code=400 if e.invalid else 500,
+                message=f"{'参数错误' if e.invalid else '导入故事失败'}: {str(e)}",
+                data=e.stats
+            )
+        except ValueError as e:
+            return ResponseEntity.error(
+                code=400,
+                message=f"参数错误: {str(e)}"
+            )
+        except Exception as e:
+            logger.error(f"导入故事失败: {str(e)}")
+            return ResponseEntity.error(
+                code=500,
+                message=f"导入故事失败: {str(e)}"
+            )
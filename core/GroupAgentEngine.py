@@ -1,10 +1,17 @@
+import hashlib
 import os
+import threading
 import time
-from typing import List, Any
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Executor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import List, Any, Dict, Tuple, Callable, Optional
 
 from autogen import ConversableAgent, Agent
 from dotenv import load_dotenv
 
+from config.Logger import logger
 from entity.BaseModel import Character, ConversationRecord
 from entity.Scene import Scene
 
@@ -35,7 +42,7 @@ class CharacterAgent(ConversableAgent):
              silent: bool | None = False, is_resume=False):
         # 在该方法中可以保存角色的对话
         if is_resume is False:
-            print(f"{self.name} talk to {recipient.name}: {message}")
+            logger.debug(f"{self.name} talk to {recipient.name}: {message}")
         super().send(message, recipient, request_reply, silent)
 
     def _generate_oai_reply_from_client(self, llm_client, messages, cache) -> str | dict[str, Any] | None:
@@ -43,11 +50,54 @@ class CharacterAgent(ConversableAgent):
         return super()._generate_oai_reply_from_client(llm_client, messages, cache)
 
 
+class MessageLog:
+    """
+    群聊共享的只追加消息日志
+
+    每条消息在日志中只保存一份，每个agent按对话对象记录可见消息在日志中的下标，
+    生成回复时按下标取出可见的聊天记录，不再在每对agent之间复制消息
+    """
+
+    def __init__(self):
+        self.messages: List[Dict[str, str]] = []
+        # agent名称 -> 对话对象名称 -> 可见消息的下标（递增）
+        self.visible: Dict[str, Dict[str, List[int]]] = defaultdict(lambda: defaultdict(list))
+
+    def append(self, sender_name: str, recipient_names: List[str], content: str) -> int:
+        """
+        追加一条消息，发送者与每个接收者互相可见
+        :return: 消息在日志中的下标
+        """
+        index = len(self.messages)
+        # 与autogen存入chat_messages的消息格式保持一致
+        self.messages.append({"content": content, "name": sender_name, "role": "user"})
+        for recipient_name in recipient_names:
+            # 不要自己与自己对话
+            if recipient_name != sender_name:
+                self.visible[sender_name][recipient_name].append(index)
+                self.visible[recipient_name][sender_name].append(index)
+        return index
+
+    def history_for(self, speaker_name: str, sender_name: str, member_names: List[str]) -> List[Dict[str, str]]:
+        """
+        获取speaker可见的聊天记录：依次拼接与其他成员的聊天记录，与要对话的成员的聊天记录放在最后一组
+        """
+        visible = self.visible.get(speaker_name, {})
+        indices = []
+        for member_name in member_names:
+            if member_name != sender_name:
+                indices.extend(visible.get(member_name, ()))
+        indices.extend(visible.get(sender_name, ()))
+        return [self.messages[index] for index in indices]
+
+
 class CharacterGroupChat:
-    def __init__(self, agents: List[CharacterAgent | UserProxyAgent | Agent], scene: Scene):
+    def __init__(self, agents: List[CharacterAgent | UserProxyAgent | Agent], scene: Scene,
+                 message_log: Optional[MessageLog] = None):
         self.agents = {agent.name: agent for agent in agents}
         self.chat_history = []
         self.scene = scene
+        self.message_log = message_log if message_log is not None else MessageLog()
 
     def introduce(self):
         pass
@@ -64,41 +114,189 @@ class CharacterGroupChat:
         if is_resume is False:
             self.chat_history.append(msg)
 
-        for recipient in recipients:
-            # 不要自己与自己对话
-            if sender.character_id != recipient.character_id:
-                sender.receive(msg.to_dict(), recipient, request_reply=False)
-                recipient.receive(msg.to_dict(), sender, request_reply=False)
-            # sender.send(msg, recipient, is_resume=is_resume, request_reply=False)
+        self.message_log.append(msg.name, msg.recipient, msg.content)
 
     def reply(self, speaker: ConversableAgent, sender: ConversableAgent, recipients: List[ConversableAgent]):
         """让某个角色生成回复"""
-        def process_all_messages_before_reply(messages):
-            agent_messages = []
-            for agent in self.agents.values():
-                agent_messages.extend(speaker.chat_messages[agent]) if agent.name != sender.name else agent_messages
-            # 将与要对话的agent的聊天记录放在最后一组
-            agent_messages.extend(speaker.chat_messages[sender])
-            print(agent_messages)
-            return agent_messages
-
-        speaker.register_hook("process_all_messages_before_reply", process_all_messages_before_reply)
-        reply = speaker.generate_reply(sender=sender)
-        print(f"this is {speaker.name}'s reply: {reply}")
+        reply = self._generate(speaker, sender)
+        logger.debug(f"{speaker.name} 的回复: {reply}")
 
         if reply:
             self.send(sender=speaker, recipients=recipients, content=reply)
         return reply
 
+    def reply_concurrently(self, speakers: List[ConversableAgent], sender: ConversableAgent,
+                           recipients: List[ConversableAgent], executor: Executor) -> List:
+        """
+        让多个角色基于同一份聊天记录快照并行生成回复
+        生成期间不发送任何消息，全部生成完成后按speakers的顺序依次发送，保证chat_history的顺序确定
+        """
+        futures = [executor.submit(self._generate, speaker, sender) for speaker in speakers]
+        # 等待全部完成后再写回，任意角色失败时抛出按speakers顺序的第一个异常
+        wait(futures)
+        replies = [future.result() for future in futures]
+
+        for speaker, reply in zip(speakers, replies):
+            logger.debug(f"{speaker.name} 的回复: {reply}")
+            if reply:
+                self.send(sender=speaker, recipients=recipients, content=reply)
+        return replies
+
+    def _generate(self, speaker: ConversableAgent, sender: ConversableAgent):
+        # 直接传入speaker可见的聊天记录，不依赖agent自身的chat_messages
+        messages = self.message_log.history_for(speaker.name, sender.name, list(self.agents))
+        return speaker.generate_reply(messages=messages, sender=sender)
+
     def resume_chat(self, chat_messages: List[ConversationRecord]):
+        # 回放只需要名称，不要求记录中的角色都在本次群组中
         for chat_message in chat_messages:
-            self.send(sender=self.agents[chat_message.name],
-                      recipients=[self.agents[recipient] for recipient in chat_message.recipient],
-                      content=chat_message.content, is_resume=True)
+            self.message_log.append(chat_message.name, chat_message.recipient, chat_message.content)
+
+
+@dataclass
+class ScenePoolEntry:
+    """
+    某个情景下池化的agent及其消息日志
+    """
+    # (character_id, prompt版本) -> agent
+    agents: Dict[Tuple[int, str], ConversableAgent] = field(default_factory=dict)
+    # 情景的消息日志，所有agent共享
+    message_log: MessageLog = field(default_factory=MessageLog)
+    # 已写入消息日志的聊天记录数量
+    applied: int = 0
+    # 最后一条已应用记录的指纹，用于判断传入的聊天记录是否与已应用的记录一致
+    last_fingerprint: Optional[Tuple] = None
+    # 已应用记录的估算大小（字节）
+    size_bytes: int = 0
+
+
+def _prompt_version(name: str, prompt: str) -> str:
+    return hashlib.sha1(f"{name}\0{prompt}".encode("utf-8")).hexdigest()[:16]
+
+
+def _record_fingerprint(record: ConversationRecord) -> Tuple:
+    return record.time, record.name, record.content
+
+
+class AgentPool:
+    """
+    复用已创建的agent（及其LLM客户端）和情景的消息日志
+
+    agent以(character_id, prompt版本, 情景)为键缓存，每个情景保留一份消息日志，
+    再次对话时只需回放新增的聊天记录。按情景整体进行LRU淘汰，情景数量或估算内存超出上限时淘汰最久未使用的情景。
+    同一情景的agent和消息日志由该情景的所有对话共享，对话需要在conversation()中进行。
+    """
+
+    def __init__(self, max_scenes: int = 64, max_bytes: int = 32 * 1024 * 1024):
+        self.max_scenes = max_scenes
+        self.max_bytes = max_bytes
+        self._scenes: OrderedDict[str, ScenePoolEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        # 情景id -> (对话锁, 持有和等待该锁的对话数)，与池中的情景分开保存，情景被淘汰时锁仍然有效
+        self._scene_locks: Dict[str, Tuple[threading.Lock, int]] = {}
+
+    def _entry(self, scene_id: str) -> ScenePoolEntry:
+        entry = self._scenes.get(scene_id)
+        if entry is None:
+            entry = self._scenes[scene_id] = ScenePoolEntry()
+        self._scenes.move_to_end(scene_id)
+        return entry
+
+    @contextmanager
+    def conversation(self, scene_id: str):
+        """
+        在情景中进行一次对话，同一情景的对话串行执行
+        从回放聊天记录到mark_applied的整个过程持有锁，避免两次对话交替写入共享的消息日志和agent
+        :param scene_id: 情景id
+        """
+        with self._lock:
+            lock, users = self._scene_locks.get(scene_id) or (threading.Lock(), 0)
+            self._scene_locks[scene_id] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                users = self._scene_locks[scene_id][1] - 1
+                if users:
+                    self._scene_locks[scene_id] = (lock, users)
+                else:
+                    del self._scene_locks[scene_id]
+
+    def get(self, scene_id: str, character: Character,
+            factory: Callable[[], ConversableAgent]) -> ConversableAgent:
+        """
+        获取池中的agent，不存在时使用factory创建
+        角色名称或prompt修改后版本号变化，会替换旧agent
+        """
+        version = _prompt_version(character.name, str(character.prompt))
+        with self._lock:
+            entry = self._entry(scene_id)
+            agent = entry.agents.get((character.character_id, version))
+            if agent is None:
+                for key in [key for key in entry.agents if key[0] == character.character_id]:
+                    del entry.agents[key]
+                agent = entry.agents[(character.character_id, version)] = factory()
+            return agent
+
+    def message_log(self, scene_id: str,
+                    chat_history: List[ConversationRecord]) -> Tuple[MessageLog, List[ConversationRecord]]:
+        """
+        获取情景的消息日志和需要回放的聊天记录
+        聊天记录是已应用记录的延续时只返回新增的记录；否则重建消息日志并返回全部记录
+        """
+        with self._lock:
+            entry = self._entry(scene_id)
+            if (len(chat_history) >= entry.applied
+                    and (entry.applied == 0
+                         or _record_fingerprint(chat_history[entry.applied - 1]) == entry.last_fingerprint)):
+                return entry.message_log, chat_history[entry.applied:]
+
+            self._reset(entry)
+            return entry.message_log, chat_history
+
+    def reset(self, scene_id: str):
+        """
+        清空情景的消息日志，对话中途失败时调用，日志中可能只写入了部分记录，下次对话重新回放全部聊天记录
+        """
+        with self._lock:
+            entry = self._scenes.get(scene_id)
+            if entry is not None:
+                self._reset(entry)
+
+    @staticmethod
+    def _reset(entry: ScenePoolEntry):
+        entry.message_log = MessageLog()
+        entry.applied = 0
+        entry.last_fingerprint = None
+        entry.size_bytes = 0
+
+    def mark_applied(self, scene_id: str, chat_history: List[ConversationRecord]):
+        """
+        记录本次对话结束后消息日志中已包含的聊天记录，并按上限淘汰情景
+        """
+        with self._lock:
+            entry = self._scenes.get(scene_id)
+            if entry is None:
+                return
+
+            entry.size_bytes += sum(len(record.content.encode("utf-8")) for record in chat_history[entry.applied:])
+            entry.applied = len(chat_history)
+            entry.last_fingerprint = _record_fingerprint(chat_history[-1]) if chat_history else None
+            self._evict(keep=scene_id)
+
+    def _evict(self, keep: str):
+        total_bytes = sum(entry.size_bytes for entry in self._scenes.values())
+        while len(self._scenes) > 1 and (len(self._scenes) > self.max_scenes or total_bytes > self.max_bytes):
+            scene_id = next(iter(self._scenes))
+            if scene_id == keep:
+                break
+            total_bytes -= self._scenes.pop(scene_id).size_bytes
 
 
 class GroupAgentEngine:
-    def __init__(self, ):
+    def __init__(self, max_pooled_scenes: int = 64, max_pooled_bytes: int = 32 * 1024 * 1024,
+                 max_concurrent_speakers: int = 8):
         load_dotenv()
         self.config_list = [
             {
@@ -114,27 +312,50 @@ class GroupAgentEngine:
             # "temperature": 0.7,
         }
 
-    def get_user_character_agent(self, user_character: Character):
-        user_character_agent = UserProxyAgent(
-            name=user_character.name,
-            system_message=user_character.prompt,
-            human_input_mode="ALWAYS",
-            code_execution_config=False,
-            silent=True,
-            character_id=user_character.character_id
-        )
-        return user_character_agent
-
-    def get_character_agent(self, characters: List[Character]):
+        # 按情景复用agent，避免每次对话都重建agent和LLM客户端并回放全部聊天记录
+        self.agent_pool = AgentPool(max_scenes=max_pooled_scenes, max_bytes=max_pooled_bytes)
+        # 多个角色并行生成回复时使用的线程池
+        self._speaker_executor = ThreadPoolExecutor(max_workers=max_concurrent_speakers,
+                                                    thread_name_prefix="group-chat-speaker")
+
+    def get_user_character_agent(self, user_character: Character, scene: Optional[Scene] = None):
+        """
+        获取用户的agent
+        :param user_character: 用户扮演的角色
+        :param scene: 情景，指定时从agent池中复用
+        """
+        def create():
+            return UserProxyAgent(
+                name=user_character.name,
+                system_message=str(user_character.prompt),
+                human_input_mode="ALWAYS",
+                code_execution_config=False,
+                silent=True,
+                character_id=user_character.character_id
+            )
+
+        if scene is None:
+            return create()
+        return self.agent_pool.get(scene.sid, user_character, create)
+
+    def get_character_agent(self, characters: List[Character], scene: Optional[Scene] = None):
+        """
+        获取角色的agent列表
+        :param characters: 角色列表
+        :param scene: 情景，指定时从agent池中复用
+        """
         character_agent = []
         for character in characters:
-            character_agent.append(CharacterAgent(
-                name=character.name,
-                system_message=character.prompt,
-                llm_config=self.llm_config,
-                silent=True,
-                character_id=character.character_id
-            ))
+            def create(character=character):
+                return CharacterAgent(
+                    name=character.name,
+                    system_message=str(character.prompt),
+                    llm_config=self.llm_config,
+                    silent=True,
+                    character_id=character.character_id
+                )
+
+            character_agent.append(create() if scene is None else self.agent_pool.get(scene.sid, character, create))
         return character_agent
 
     def start_conversation(self, scene: Scene,
@@ -145,7 +366,8 @@ class GroupAgentEngine:
                            speaker_recipients: List[CharacterAgent | UserProxyAgent],
                            chat_history=None,
                            conversation: ConversationRecord = None,
-                           recipients: List[CharacterAgent | UserProxyAgent] = None):
+                           recipients: List[CharacterAgent | UserProxyAgent] = None,
+                           concurrent_speakers: bool = False):
         """
         开始对话
         :param scene: 情景类
@@ -157,6 +379,8 @@ class GroupAgentEngine:
         :param chat_history: 聊天历史记录, 如果有则从该字段中恢复聊天记录
         :param conversation: 用户发送的信息, 可为空, 表示用户不发言, speakers角色发言给speak_to
         :param recipients: 指定哪些角色agent可以接收角色的回复, 可以是CharacterAgent或UserProxyAgent
+        :param concurrent_speakers: 是否让speakers基于同一份聊天记录并行生成回复, 互相看不到本轮其他角色的回复,
+                                    回复按speakers的顺序写入聊天记录
         :return: List[ConversationRecord]
         """
         # 确保all_agents包含所有可能用到的角色agent
@@ -187,20 +411,38 @@ class GroupAgentEngine:
             if agent not in all_agents:
                 all_agents.append(agent)
         
-        # 创建群组聊天, 将用户agent也添加到群组中
-        character_group_chat = CharacterGroupChat(all_agents + [user_agent], scene=scene)
-
-        if chat_history:
-            character_group_chat.resume_chat(chat_history)
-
-        # 可广播信息
-        if conversation and conversation.content and recipients:
-            character_group_chat.send(user_agent, recipients, conversation.content)
-
-        # 指定任意角色回复
-        for speaker in speakers:
-            character_group_chat.reply(speaker=speaker, sender=speak_to, recipients=speaker_recipients)
-
+        # 同一情景的对话共享消息日志和agent, 整个对话期间持有情景的对话锁
+        with self.agent_pool.conversation(scene.sid):
+            try:
+                # 情景的消息日志已包含之前的聊天记录, 只回放新增的记录
+                chat_history = chat_history or []
+                message_log, pending_records = self.agent_pool.message_log(scene.sid, chat_history)
+
+                # 创建群组聊天, 将用户agent也添加到群组中
+                character_group_chat = CharacterGroupChat(all_agents + [user_agent], scene=scene,
+                                                          message_log=message_log)
+
+                if pending_records:
+                    character_group_chat.resume_chat(pending_records)
+
+                # 可广播信息
+                if conversation and conversation.content and recipients:
+                    character_group_chat.send(user_agent, recipients, conversation.content)
+
+                # 指定任意角色回复
+                if concurrent_speakers and len(speakers) > 1:
+                    character_group_chat.reply_concurrently(speakers=speakers, sender=speak_to,
+                                                            recipients=speaker_recipients,
+                                                            executor=self._speaker_executor)
+                else:
+                    for speaker in speakers:
+                        character_group_chat.reply(speaker=speaker, sender=speak_to, recipients=speaker_recipients)
+
+                self.agent_pool.mark_applied(scene.sid, chat_history + character_group_chat.chat_history)
+            except BaseException:
+                # 消息日志可能已写入部分记录而applied未更新, 下次回放会重复, 清空后重建
+                self.agent_pool.reset(scene.sid)
+                raise
         return character_group_chat.chat_history
 
 
@@ -1,3 +1,4 @@
+import time
 from abc import ABC
 from typing import List, Callable, Any, Optional
 
@@ -10,6 +11,14 @@ from mapper.CharacterMapper import CharacterMapper
 from mapper.CharacterSceneMapper import CharacterSceneMapper
 from mapper.ConversationMapper import ConversationMapper
 from mapper.SceneMapper import SceneMapper
+from utils.Metrics import histogram
+from utils.ToolKit import estimate_tokens
+
+_CONTEXT_SECONDS = histogram("treenovel_context_assembly_seconds", "组装聊天上下文的耗时（秒）")
+_PROMPT_MESSAGES = histogram("treenovel_prompt_messages", "每次组装的上下文消息数",
+                             buckets=(2, 4, 8, 16, 32, 64, 128, 256, 512))
+_PROMPT_TOKENS = histogram("treenovel_prompt_estimated_tokens", "每次组装的上下文估算token数",
+                           buckets=(256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072))
 
 
 # 定义回调函数类型
@@ -27,9 +36,9 @@ def default_build_chat_history(
     """默认的聊天历史构建函数"""
     for conversation in chat_message:
         if conversation.role == "user":
-            langchain_messages.append(HumanMessage(content=conversation.message))
+            langchain_messages.append(HumanMessage(content=str(conversation.message)))
         elif conversation.role == "assistant":
-            langchain_messages.append(AIMessage(content=conversation.message))
+            langchain_messages.append(AIMessage(content=str(conversation.message)))
     return langchain_messages
 
 
@@ -79,7 +88,7 @@ def build_chat_history_with_role_switch(
             last_user_sender_id = conversation.sender_id
 
             # 添加用户消息
-            langchain_messages.append(HumanMessage(content=conversation.message))
+            langchain_messages.append(HumanMessage(content=str(conversation.message)))
 
         elif conversation.role == "assistant":
             # 检查是否需要添加LLM角色切换提示
@@ -100,7 +109,7 @@ def build_chat_history_with_role_switch(
             last_assistant_sender_id = conversation.sender_id
 
             # 添加AI消息
-            langchain_messages.append(AIMessage(content=conversation.message))
+            langchain_messages.append(AIMessage(content=str(conversation.message)))
 
     # 检查最后一条assistant消息的sender_id是否与roleplay_character_id一致
     if last_assistant_sender_id is not None and last_assistant_sender_id != roleplay_character_id:
@@ -150,6 +159,8 @@ class PrepareChatHistoryInterface(ABC):
                               user_character_id: int,
                               is_current_scene: bool = True,
                               build_chat_callback: Optional[BuildChatHistoryCallback] = None,
+                              pending_conversations: Optional[List[Conversation]] = None,
+                              history_watermark: Optional[int] = None,
                               **build_kwargs
                               ):
         """
@@ -159,6 +170,8 @@ class PrepareChatHistoryInterface(ABC):
         :param user_character_id: user扮演的角色
         :param is_current_scene: 是否将上下文和聊天记录限制在当前情景中
         :param build_chat_callback: 自定义构建对话上下文的方式
+        :param pending_conversations: 尚未写入数据库的对话，追加在历史记录末尾
+        :param history_watermark: 只使用conversation_id不大于该值的历史记录
         :param build_kwargs: 传递给回调函数的额外参数
         :return: langchain式的上下文
         """
@@ -199,7 +212,7 @@ class PrepareChatHistory(PrepareChatHistoryInterface):
             character = self.character_mapper.get_character_by_id(record.character_id)
             # 只添加可见角色的prompt
             if character.is_visible:
-                pre_chat_history += character.prompt
+                pre_chat_history += str(character.prompt)
                 pre_chat_history += "\n --- \n"
         return pre_chat_history
 
@@ -235,6 +248,8 @@ class PrepareChatHistory(PrepareChatHistoryInterface):
                               user_character_id: int,
                               is_current_scene: bool = True,
                               build_chat_callback: Optional[BuildChatHistoryCallback] = None,
+                              pending_conversations: Optional[List[Conversation]] = None,
+                              history_watermark: Optional[int] = None,
                               **build_kwargs
                               ):
         """
@@ -255,9 +270,13 @@ class PrepareChatHistory(PrepareChatHistoryInterface):
         :param user_character_id: 用户扮演的角色ID
         :param is_current_scene: 是否将上下文限制在当前情景中
         :param build_chat_callback: 自定义构建对话上下文的回调函数
+        :param pending_conversations: 尚未写入数据库的对话（与写库并行组装上下文时使用），追加在历史记录末尾
+        :param history_watermark: 历史记录水位线，只使用conversation_id不大于该值的记录，
+                                  避免并行写入的对话被重复读入
         :param build_kwargs: 传递给回调函数的额外参数
         :return: langchain格式的消息列表
         """
+        start = time.perf_counter()
         # 使用默认回调函数（如果未指定）
         if build_chat_callback is None:
             build_chat_callback = default_build_chat_history
@@ -282,6 +301,12 @@ class PrepareChatHistory(PrepareChatHistoryInterface):
             # 获取所有情景的上下文和对话（已包含情景可见性和角色可见性过滤）
             pre_chat, chat_message = self.get_all_chat_history_by_scene(scene_id, all_scenes, roleplay_character_id)
 
+        # 写库与上下文组装并行时，水位线之后的记录由pending_conversations提供
+        if history_watermark is not None:
+            chat_message = [conv for conv in chat_message if conv.conversation_id <= history_watermark]
+        if pending_conversations:
+            chat_message = chat_message + list(pending_conversations)
+
         # 检查角色是否首次出现在情景链中
         # 如果是首次出现（返回None），则需要完整的角色prompt
         # 如果不是首次出现，则不重复显示角色prompt（因为在pre_chat中已经包含了）
@@ -298,8 +323,8 @@ class PrepareChatHistory(PrepareChatHistoryInterface):
         # 根据是否首次出现决定是否添加角色prompt
         # 首次出现时，first_xxx为None，此时显示完整prompt
         # 非首次出现时，first_xxx不为None，此时不显示prompt（避免重复）
-        roleplay_character_prompt = roleplay_character.prompt if first_roleplay_character is None else ""
-        user_roleplay_prompt = user_roleplay_character.prompt if first_user_roleplay_character is None else ""
+        roleplay_character_prompt = str(roleplay_character.prompt) if first_roleplay_character is None else ""
+        user_roleplay_prompt = str(user_roleplay_character.prompt) if first_user_roleplay_character is None else ""
 
         # 创建langchain消息列表
         langchain_messages = []
@@ -328,6 +353,9 @@ class PrepareChatHistory(PrepareChatHistoryInterface):
                 content=f"你的回复开头必须包含你扮演角色的真实姓名的标签，且禁止使用代号，绰号，小名等。"
                         f"示例：[{roleplay_character.name}] \\n "))
 
+        _CONTEXT_SECONDS.observe(time.perf_counter() - start)
+        _PROMPT_MESSAGES.observe(len(langchain_messages))
+        _PROMPT_TOKENS.observe(sum(estimate_tokens(str(message.content)) for message in langchain_messages))
         return langchain_messages
 
     def get_all_chat_history_by_scene(self, scene_id: str, all_scenes: List[Scene4db],
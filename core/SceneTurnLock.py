@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，只能在进程内串行化
+    fcntl = None
+
+load_dotenv()
+
+# 跨进程的轮次锁文件数，情景id按哈希分配到锁文件，哈希相同的情景之间也会串行
+SCENE_LOCK_STRIPES = int(os.getenv("SCENE_LOCK_STRIPES", "1024"))
+
+# stats中保留历史最大队列深度的情景数，只保留最热的这些情景，情景数量增长时内存不随之增长
+SCENE_LOCK_TOP_SCENES = int(os.getenv("SCENE_LOCK_TOP_SCENES", "20"))
+
+# 锁文件被其他进程持有时重试的最短与最长间隔（秒）
+_RETRY_MIN = 0.005
+_RETRY_MAX = 0.1
+
+
+class SceneTurnLock:
+    """
+    按情景串行化对话轮次
+    同一情景内的轮次按到达顺序依次执行（asyncio.Lock的等待队列是FIFO的），
+    保证后一轮组装上下文时能读到前一轮写入的记录；不同情景之间互不影响，完全并行。
+    多进程部署时，拿到进程内的锁后再对情景的锁文件加flock，同一情景的轮次在所有工作进程间串行；
+    进程之间不保证先来先到。只能在事件循环线程中使用。
+    """
+
+    def __init__(self, directory: Optional[str] = None, top_scenes: int = SCENE_LOCK_TOP_SCENES):
+        self._directory = directory
+        self.top_scenes = top_scenes
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # 当前持有的锁文件
+        self._files: Dict[str, int] = {}
+        # 每个情景正在执行和排队中的轮次数
+        self._depths: Dict[str, int] = {}
+        # 历史最大队列深度最高的top_scenes个情景，以及所有情景中的最大值
+        self._max_depths: Dict[str, int] = {}
+        self._max_depth = 0
+        self._turns_total = 0
+        self._wait_seconds_total = 0.0
+
+    async def acquire(self, scene_id: str):
+        """
+        进入情景的轮次队列，轮到本轮时返回
+        :param scene_id: 情景id
+        """
+        lock = self._locks.get(scene_id)
+        if lock is None:
+            lock = self._locks[scene_id] = asyncio.Lock()
+        depth = self._depths.get(scene_id, 0) + 1
+        self._depths[scene_id] = depth
+        self._record_depth(scene_id, depth)
+
+        start = time.monotonic()
+        try:
+            await lock.acquire()
+        except BaseException:
+            # 排队时请求被取消
+            self._leave(scene_id)
+            raise
+        try:
+            await self._lock_file(scene_id)
+        except BaseException:
+            lock.release()
+            self._leave(scene_id)
+            raise
+        self._turns_total += 1
+        self._wait_seconds_total += time.monotonic() - start
+
+    def release(self, scene_id: str):
+        """
+        结束本轮，唤醒该情景队列中的下一轮
+        :param scene_id: 情景id
+        """
+        self._unlock_file(scene_id)
+        self._locks[scene_id].release()
+        self._leave(scene_id)
+
+    @property
+    def directory(self) -> str:
+        # 默认按数据库文件区分，连接同一个数据库的进程共用锁文件
+        if self._directory is None:
+            from entity.BaseModel import BaseDtoModel
+            database = BaseDtoModel._meta.database.database
+            digest = hashlib.sha1(os.path.abspath(database).encode("utf-8")).hexdigest()[:12]
+            self._directory = os.getenv("SCENE_LOCK_DIR") or os.path.join(tempfile.gettempdir(),
+                                                                          f"treenovel-turns-{digest}")
+        return self._directory
+
+    async def _lock_file(self, scene_id: str):
+        """
+        对情景的锁文件加排他锁，被其他进程持有时退避重试；不阻塞事件循环，也不占用线程池
+        """
+        if fcntl is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        stripe = int(hashlib.sha1(scene_id.encode("utf-8")).hexdigest(), 16) % SCENE_LOCK_STRIPES
+        fd = os.open(os.path.join(self.directory, f"{stripe}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        delay = _RETRY_MIN
+        try:
+            while True:
+                try:
+                    # flock按打开的文件加锁，同一进程中哈希相同的两个情景之间也互斥
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, _RETRY_MAX)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._files[scene_id] = fd
+
+    def _unlock_file(self, scene_id: str):
+        fd = self._files.pop(scene_id, None)
+        if fd is not None:
+            # 关闭文件即释放flock
+            os.close(fd)
+
+    def _record_depth(self, scene_id: str, depth: int):
+        self._max_depth = max(self._max_depth, depth)
+        if depth <= self._max_depths.get(scene_id, 0):
+            return
+        if scene_id not in self._max_depths and len(self._max_depths) >= self.top_scenes:
+            # 已满时替换深度最小的情景，比它还小则不记录
+            coldest = min(self._max_depths, key=self._max_depths.get)
+            if self._max_depths[coldest] >= depth:
+                return
+            del self._max_depths[coldest]
+        self._max_depths[scene_id] = depth
+
+    def _leave(self, scene_id: str):
+        depth = self._depths[scene_id] - 1
+        if depth:
+            self._depths[scene_id] = depth
+        else:
+            # 队列清空后移除锁，避免情景数量增长导致内存泄漏
+            del self._depths[scene_id]
+            del self._locks[scene_id]
+
+    @asynccontextmanager
+    async def turn(self, scene_id: str):
+        """
+        在情景中执行一轮对话
+        :param scene_id: 情景id
+        """
+        await self.acquire(scene_id)
+        try:
+            yield
+        finally:
+            self.release(scene_id)
+
+    def queue_depths(self) -> Dict[str, int]:
+        """
+        获取每个活跃情景的队列深度（正在执行的轮次 + 排队的轮次）
+        :return: {情景id: 队列深度}
+        """
+        return dict(self._depths)
+
+    def stats(self) -> Dict:
+        """
+        获取队列指标，用于观察热点情景
+        :return: 当前队列深度、历史最大深度最高的情景、所有情景的历史最大深度、累计轮次与累计等待时间
+        """
+        return {
+            "queue_depths": self.queue_depths(),
+            "max_queue_depths": dict(sorted(self._max_depths.items(), key=lambda item: item[1], reverse=True)),
+            "max_queue_depth": self._max_depth,
+            "turns_total": self._turns_total,
+            "wait_seconds_total": round(self._wait_seconds_total, 6),
+        }
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Union, Generator, List
+from typing import Union, Generator, List, Optional
 
 from entity.BaseModel import Conversation
 from langchain_core.messages import BaseMessage
@@ -12,7 +12,9 @@ class ChatCore(ABC):
                        scene_id: str,
                        roleplay_character_id: int,
                        user_character_id: int,
-                       is_current_scene: bool = False) -> List[BaseMessage]:
+                       is_current_scene: bool = False,
+                       pending_conversations: Optional[List[Conversation]] = None,
+                       history_watermark: Optional[int] = None) -> List[BaseMessage]:
         """
         准备聊天上下文，包括角色设定、历史对话等
 
@@ -21,6 +23,8 @@ class ChatCore(ABC):
             roleplay_character_id: LLM扮演的角色ID
             user_character_id: 用户扮演的角色ID
             is_current_scene: 是否限制在当前情景中a
+            pending_conversations: 尚未写入数据库的对话，追加在历史记录末尾
+            history_watermark: 只使用conversation_id不大于该值的历史记录
 
         Returns:
             List[BaseMessage]: 准备好的langchain消息列表
@@ -30,7 +34,9 @@ class ChatCore(ABC):
     def generate_reply(self,
                        roleplay_character_id: int,
                        conversation: Conversation,
-                       stream: bool = False) -> Union[str, Generator[str, None, None]]:
+                       stream: bool = False,
+                       persisted: bool = True,
+                       history_watermark: Optional[int] = None) -> Union[str, Generator[str, None, None]]:
         """
         与角色进行对话
 
@@ -38,8 +44,28 @@ class ChatCore(ABC):
             roleplay_character_id: llm扮演的角色ID
             conversation: 对话内容
             stream: 是否流式返回，默认为False
+            persisted: conversation是否已写入数据库，为False时作为待写入消息追加到上下文末尾
+            history_watermark: 只使用conversation_id不大于该值的历史记录
 
         Returns:
             Union[str, Generator[str, None, None]]: 返回完整响应或流式响应生成器
         """
         raise NotImplementedError
+
+    def warm_up(self):
+        """
+        提前创建客户端连接，应用启动后调用
+        """
+        pass
+
+    def connection_stats(self) -> dict:
+        """
+        :return: 与LLM服务商之间的连接指标
+        """
+        return {}
+
+    def close(self):
+        """
+        释放引擎持有的客户端连接，应用退出时调用
+        """
+        pass
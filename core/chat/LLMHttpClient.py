@@ -0,0 +1,170 @@
+import importlib.util
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from config.Logger import logger
+
+load_dotenv()
+
+# 连接池上限与保留的空闲连接数
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "20"))
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "10"))
+# 空闲连接保留的秒数，httpx默认只有5秒，对话间隔稍长就要重新握手
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "120"))
+# 空闲超过该秒数时发送一次保活请求，避免服务端或中间网络关闭连接，0表示不发送
+LLM_HTTP_KEEPALIVE_INTERVAL = float(os.getenv("LLM_HTTP_KEEPALIVE_INTERVAL", "30"))
+# HTTP/2：auto在安装了h2时开启
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "auto").lower()
+
+
+class LLMHttpClient:
+    """
+    LLM服务商共享的HTTP连接池
+    注入到ChatOpenAI中，所有对话复用同一组长连接（安装了h2时使用HTTP/2多路复用）；
+    启动时预热建立连接，空闲时定期发送保活请求，并通过httpcore的trace统计连接复用情况。
+    httpx在第一次使用时才导入。
+    """
+
+    def __init__(self, max_connections: int = LLM_HTTP_MAX_CONNECTIONS,
+                 max_keepalive: int = LLM_HTTP_MAX_KEEPALIVE,
+                 keepalive_expiry: float = LLM_HTTP_KEEPALIVE_EXPIRY,
+                 keepalive_interval: float = LLM_HTTP_KEEPALIVE_INTERVAL,
+                 http2: Optional[bool] = None):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.keepalive_interval = keepalive_interval
+        if http2 is None:
+            http2 = LLM_HTTP2 == "on" or (LLM_HTTP2 == "auto" and importlib.util.find_spec("h2") is not None)
+        self.http2 = http2
+        self._client = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "new_connection_requests": 0, "connections": 0, "tls_handshakes": 0,
+                       "keepalive_pings": 0, "connect_seconds": 0.0}
+        self._last_active = time.monotonic()
+        self._ping_url: Optional[str] = None
+        self._stopped = threading.Event()
+        self._ping_thread: Optional[threading.Thread] = None
+
+    @property
+    def client(self):
+        """
+        :return: 共享的httpx.Client，第一次访问时创建
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    def _create_client(self):
+        import httpx
+
+        return httpx.Client(
+            http2=self.http2,
+            limits=httpx.Limits(max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_keepalive,
+                                keepalive_expiry=self.keepalive_expiry),
+            timeout=httpx.Timeout(600, connect=10),
+            event_hooks={"request": [self._on_request]},
+        )
+
+    def _on_request(self, request):
+        # 保活请求自带trace，其余请求在这里挂上统计用的trace
+        request.extensions.setdefault("trace", self._tracer())
+        self._last_active = time.monotonic()
+
+    def _tracer(self, ping: bool = False):
+        """
+        创建单个请求的httpcore trace回调，新建TCP连接、TLS握手、发送请求头时调用
+        :param ping: 是否为保活请求，保活请求不计入请求数
+        """
+        state = {"connect_started": 0.0, "new_connection": False}
+
+        def trace(event: str, info: Dict):
+            if event == "connection.connect_tcp.started":
+                state["connect_started"] = time.perf_counter()
+            elif event == "connection.connect_tcp.complete":
+                state["new_connection"] = True
+                with self._stats_lock:
+                    self._stats["connections"] += 1
+                    self._stats["connect_seconds"] += time.perf_counter() - state["connect_started"]
+            elif event == "connection.start_tls.complete":
+                with self._stats_lock:
+                    self._stats["tls_handshakes"] += 1
+            elif event.endswith("send_request_headers.started"):
+                with self._stats_lock:
+                    if ping:
+                        self._stats["keepalive_pings"] += 1
+                    else:
+                        self._stats["requests"] += 1
+                        self._stats["new_connection_requests"] += state["new_connection"]
+
+        return trace
+
+    def _ping(self) -> bool:
+        try:
+            self.client.head(self._ping_url, extensions={"trace": self._tracer(ping=True)})
+            return True
+        except Exception as e:
+            logger.debug(f"LLM连接保活请求失败: {e}")
+            return False
+
+    def warm_up(self, base_url: str):
+        """
+        向服务商发送一次请求建立连接（TCP、TLS、HTTP/2协商），并启动保活线程
+        :param base_url: 服务商的API地址
+        """
+        self._ping_url = base_url
+        start = time.perf_counter()
+        if self._ping():
+            logger.info(f"LLM连接预热完成: {base_url}，耗时{time.perf_counter() - start:.3f}s，"
+                        f"HTTP/2={'开启' if self.http2 else '关闭'}")
+        else:
+            logger.warning(f"LLM连接预热失败: {base_url}，第一次对话时再建立连接")
+        if self.keepalive_interval > 0 and self._ping_thread is None:
+            self._stopped.clear()
+            self._ping_thread = threading.Thread(target=self._keep_alive, name="llm-keepalive", daemon=True)
+            self._ping_thread.start()
+
+    def _keep_alive(self):
+        while not self._stopped.wait(self.keepalive_interval / 2):
+            if time.monotonic() - self._last_active >= self.keepalive_interval:
+                self._last_active = time.monotonic()
+                self._ping()
+
+    def stats(self) -> Dict:
+        """
+        :return: 请求数、新建连接数、TLS握手数、保活请求数、建立连接的平均耗时和连接复用率
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        connect_seconds = stats.pop("connect_seconds")
+        stats["avg_connect_ms"] = round(connect_seconds * 1000 / stats["connections"], 2) if stats["connections"] else 0
+        # 复用率：对话请求中不需要新建连接的比例
+        requests = stats["requests"]
+        stats["reuse_rate"] = round(1 - stats["new_connection_requests"] / requests, 4) if requests else 0
+        stats["http2"] = self.http2
+        return stats
+
+    def close(self):
+        """
+        停止保活并关闭连接池，之后再使用会重新创建
+        """
+        self._stopped.set()
+        if self._ping_thread is not None:
+            self._ping_thread.join(1)
+            self._ping_thread = None
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+
+# 全局单例，LangchainEngine注入ChatOpenAI
+llm_http_client = LLMHttpClient()
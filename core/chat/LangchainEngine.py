@@ -1,49 +1,101 @@
 import os
+import threading
+import time
 
 from dotenv import load_dotenv
-from typing import Union, Generator, List
+from typing import Union, Generator, List, Optional, TYPE_CHECKING
 
 from config.Logger import logger
 from core.PrepareChatHistory import PrepareChatHistory, build_chat_history_with_role_switch
 from core.chat.ChatCore import ChatCore
 from core.chat.Exceptions import ServerSideError
+from core.chat.LLMHttpClient import LLMHttpClient, llm_http_client
 from entity.BaseModel import Conversation
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import BaseMessage
 
 from mapper.CharacterMapper import CharacterMapper
 from mapper.ConversationMapper import ConversationMapper
 from mapper.SceneMapper import SceneMapper
+from utils.Metrics import counter, histogram
 
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
 
-from langchain_community.chat_models import ChatZhipuAI
+# base_url="https://openrouter.ai/api/v1"
+# base_url="https://api.moonshot.cn/v1"
+# base_url="https://open.bigmodel.cn/api/paas/v4"
+LLM_BASE_URL = "https://api.deepseek.com"
+
+_LLM_FIRST_TOKEN_SECONDS = histogram("treenovel_llm_time_to_first_token_seconds",
+                                     "流式对话从发出请求到收到第一段内容的耗时（秒）")
+_LLM_SECONDS = histogram("treenovel_llm_request_seconds", "LLM请求的总耗时（秒），流式为读取到结束的时间",
+                         ("stream", "outcome"))
+_LLM_ERRORS = counter("treenovel_llm_errors_total", "LLM请求失败次数", ("stream",))
 
 
 class LangchainEngine(ChatCore):
 
-    def __init__(self, prepare_chat_history: PrepareChatHistory):
+    def __init__(self, prepare_chat_history: PrepareChatHistory, http_client: Optional[LLMHttpClient] = None):
         self.prepare_chat_history = prepare_chat_history
+        # 所有请求复用同一个连接池
+        self.http_client = http_client or llm_http_client
+        self._llm: Optional["ChatOpenAI"] = None
+        self._llm_lock = threading.Lock()
+
+    @property
+    def llm(self) -> "ChatOpenAI":
+        """
+        第一次对话时才导入langchain_openai并创建LLM客户端
+        langchain_openai连带导入openai SDK，占启动时导入耗时的大半，不聊天的工作进程不需要它
+        """
+        if self._llm is None:
+            with self._llm_lock:
+                if self._llm is None:
+                    self._llm = self._create_llm()
+        return self._llm
+
+    def warm_up(self):
+        """
+        创建LLM客户端（导入langchain_openai）并与服务商建立连接，在后台线程中调用，
+        第一次对话时不用再等待导入和TCP、TLS握手
+        """
+        _ = self.llm
+        self.http_client.warm_up(LLM_BASE_URL)
+
+    def connection_stats(self) -> dict:
+        return self.http_client.stats()
+
+    def close(self):
+        """
+        关闭LLM客户端的连接池
+        """
+        with self._llm_lock:
+            self._llm = None
+        self.http_client.close()
+
+    def _create_llm(self) -> "ChatOpenAI":
+        from langchain_openai import ChatOpenAI
 
         load_dotenv()
 
         # 初始化LLM
-        self.llm = ChatOpenAI(
+        return ChatOpenAI(
             # model="kimi-k2-0905-preview",
             # model="glm-4.6",
             model="deepseek-chat",
             api_key=os.getenv("DEEPSEEK_API_KEY"),
-            # base_url="https://openrouter.ai/api/v1",
-            # base_url="https://api.moonshot.cn/v1",
-            base_url="https://api.deepseek.com",
-            # base_url="https://open.bigmodel.cn/api/paas/v4",
+            base_url=LLM_BASE_URL,
             temperature=1,
+            http_client=self.http_client.client,
         )
 
     def prepare_context(self,
                        scene_id: str,
                        roleplay_character_id: int,
                        user_character_id: int,
-                       is_current_scene: bool = False) -> List[BaseMessage]:
+                       is_current_scene: bool = False,
+                       pending_conversations: Optional[List[Conversation]] = None,
+                       history_watermark: Optional[int] = None) -> List[BaseMessage]:
         """
         准备聊天上下文，包括角色设定、历史对话等
 
@@ -52,6 +104,8 @@ class LangchainEngine(ChatCore):
             roleplay_character_id: LLM扮演的角色ID
             user_character_id: 用户扮演的角色ID
             is_current_scene: 是否限制在当前情景中
+            pending_conversations: 尚未写入数据库的对话，追加在历史记录末尾
+            history_watermark: 只使用conversation_id不大于该值的历史记录
 
         Returns:
             List[BaseMessage]: 准备好的langchain消息列表
@@ -63,7 +117,9 @@ class LangchainEngine(ChatCore):
             user_character_id=user_character_id,
             build_chat_callback=build_chat_history_with_role_switch,
             character_mapper=self.prepare_chat_history.character_mapper,
-            is_current_scene=is_current_scene
+            is_current_scene=is_current_scene,
+            pending_conversations=pending_conversations,
+            history_watermark=history_watermark
         )
 
         return chat_history
@@ -71,7 +127,9 @@ class LangchainEngine(ChatCore):
     def generate_reply(self,
                        roleplay_character_id: int,
                        conversation: Conversation,
-                       stream: bool = False) -> Union[str, Generator[str, None, None]]:
+                       stream: bool = False,
+                       persisted: bool = True,
+                       history_watermark: Optional[int] = None) -> Union[str, Generator[str, None, None]]:
         """
         与角色进行对话
 
@@ -79,6 +137,8 @@ class LangchainEngine(ChatCore):
             roleplay_character_id: LLM扮演的角色ID
             conversation: 对话内容（包含当前用户消息）
             stream: 是否流式返回，默认为False
+            persisted: conversation是否已写入数据库，为False时作为待写入消息追加到上下文末尾
+            history_watermark: 只使用conversation_id不大于该值的历史记录
 
         Returns:
             Union[str, Generator[str, None, None]]: 返回完整响应或流式响应生成器
@@ -92,7 +152,9 @@ class LangchainEngine(ChatCore):
                 scene_id=conversation.sid,
                 roleplay_character_id=roleplay_character_id,
                 user_character_id=user_character_id,
-                is_current_scene=False
+                is_current_scene=False,
+                pending_conversations=None if persisted else [conversation],
+                history_watermark=history_watermark
             )
 
             logger.info(chat_history)
@@ -100,6 +162,9 @@ class LangchainEngine(ChatCore):
             if stream:
                 # 流式响应
                 def generate_response():
+                    start = time.perf_counter()
+                    first_token = True
+                    outcome = "cancelled"
                     try:
                         # 调用LLM进行流式对话
                         response = self.llm.stream(chat_history)
@@ -137,9 +202,15 @@ class LangchainEngine(ChatCore):
 
                             # 输出提取到的内容
                             if content:
+                                if first_token:
+                                    first_token = False
+                                    _LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start)
                                 yield content
 
+                        outcome = "ok"
                     except Exception as e:
+                        outcome = "error"
+                        _LLM_ERRORS.labels("true").inc()
                         error_msg = str(e)
                         logger.error(f"流式响应错误: {error_msg}")
                         # 抛出服务器端错误
@@ -147,14 +218,21 @@ class LangchainEngine(ChatCore):
                             message=f"流式响应错误: {error_msg}",
                             server_response=getattr(e, 'response', '') or error_msg
                         )
+                    finally:
+                        # 客户端断开时生成器被关闭，记为cancelled
+                        _LLM_SECONDS.labels("true", outcome).observe(time.perf_counter() - start)
 
                 return generate_response()
             else:
                 # 非流式响应
+                start = time.perf_counter()
                 try:
                     response = self.llm.invoke(chat_history)
+                    _LLM_SECONDS.labels("false", "ok").observe(time.perf_counter() - start)
                     return response.content
                 except Exception as e:
+                    _LLM_SECONDS.labels("false", "error").observe(time.perf_counter() - start)
+                    _LLM_ERRORS.labels("false").inc()
                     error_msg = str(e)
                     # 抛出服务器端错误，传入服务端返回的content
                     raise ServerSideError(
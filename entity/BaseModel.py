@@ -1,9 +1,29 @@
 from dataclasses import dataclass
 from typing import List, Optional
 
-from peewee import Model, CharField, ForeignKeyField, IntegerField, BooleanField
+from peewee import Model, CharField, ForeignKeyField, IntegerField, BooleanField, TextField, FloatField, BlobField
+from playhouse.sqlite_ext import AutoIncrementField
 
 from mapper.config.LoadDB import load_sqlite_config
+from utils.TextCompression import compress_text, decompress_text
+
+
+class CompressedTextField(TextField):
+    """
+    透明压缩的长文本字段
+    达到TEXT_COMPRESSION_THRESHOLD的文本压缩后以BLOB保存，读出时解压为str；
+    短文本仍以TEXT保存。SQL中需要读取原文时使用tn_text(字段)。
+    """
+
+    def db_value(self, value):
+        if isinstance(value, str):
+            return compress_text(value)
+        return value
+
+    def python_value(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return decompress_text(bytes(value))
+        return value
 
 
 class BaseDtoModel(Model):
@@ -14,7 +34,7 @@ class BaseDtoModel(Model):
 class Character2db(BaseDtoModel):
     name = CharField()
 
-    prompt = CharField()
+    prompt = CompressedTextField()
 
     # 是否可见
     is_visible = BooleanField(default=False)
@@ -29,7 +49,10 @@ class Character:
 
 
 class Conversation2db(BaseDtoModel):
-    message = CharField()
+    # AUTOINCREMENT：删除（归档）id最大的对话后id也不会被新对话复用，客户端、事件日志和全文索引中的id始终唯一
+    id = AutoIncrementField()
+
+    message = CompressedTextField()
     
     # 与scene表关联
     sid = CharField()
@@ -93,6 +116,80 @@ class   CharacterSceneRecord:
     character_scene_id: Optional[int] = None
 
 
+# 情景最近一次写入对话的时间，由conversation2db上的触发器维护，用于判断情景是否已不活跃
+class SceneActivity2db(BaseDtoModel):
+    sid = CharField(primary_key=True)
+
+    # unix时间戳（秒）
+    last_active = FloatField(index=True)
+
+
+# 已归档情景的对话在段文件中的位置
+class ConversationArchive2db(BaseDtoModel):
+    sid = CharField(primary_key=True)
+
+    # 段文件名
+    segment = CharField()
+
+    offset = IntegerField()
+
+    length = IntegerField()
+
+    # 归档的对话条数
+    count = IntegerField()
+
+    # 压缩数据的crc32
+    checksum = IntegerField()
+
+    archived_at = FloatField()
+
+
+# 对话事件日志，只追加；id即全局有序的事件序号
+class ConversationEvent2db(BaseDtoModel):
+    sid = CharField()
+
+    conversation_id = IntegerField()
+
+    # create update delete
+    op = CharField()
+
+    # 事件发生后的对话内容，delete事件为空
+    message = CompressedTextField(null=True)
+
+    role = CharField(null=True)
+
+    sender_id = IntegerField(null=True)
+
+    created_at = FloatField()
+
+
+@dataclass
+class ConversationEvent:
+    sid: str
+    conversation_id: int
+    op: str
+    message: Optional[str] = None
+    role: Optional[str] = None
+    sender_id: Optional[int] = None
+    created_at: Optional[float] = None
+    event_id: Optional[int] = None
+
+
+# 情景对话在某个事件之后的完整状态，重放时从最近的快照开始
+class ConversationSnapshot2db(BaseDtoModel):
+    sid = CharField()
+
+    # 快照包含的最后一个事件
+    event_id = IntegerField()
+
+    # 压缩后的对话列表
+    data = BlobField()
+
+    count = IntegerField()
+
+    created_at = FloatField()
+
+
 # 指令模板
 class Template2db(BaseDtoModel):
     # 模板名字
@@ -113,6 +210,10 @@ class TemplateRecord:
 
 
 if __name__ == '__main__':
+    # 建表和索引由结构变更统一管理，服务启动时也会自动执行
+    from mapper.config.Migrations import run_migrations, check_query_plans
+
     db = load_sqlite_config()
     db.connection()
-    db.create_tables([Character2db, Conversation2db, CharacterScene, Template2db])
+    run_migrations(db)
+    check_query_plans(db)
@@ -33,6 +33,20 @@ class Scene(Node):
         return f"Scene(sid={self.sid}, name={self.name}, is_main={self.is_main}, is_root={self.is_root})"
 
 
+class SceneProjection(Node):
+    """
+    只包含id、名称和标记的轻量场景，用于按需分页加载大型情景图
+    """
+    def __init__(self, sid: str, name: str, is_main: bool, is_root: bool):
+        super().__init__(sid)
+        self.name = name
+        self.is_main = is_main
+        self.is_root = is_root
+
+    def __repr__(self):
+        return f"SceneProjection(sid={self.sid}, name={self.name}, is_main={self.is_main}, is_root={self.is_root})"
+
+
 class Edge:
     def __init__(self, source: str, target: str):
         self.source = source
@@ -43,11 +57,11 @@ class Edge:
 
 
 class Graph:
-    def __init__(self, nodes: Optional[List[Scene]] = None, edges: Optional[List[Edge]] = None):
-        self.nodes: List[Scene] = nodes or []
+    def __init__(self, nodes: Optional[List[Node]] = None, edges: Optional[List[Edge]] = None):
+        self.nodes: List[Node] = nodes or []
         self.edges: List[Edge] = edges or []
 
-    def add_node(self, node: Scene):
+    def add_node(self, node: Node):
         self.nodes.append(node)
 
     def add_edge(self, source: str, target: str):
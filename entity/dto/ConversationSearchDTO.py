@@ -0,0 +1,18 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class ConversationSearchHit:
+    """
+    对话全文搜索的一条结果
+    """
+    conversation_id: int
+    sid: str
+    sender_id: int
+    sender_name: Optional[str]
+    role: str
+    # 命中位置附近的片段，命中的文字用<mark></mark>包裹
+    snippet: str
+    # bm25得分，越小越相关；短查询回退到LIKE时为None
+    score: Optional[float] = None
@@ -4,7 +4,7 @@
  */
 
 import http from '../utils/request'
-import { Conversation } from '@/beans'
+import { Conversation, ConversationSearchHit } from '@/beans'
 
 class ConversationApi {
   /**
@@ -23,6 +23,20 @@ class ConversationApi {
     return (response as any).map((item: any) => new Conversation(item))
   }
 
+  /**
+   * 全文搜索对话，可限定场景子树和发送者
+   */
+  async searchConversations(params: {
+    q: string
+    scene_id?: string
+    sender_id?: number
+    limit?: number
+    offset?: number
+  }): Promise<ConversationSearchHit[]> {
+    const response = await http.get('/api/conversations/search', { params })
+    return (response as any).map((item: any) => new ConversationSearchHit(item))
+  }
+
   /**
    * 创建新对话
    */
@@ -10,6 +10,7 @@ import {
   UpdateSceneRequest,
   ConnectCharacterRequest,
   SceneGraph,
+  SceneGraphChanges,
   Character,
   CharacterSceneDto,
 } from '@/beans'
@@ -63,6 +64,20 @@ class SceneApi {
     return response as CharacterSceneDto[]
   }
 
+  /**
+   * 批量获取多个场景的角色列表
+   */
+  async getScenesCharactersBatch(
+    sids: string[],
+    includeInvisible = true
+  ): Promise<Record<string, CharacterSceneDto[]>> {
+    const response = await http.post('/api/scenes/characters:batch', {
+      sids,
+      include_invisible: includeInvisible,
+    })
+    return response as Record<string, CharacterSceneDto[]>
+  }
+
   /**
    * 连接角色到场景
    */
@@ -82,6 +97,46 @@ class SceneApi {
     return new SceneGraph(response as any)
   }
 
+  /**
+   * 获取场景周围hops跳以内的子图（节点不含summary）
+   */
+  async getSceneNeighborhood(sceneId: string, hops = 1): Promise<SceneGraph> {
+    const response = await http.get(`/api/scenes/${sceneId}/neighborhood`, { params: { hops } })
+    return new SceneGraph(response as any)
+  }
+
+  /**
+   * 获取场景depth层以内的后续场景（节点不含summary）
+   */
+  async getSceneDescendants(sceneId: string, depth = 1): Promise<SceneGraph> {
+    const response = await http.get(`/api/scenes/${sceneId}/descendants`, { params: { depth } })
+    return new SceneGraph(response as any)
+  }
+
+  /**
+   * 获取场景的前情景子图，不传depth时一直找到根场景（节点不含summary）
+   */
+  async getSceneAncestors(sceneId: string, depth?: number): Promise<SceneGraph> {
+    const response = await http.get(`/api/scenes/${sceneId}/ancestors`, { params: { depth } })
+    return new SceneGraph(response as any)
+  }
+
+  /**
+   * 分页获取主线场景（节点不含summary）
+   */
+  async getMainLine(skip = 0, limit = 200): Promise<SceneGraph> {
+    const response = await http.get('/api/scenes/graph/main', { params: { skip, limit } })
+    return new SceneGraph(response as any)
+  }
+
+  /**
+   * 获取场景图自since版本以来的增量变更
+   */
+  async getScenesGraphChanges(since?: number, epoch?: string): Promise<SceneGraphChanges> {
+    const response = await http.get('/api/scenes/graph/changes', { params: { since, epoch } })
+    return new SceneGraphChanges(response as any)
+  }
+
   /**
    * 获取场景的父场景链
    */
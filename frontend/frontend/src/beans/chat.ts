@@ -17,6 +17,23 @@ export class Conversation {
   }
 }
 
+/**
+ * 对话全文搜索结果，snippet中命中的文字用<mark></mark>包裹
+ */
+export class ConversationSearchHit {
+  conversation_id!: number
+  sid!: string
+  sender_id!: number
+  sender_name?: string
+  role!: string
+  snippet!: string
+  score?: number
+
+  constructor(data: Partial<ConversationSearchHit>) {
+    Object.assign(this, data)
+  }
+}
+
 /**
  * 聊天请求
  */
@@ -98,6 +98,23 @@ export class SceneGraph {
   }
 }
 
+/**
+ * 场景图增量变更
+ * reset为true时只有graph字段，需要用它替换本地的整张图
+ */
+export class SceneGraphChanges {
+  version!: number
+  epoch!: string
+  reset!: boolean
+  graph?: SceneGraph
+  nodes?: { added: Scene[]; updated: Scene[]; removed: string[] }
+  edges?: { added: SceneEdge[]; removed: SceneEdge[] }
+
+  constructor(data: Partial<SceneGraphChanges>) {
+    Object.assign(this, data)
+  }
+}
+
 
 export class CharacterSceneDto {
   character_id!: number
@@ -1,9 +1,10 @@
 from abc import ABC
-from typing import List
+from typing import List, Set
 
 from peewee import DoesNotExist
 
 from entity.BaseModel import Character, Character2db
+from utils.ChangeCounter import change_counter, CHARACTER, CHARACTER_SCENE
 
 
 class CharacterMapperInterface(ABC):
@@ -23,6 +24,12 @@ class CharacterMapperInterface(ABC):
     def delete_character_by_id(self, character_id) -> bool:
         raise NotImplementedError
 
+    def create_characters(self, characters: List[Character]) -> bool:
+        raise NotImplementedError
+
+    def get_existing_character_ids(self, character_ids: List[int]) -> Set[int]:
+        raise NotImplementedError
+
 
 class CharacterMapper(CharacterMapperInterface):
     """
@@ -44,6 +51,7 @@ class CharacterMapper(CharacterMapperInterface):
                 name=character.name,
                 prompt=character.prompt
             )
+            change_counter.bump(CHARACTER)
             return True
         except Exception as e:
             print(f"创建角色失败: {e}")
@@ -117,6 +125,7 @@ class CharacterMapper(CharacterMapperInterface):
             character_db.is_visible = character.is_visible
             # 保存更改
             character_db.save()
+            change_counter.bump(CHARACTER)
             return True
         except DoesNotExist:
             print(f"更新失败：角色 ID {character_id} 不存在。")
@@ -139,12 +148,56 @@ class CharacterMapper(CharacterMapperInterface):
             char = Character2db.get_or_none(Character2db.id == character_id)
             if char:
                 char.delete_instance(recursive=True)  # recursive=True 也会删除反向依赖对象
+                # 级联删除了角色与场景的关联
+                change_counter.bump(CHARACTER, CHARACTER_SCENE)
                 return True
             return False
         except Exception as e:
             print(f"删除角色失败: {e}")
             return False
 
+    def create_characters(self, characters: List[Character]):
+        """
+        在同一个事务中创建多个角色，创建成功后回填character_id。
+
+        Args:
+            characters: Character 对象列表。
+
+        Returns:
+            如果全部创建成功则返回 True，否则全部回滚并返回 False。
+        """
+        try:
+            with Character2db._meta.database.atomic():
+                for character in characters:
+                    character_db = Character2db.create(
+                        name=character.name,
+                        prompt=character.prompt,
+                        is_visible=character.is_visible
+                    )
+                    character.character_id = character_db.id
+            change_counter.bump(CHARACTER)
+            return True
+        except Exception as e:
+            for character in characters:
+                character.character_id = None
+            print(f"批量创建角色失败: {e}")
+            return False
+
+    def get_existing_character_ids(self, character_ids: List[int]) -> Set[int]:
+        """
+        筛选出数据库中存在的角色 ID。
+
+        Args:
+            character_ids: 待检查的角色 ID 列表。
+
+        Returns:
+            其中存在的角色 ID 集合。
+        """
+        if not character_ids:
+            return set()
+        query = Character2db.select(Character2db.id).where(Character2db.id << character_ids)
+        return {character_id for character_id, in query.tuples()}
+
 
 if __name__ == '__main__':
     mapper = CharacterMapper()
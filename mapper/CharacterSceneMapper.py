@@ -1,6 +1,9 @@
-from entity.BaseModel import CharacterSceneRecord, CharacterScene
-from typing import List, Optional
+from entity.BaseModel import CharacterSceneRecord, CharacterScene, Character, Character2db
+from entity.dto.CharacterSceneDTO import CharacterSceneDto
+from typing import Dict, Iterator, List, Optional
+from peewee import JOIN
 from abc import ABC
+from utils.ChangeCounter import change_counter, CHARACTER_SCENE
 
 
 class CharacterSceneMapperInterface(ABC):
@@ -107,6 +110,46 @@ class CharacterSceneMapperInterface(ABC):
         """
         raise NotImplementedError
 
+    def iter_character_scenes_by_scene_id(self, scene_id: str) -> Iterator[CharacterSceneRecord]:
+        """
+        流式遍历场景下的全部角色关联记录（包括不可见的）
+
+        Args:
+            scene_id: 场景ID
+
+        Returns:
+            Iterator[CharacterSceneRecord]: 按sort_order排序的记录迭代器
+        """
+        raise NotImplementedError
+
+    def connect_characters_2_scenes(self, character_scenes: List[CharacterSceneRecord], batch_size: int = 500) -> bool:
+        """
+        批量连接角色与情景
+
+        Args:
+            character_scenes: 关联记录列表
+            batch_size: 每条INSERT语句写入的记录数
+
+        Returns:
+            bool: 是否全部写入成功
+        """
+        raise NotImplementedError
+
+    def get_character_scenes_with_characters(self, scene_ids: List[str],
+                                             include_invisible: bool = False) -> Dict[str, List[CharacterSceneDto]]:
+        """
+        批量获取多个场景的角色关联记录及角色信息，关联表与角色表一次JOIN查出
+
+        Args:
+            scene_ids: 场景ID列表
+            include_invisible: 是否包含场景中不可见的角色
+
+        Returns:
+            Dict[str, List[CharacterSceneDto]]: 场景ID -> 按关联记录创建顺序排列的列表，没有角色的场景不出现；
+            角色已被删除的关联记录character为None
+        """
+        raise NotImplementedError
+
 
 class CharacterSceneMapper(CharacterSceneMapperInterface):
 
@@ -149,6 +192,7 @@ class CharacterSceneMapper(CharacterSceneMapperInterface):
                 sort_order=character_scene.sort_order,
                 is_visible=character_scene.is_visible,
             )
+            change_counter.bump(CHARACTER_SCENE)
             return True
         except Exception as e:
             print(f"连接角色与情景失败: {e}")
@@ -253,6 +297,7 @@ class CharacterSceneMapper(CharacterSceneMapperInterface):
                            .where(CharacterScene.character_id == character_id)
                            .where(CharacterScene.sid == scene_id)
                            .execute())
+            change_counter.bump(CHARACTER_SCENE)
             return deleted_count > 0
         except Exception as e:
             print(f"删除角色与场景关联失败: {e}")
@@ -272,11 +317,85 @@ class CharacterSceneMapper(CharacterSceneMapperInterface):
             deleted_count = (CharacterScene.delete()
                            .where(CharacterScene.sid == scene_id)
                            .execute())
+            change_counter.bump(CHARACTER_SCENE)
             return deleted_count >= 0  # 返回 True 即使没有记录被删除
         except Exception as e:
             print(f"删除场景下所有角色关联失败: {e}")
             return False
 
+    def iter_character_scenes_by_scene_id(self, scene_id: str) -> Iterator[CharacterSceneRecord]:
+        query = (CharacterScene.select()
+                 .where(CharacterScene.sid == scene_id)
+                 .order_by(CharacterScene.sort_order, CharacterScene.id))
+        for record in query.iterator():
+            yield CharacterSceneRecord(
+                character_scene_id=record.id,
+                character_id=record.character_id,
+                sid=record.sid,
+                sort_order=record.sort_order,
+                is_visible=record.is_visible,
+                # 直接读取外键列，避免逐条查询父记录
+                parent_id=record.parent_id_id
+            )
+
+    def connect_characters_2_scenes(self, character_scenes: List[CharacterSceneRecord], batch_size: int = 500) -> bool:
+        if not character_scenes:
+            return True
+        try:
+            rows = [
+                {
+                    "character_id": character_scene.character_id,
+                    "sid": character_scene.sid,
+                    "sort_order": character_scene.sort_order,
+                    "is_visible": character_scene.is_visible,
+                }
+                for character_scene in character_scenes
+            ]
+            with CharacterScene._meta.database.atomic():
+                for start in range(0, len(rows), batch_size):
+                    CharacterScene.insert_many(rows[start:start + batch_size]).execute()
+            change_counter.bump(CHARACTER_SCENE)
+            return True
+        except Exception as e:
+            print(f"批量连接角色与情景失败: {e}")
+            return False
+
+    def get_character_scenes_with_characters(self, scene_ids: List[str],
+                                             include_invisible: bool = False,
+                                             chunk_size: int = 500) -> Dict[str, List[CharacterSceneDto]]:
+        result: Dict[str, List[CharacterSceneDto]] = {}
+        scene_ids = list(dict.fromkeys(scene_ids))
+        # 分批拼接IN条件，避免超出SQLite的参数个数上限
+        for start in range(0, len(scene_ids), chunk_size):
+            query = (CharacterScene
+                     .select(CharacterScene.id, CharacterScene.character_id, CharacterScene.sid,
+                             CharacterScene.sort_order, CharacterScene.is_visible, CharacterScene.parent_id,
+                             Character2db.id, Character2db.name, Character2db.prompt, Character2db.is_visible)
+                     # 外连接：角色已被删除时保留关联记录，与逐条查询角色时一致
+                     .join(Character2db, JOIN.LEFT_OUTER, on=(CharacterScene.character_id == Character2db.id))
+                     .where(CharacterScene.sid << scene_ids[start:start + chunk_size])
+                     .order_by(CharacterScene.id))
+            if not include_invisible:
+                query = query.where(CharacterScene.is_visible == True)
+
+            for (character_scene_id, character_id, sid, sort_order, is_visible, parent_id,
+                 found_id, name, prompt, character_visible) in query.tuples():
+                result.setdefault(sid, []).append(CharacterSceneDto(
+                    character_id=character_id,
+                    sid=sid,
+                    sort_order=sort_order,
+                    is_visible=is_visible,
+                    parent_id=parent_id,
+                    character_scene_id=character_scene_id,
+                    character=Character(
+                        character_id=character_id,
+                        name=name,
+                        prompt=prompt,
+                        is_visible=character_visible
+                    ) if found_id is not None else None
+                ))
+        return result
+
 
 if __name__ == '__main__':
     # 测试get_character_scene_by_scene_id方法
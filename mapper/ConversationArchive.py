@@ -0,0 +1,247 @@
+import mmap
+import os
+import threading
+import time
+import zlib
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import orjson
+from dotenv import load_dotenv
+from peewee import fn
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，只能单进程归档
+    fcntl = None
+
+from config.Logger import logger
+from entity.BaseModel import Conversation2db, ConversationArchive2db, SceneActivity2db
+from mapper.config.SearchIndex import index_conversations
+from utils.ChangeCounter import change_counter, CONVERSATION
+from utils.TextCompression import compress_bytes, decompress_bytes
+
+load_dotenv()
+
+# 单个段文件达到该大小后新建下一个段文件
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", str(64 * 1024 * 1024)))
+
+_SEGMENT_PREFIX = "segment-"
+_SEGMENT_SUFFIX = ".tnseg"
+
+
+class ConversationArchive:
+    """
+    不活跃情景的对话冷存储
+    每个情景的全部对话序列化、压缩后追加写入段文件（只追加，不原地修改），
+    位置记录在ConversationArchive2db中，对应的行从conversation2db中删除。
+    读取时通过mmap只映射需要的段文件，情景被再次访问时对话以原id写回conversation2db。
+    重新激活后段文件中的旧数据不再被引用，不会自动回收。
+    """
+
+    def __init__(self, directory: Optional[str] = None, segment_size: int = ARCHIVE_SEGMENT_SIZE):
+        self._directory = directory
+        self.segment_size = segment_size
+        self._maps: Dict[str, mmap.mmap] = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # 已归档情景id的缓存及其对应的CONVERSATION版本，归档和恢复都会递增该版本
+        self._archived: FrozenSet[str] = frozenset()
+        self._archived_version: Optional[int] = None
+
+    @property
+    def directory(self) -> str:
+        # 默认放在SQLite数据库文件旁边
+        if self._directory is None:
+            self._directory = os.getenv("ARCHIVE_DIR") or os.path.join(
+                os.path.dirname(os.path.abspath(Conversation2db._meta.database.database)), "archive")
+        return self._directory
+
+    def _segment_path(self, segment: str) -> str:
+        return os.path.join(self.directory, segment)
+
+    def _current_segment(self) -> Tuple[str, int]:
+        """
+        :return: (可追加写入的段文件名, 当前大小)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        segments = sorted(name for name in os.listdir(self.directory)
+                          if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX))
+        if segments:
+            size = os.path.getsize(self._segment_path(segments[-1]))
+            if size < self.segment_size:
+                return segments[-1], size
+            number = int(segments[-1][len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)]) + 1
+        else:
+            number = 1
+        return f"{_SEGMENT_PREFIX}{number:06d}{_SEGMENT_SUFFIX}", 0
+
+    def _append(self, data: bytes) -> Tuple[str, int]:
+        """
+        追加写入一条记录并落盘
+        :return: (段文件名, 偏移)
+        """
+        with self._write_lock:
+            segment, _ = self._current_segment()
+            with open(self._segment_path(segment), "ab") as file:
+                # 多个工作进程可能同时归档，加锁后再取文件末尾作为偏移，关闭文件时释放
+                if fcntl is not None:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+                offset = file.seek(0, os.SEEK_END)
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+        return segment, offset
+
+    def _read(self, segment: str, offset: int, length: int) -> bytes:
+        """
+        通过mmap读取段文件中的一段数据，映射按段文件缓存；段文件追加后映射长度不够时重新映射
+        """
+        with self._lock:
+            mapped = self._maps.get(segment)
+            if mapped is None or offset + length > len(mapped):
+                if mapped is not None:
+                    mapped.close()
+                with open(self._segment_path(segment), "rb") as file:
+                    mapped = self._maps[segment] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            return mapped[offset:offset + length]
+
+    def inactive_scene_ids(self, before: float, limit: int = 100) -> List[str]:
+        """
+        获取在指定时间之后没有写入过对话、且尚未归档的情景
+        :param before: unix时间戳
+        :param limit: 最多返回的数量
+        :return: 情景id列表，最久未活跃的在前
+        """
+        query = (SceneActivity2db
+                 .select(SceneActivity2db.sid)
+                 .where(SceneActivity2db.last_active < before)
+                 .where(SceneActivity2db.sid.not_in(ConversationArchive2db.select(ConversationArchive2db.sid)))
+                 .order_by(SceneActivity2db.last_active)
+                 .limit(limit))
+        return [sid for sid, in query.tuples()]
+
+    def archive_scene(self, sid: str) -> int:
+        """
+        归档情景的全部对话
+        先写段文件再在一个事务中写索引、删除对话；事务失败时段文件中只留下一条不被引用的记录。
+        :param sid: 情景id
+        :return: 归档的对话条数，情景没有对话或已归档时为0
+        """
+        database = Conversation2db._meta.database
+        rows = list(Conversation2db
+                    .select(Conversation2db.id, Conversation2db.message, Conversation2db.role,
+                            Conversation2db.sender)
+                    .where(Conversation2db.sid == sid)
+                    .order_by(Conversation2db.id)
+                    .tuples())
+        if not rows or ConversationArchive2db.get_or_none(ConversationArchive2db.sid == sid) is not None:
+            return 0
+
+        data = compress_bytes(orjson.dumps(
+            [[conversation_id, str(message), role, sender_id] for conversation_id, message, role, sender_id in rows]
+        ))
+        segment, offset = self._append(data)
+        with database.atomic():
+            ConversationArchive2db.create(sid=sid, segment=segment, offset=offset, length=len(data),
+                                          count=len(rows), checksum=zlib.crc32(data), archived_at=time.time())
+            deleted = (Conversation2db.delete()
+                       .where(Conversation2db.sid == sid)
+                       .where(Conversation2db.id <= rows[-1][0])
+                       .execute())
+            if deleted != len(rows):
+                # 读取之后又有新的对话写入或被删除，放弃本次归档
+                raise RuntimeError(f"情景 {sid} 的对话在归档过程中发生变化")
+            # 对话表的内容变了，缓存的响应和ETag需要失效
+            change_counter.bump(CONVERSATION)
+        return len(rows)
+
+    def archived_sids(self) -> FrozenSet[str]:
+        """
+        获取已归档的情景id，CONVERSATION版本不变时直接使用缓存，避免每次读写对话都查询索引表
+        """
+        version, = change_counter.versions(CONVERSATION)
+        if version != self._archived_version:
+            # 先取版本再查询，查询期间发生的归档会在下一次调用时重新加载
+            query = ConversationArchive2db.select(ConversationArchive2db.sid)
+            self._archived = frozenset(sid for sid, in query.tuples())
+            self._archived_version = version
+        return self._archived
+
+    def is_archived(self, sid: str) -> bool:
+        return sid in self.archived_sids()
+
+    def rehydrate(self, sid: str) -> int:
+        """
+        把已归档情景的对话写回conversation2db，未归档时直接返回
+        :param sid: 情景id
+        :return: 写回的对话条数
+        """
+        if not self.is_archived(sid):
+            return 0
+        entry = ConversationArchive2db.get_or_none(ConversationArchive2db.sid == sid)
+        if entry is None:
+            return 0
+
+        data = self._read(entry.segment, entry.offset, entry.length)
+        if zlib.crc32(data) != entry.checksum:
+            raise ValueError(f"情景 {sid} 的归档数据校验失败: {entry.segment}@{entry.offset}")
+        rows = [
+            {"id": conversation_id, "message": message, "sid": sid, "role": role, "sender": sender_id}
+            for conversation_id, message, role, sender_id in orjson.loads(decompress_bytes(data))
+        ]
+
+        with Conversation2db._meta.database.atomic():
+            # 并发读取同一情景时只有删除到索引记录的一方写回
+            if not ConversationArchive2db.delete().where(ConversationArchive2db.sid == sid).execute():
+                return 0
+            # 对话id是AUTOINCREMENT的，归档的id不会被复用；只有迁移到AUTOINCREMENT之前归档、
+            # 且当时是id最大的几条时，id才可能已被新对话占用，这些对话写回时分配新id
+            taken = set()
+            for start in range(0, len(rows), 500):
+                ids = [row["id"] for row in rows[start:start + 500]]
+                taken.update(conversation_id for conversation_id, in
+                             Conversation2db.select(Conversation2db.id).where(Conversation2db.id << ids).tuples())
+            if taken:
+                logger.warning(f"情景 {sid} 的{len(taken)}条归档对话id已被占用，恢复时分配新id")
+            kept = [row for row in rows if row["id"] not in taken]
+            moved = [{key: value for key, value in row.items() if key != "id"} for row in rows if row["id"] in taken]
+            indexed = [(row["id"], row["message"], sid, row["sender"]) for row in kept]
+            for batch in (kept, moved):
+                for start in range(0, len(batch), 500):
+                    chunk = batch[start:start + 500]
+                    last_id = Conversation2db.insert_many(chunk).execute()
+                    if batch is moved:
+                        # 同一条INSERT语句写入的行id连续
+                        indexed.extend((conversation_id, row["message"], sid, row["sender"])
+                                       for conversation_id, row in enumerate(chunk, last_id - len(chunk) + 1))
+            index_conversations(Conversation2db._meta.database, indexed)
+            change_counter.bump(CONVERSATION)
+        logger.info(f"情景 {sid} 的{len(rows)}条对话已从归档恢复")
+        return len(rows)
+
+    def close(self):
+        """
+        释放缓存的段文件映射
+        """
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+
+    def stats(self) -> Dict:
+        """
+        :return: 归档的情景数、对话数和段文件总大小
+        """
+        directory = self.directory
+        segments = [name for name in os.listdir(directory)
+                    if name.endswith(_SEGMENT_SUFFIX)] if os.path.isdir(directory) else []
+        return {
+            "scenes": ConversationArchive2db.select().count(),
+            "conversations": ConversationArchive2db.select(fn.SUM(ConversationArchive2db.count)).scalar() or 0,
+            "segments": len(segments),
+            "segment_bytes": sum(os.path.getsize(self._segment_path(name)) for name in segments),
+        }
+
+
+# 全局单例，ConversationMapper读取时恢复，ArchiveService归档
+conversation_archive = ConversationArchive()
@@ -0,0 +1,185 @@
+import os
+import time
+from abc import ABC
+from typing import Dict, Iterable, List, Optional
+
+import orjson
+from dotenv import load_dotenv
+from peewee import fn
+
+from config.Logger import logger
+from entity.BaseModel import Conversation, ConversationEvent, ConversationEvent2db, ConversationSnapshot2db
+from utils.TextCompression import compress_bytes, decompress_bytes
+
+load_dotenv()
+
+# 事件类型
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+
+# 情景自上次快照以来累计多少个事件后生成新快照
+SNAPSHOT_INTERVAL = int(os.getenv("CONVERSATION_SNAPSHOT_INTERVAL", "200"))
+
+
+class ConversationEventMapperInterface(ABC):
+
+    def append_events(self, events: List[ConversationEvent], batch_size: int = 500) -> List[ConversationEvent]:
+        raise NotImplementedError
+
+    def get_events_since(self, after_event_id: int, limit: int = 500,
+                         sid: Optional[str] = None) -> List[ConversationEvent]:
+        raise NotImplementedError
+
+    def get_latest_event_id(self) -> int:
+        raise NotImplementedError
+
+    def get_scene_state(self, sid: str, at_event_id: Optional[int] = None) -> List[Conversation]:
+        raise NotImplementedError
+
+    def snapshot_if_needed(self, sids: Iterable[str]) -> int:
+        raise NotImplementedError
+
+
+class ConversationEventMapper(ConversationEventMapperInterface):
+    """
+    对话事件日志与快照
+    对话的每次创建、修改、删除都追加一条事件（与对话表的写入在同一个事务中），
+    情景在任意事件时刻的对话状态 = 该时刻之前最近的快照 + 之后的事件重放。
+    """
+
+    def __init__(self, snapshot_interval: int = SNAPSHOT_INTERVAL):
+        self.snapshot_interval = snapshot_interval
+
+    @staticmethod
+    def _reverse(event_db: ConversationEvent2db) -> ConversationEvent:
+        return ConversationEvent(
+            sid=event_db.sid,
+            conversation_id=event_db.conversation_id,
+            op=event_db.op,
+            message=event_db.message,
+            role=event_db.role,
+            sender_id=event_db.sender_id,
+            created_at=event_db.created_at,
+            event_id=event_db.id
+        )
+
+    def append_events(self, events: List[ConversationEvent], batch_size: int = 500) -> List[ConversationEvent]:
+        """
+        追加事件，调用方负责把它和对话表的写入放在同一个事务中
+        :param events: 事件列表，写入后回填event_id和created_at
+        :param batch_size: 每条INSERT语句写入的事件数
+        :return: 写入的事件
+        """
+        now = time.time()
+        for start in range(0, len(events), batch_size):
+            batch = events[start:start + batch_size]
+            last_id = ConversationEvent2db.insert_many([
+                {"sid": event.sid, "conversation_id": event.conversation_id, "op": event.op,
+                 "message": event.message, "role": event.role, "sender_id": event.sender_id, "created_at": now}
+                for event in batch
+            ]).execute()
+            # 同一条INSERT语句写入的行id连续
+            for offset, event in enumerate(batch, last_id - len(batch) + 1):
+                event.event_id = offset
+                event.created_at = now
+        return events
+
+    def get_events_since(self, after_event_id: int, limit: int = 500,
+                         sid: Optional[str] = None) -> List[ConversationEvent]:
+        """
+        按顺序读取某个事件之后的事件
+        :param after_event_id: 上次读到的事件id，从头读取时为0
+        :param limit: 最多返回的数量
+        :param sid: 只读取该情景的事件
+        :return: 事件列表
+        """
+        query = ConversationEvent2db.select().where(ConversationEvent2db.id > after_event_id)
+        if sid is not None:
+            query = query.where(ConversationEvent2db.sid == sid)
+        return [self._reverse(event_db) for event_db in query.order_by(ConversationEvent2db.id).limit(limit)]
+
+    def get_latest_event_id(self) -> int:
+        """
+        :return: 最新的事件id，没有事件时为0
+        """
+        return ConversationEvent2db.select(fn.MAX(ConversationEvent2db.id)).scalar() or 0
+
+    @staticmethod
+    def _latest_snapshot(sid: str, at_event_id: Optional[int]) -> Optional[ConversationSnapshot2db]:
+        query = ConversationSnapshot2db.select().where(ConversationSnapshot2db.sid == sid)
+        if at_event_id is not None:
+            query = query.where(ConversationSnapshot2db.event_id <= at_event_id)
+        return query.order_by(ConversationSnapshot2db.event_id.desc()).first()
+
+    def _replay(self, sid: str, at_event_id: Optional[int]):
+        """
+        :return: (对话id -> [内容, 角色, 发送者], 重放到的最后一个事件id)
+        """
+        state: Dict[int, list] = {}
+        last_event_id = 0
+        snapshot = self._latest_snapshot(sid, at_event_id)
+        if snapshot is not None:
+            for conversation_id, message, role, sender_id in orjson.loads(decompress_bytes(bytes(snapshot.data))):
+                state[conversation_id] = [message, role, sender_id]
+            last_event_id = snapshot.event_id
+
+        query = (ConversationEvent2db
+                 .select(ConversationEvent2db.id, ConversationEvent2db.conversation_id, ConversationEvent2db.op,
+                         ConversationEvent2db.message, ConversationEvent2db.role, ConversationEvent2db.sender_id)
+                 .where(ConversationEvent2db.sid == sid)
+                 .where(ConversationEvent2db.id > last_event_id))
+        if at_event_id is not None:
+            query = query.where(ConversationEvent2db.id <= at_event_id)
+        for event_id, conversation_id, op, message, role, sender_id in \
+                query.order_by(ConversationEvent2db.id).tuples().iterator():
+            if op == DELETE:
+                state.pop(conversation_id, None)
+            else:
+                state[conversation_id] = [message, role, sender_id]
+            last_event_id = event_id
+        return state, last_event_id
+
+    def get_scene_state(self, sid: str, at_event_id: Optional[int] = None) -> List[Conversation]:
+        """
+        重建情景在某个事件之后的对话列表
+        :param sid: 情景id
+        :param at_event_id: 事件id，为空时重建到最新
+        :return: 按对话id排序的对话列表
+        """
+        state, _ = self._replay(sid, at_event_id)
+        return [
+            Conversation(message=message, sid=sid, sender_id=sender_id, role=role, conversation_id=conversation_id)
+            for conversation_id, (message, role, sender_id) in sorted(state.items())
+        ]
+
+    def _take_snapshot(self, sid: str):
+        state, last_event_id = self._replay(sid, None)
+        data = compress_bytes(orjson.dumps(
+            [[conversation_id, str(message), role, sender_id]
+             for conversation_id, (message, role, sender_id) in sorted(state.items())]
+        ))
+        ConversationSnapshot2db.create(sid=sid, event_id=last_event_id, data=data, count=len(state),
+                                       created_at=time.time())
+
+    def snapshot_if_needed(self, sids: Iterable[str]) -> int:
+        """
+        为自上次快照以来事件数达到snapshot_interval的情景生成快照，失败不影响调用方
+        :param sids: 刚写入过事件的情景
+        :return: 生成的快照数
+        """
+        created = 0
+        for sid in set(sids):
+            try:
+                snapshot = self._latest_snapshot(sid, None)
+                since = snapshot.event_id if snapshot is not None else 0
+                pending = (ConversationEvent2db.select()
+                           .where(ConversationEvent2db.sid == sid)
+                           .where(ConversationEvent2db.id > since)
+                           .count())
+                if pending >= self.snapshot_interval:
+                    self._take_snapshot(sid)
+                    created += 1
+            except Exception as e:
+                logger.error(f"生成情景 {sid} 的对话快照失败: {e}")
+        return created
@@ -1,10 +1,19 @@
 import logging
 from abc import ABC
-from typing import List, Optional
+import json
+import re
+from typing import Iterator, List, Optional
+
+from peewee import fn
 
 from config.Logger import logger
-from entity.BaseModel import Conversation, Conversation2db, Character2db
+from entity.BaseModel import Conversation, Conversation2db, Character2db, ConversationEvent
+from entity.dto.ConversationSearchDTO import ConversationSearchHit
+from mapper.ConversationArchive import conversation_archive
+from mapper.ConversationEventMapper import ConversationEventMapper, CREATE, UPDATE, DELETE
+from utils.ChangeCounter import change_counter, CONVERSATION
 from mapper.config.LoadDB import load_sqlite_config
+from mapper.config.SearchIndex import index_conversations
 
 
 class ConversationMapperInterface(ABC):
@@ -24,11 +33,70 @@ class ConversationMapperInterface(ABC):
     def delete_conversation_by_id(self, conversation_id: int) -> bool:
         raise NotImplementedError
 
+    def create_conversations(self, convs: List[Conversation]) -> bool:
+        raise NotImplementedError
+
+    def get_latest_conversation_id(self) -> int:
+        raise NotImplementedError
+
+    def iter_conversations_by_scene_id(self, sid: str) -> Iterator[Conversation]:
+        raise NotImplementedError
+
+    def insert_conversations(self, convs: List[Conversation], batch_size: int = 500) -> int:
+        raise NotImplementedError
+
+    def search_conversations(self, query: str, sids: Optional[List[str]] = None, sender_id: Optional[int] = None,
+                             limit: int = 20, offset: int = 0) -> List[ConversationSearchHit]:
+        raise NotImplementedError
+
+
+# trigram分词要求每个词至少3个字符，更短的词只能用LIKE匹配
+_TRIGRAM_MIN_LENGTH = 3
+_SNIPPET_OPEN = "<mark>"
+_SNIPPET_CLOSE = "</mark>"
+_SNIPPET_ELLIPSIS = "…"
+# 片段包含的大致字符数
+_SNIPPET_CHARS = 32
+
+
+def _escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _like_snippet(message: str, terms: List[str]) -> str:
+    """
+    LIKE回退时在Python中截取片段，格式与FTS5的snippet()一致
+    """
+    lowered = message.lower()
+    position = min((lowered.find(term.lower()) for term in terms if term.lower() in lowered), default=0)
+    start = max(position - _SNIPPET_CHARS // 2, 0)
+    end = min(start + _SNIPPET_CHARS, len(message))
+    fragment = message[start:end]
+    pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE)
+    fragment = pattern.sub(lambda m: f"{_SNIPPET_OPEN}{m.group(0)}{_SNIPPET_CLOSE}", fragment)
+    return (_SNIPPET_ELLIPSIS if start > 0 else "") + fragment + (_SNIPPET_ELLIPSIS if end < len(message) else "")
+
+
+def _event(op: str, conversation_id: int, sid: str, message=None, role=None, sender_id=None) -> ConversationEvent:
+    return ConversationEvent(sid=sid, conversation_id=conversation_id, op=op, message=message, role=role,
+                             sender_id=sender_id)
+
 
 class ConversationMapper(ConversationMapperInterface):
-    def __init__(self):
+    def __init__(self, event_mapper: Optional[ConversationEventMapper] = None):
         self.db = load_sqlite_config()
+        # 对话的每次写入都在同一个事务中追加事件
+        self._event_mapper = event_mapper or ConversationEventMapper()
     
+    def _record_writes(self, events: List[ConversationEvent], batch_size: int = 500):
+        """
+        在写入对话的事务中追加事件，并为新建和修改的对话写入全文索引行
+        """
+        self._event_mapper.append_events(events, batch_size)
+        index_conversations(Conversation2db._meta.database,
+                            ((event.conversation_id, event.message, event.sid, event.sender_id)
+                             for event in events if event.op != DELETE))
+
     def create_conversation(self, conv: Conversation) -> bool:
         """
         创建新的对话记录
@@ -38,16 +106,24 @@ class ConversationMapper(ConversationMapperInterface):
         try:
             # 获取发送者角色
             sender = Character2db.get_by_id(conv.sender_id)
+            # 情景已归档时先恢复，保证情景的对话完整
+            conversation_archive.rehydrate(conv.sid)
             
             # 创建数据库记录
-            conversation_db = Conversation2db.create(
-                message=conv.message,
-                sid=conv.sid,
-                role=conv.role,
-                sender=sender
-            )
+            with Conversation2db._meta.database.atomic():
+                conversation_db = Conversation2db.create(
+                    message=conv.message,
+                    sid=conv.sid,
+                    role=conv.role,
+                    sender=sender
+                )
+                self._record_writes([
+                    _event(CREATE, conversation_db.id, conv.sid, conv.message, conv.role, conv.sender_id)
+                ])
+                change_counter.bump(CONVERSATION)
             # 更新conv对象的id
             conv.id = conversation_db.id
+            self._event_mapper.snapshot_if_needed([conv.sid])
             return True
         except Exception as e:
             print(f"创建对话记录失败: {e}")
@@ -87,14 +163,16 @@ class ConversationMapper(ConversationMapperInterface):
         """
         try:
             conversations = []
-            # 查询数据库
-            query = Conversation2db.select().where(Conversation2db.sid == sid)
+            # 情景已归档时透明恢复
+            conversation_archive.rehydrate(sid)
+            # 查询数据库，按id排序保证对话顺序，可走(sid, id)索引不需要额外排序
+            query = Conversation2db.select().where(Conversation2db.sid == sid).order_by(Conversation2db.id)
             
             for conv_db in query:
                 conv = Conversation(
                     message=conv_db.message,
                     sid=conv_db.sid,
-                    sender_id=conv_db.sender.id,
+                    sender_id=conv_db.sender_id,
                     role=conv_db.role,
                     conversation_id=conv_db.id
                 )
@@ -120,11 +198,24 @@ class ConversationMapper(ConversationMapperInterface):
             sender = Character2db.get_by_id(conversation.sender_id)
             
             # 更新字段
+            old_sid = conv_db.sid
             conv_db.message = conversation.message
             conv_db.sid = conversation.sid
             conv_db.role = conversation.role
             conv_db.sender = sender
-            conv_db.save()
+            if old_sid == conversation.sid:
+                events = [_event(UPDATE, conversation_id, conversation.sid, conversation.message,
+                                 conversation.role, conversation.sender_id)]
+            else:
+                # 对话移动到其他情景：原情景中删除，新情景中创建
+                events = [_event(DELETE, conversation_id, old_sid),
+                          _event(CREATE, conversation_id, conversation.sid, conversation.message,
+                                 conversation.role, conversation.sender_id)]
+            with Conversation2db._meta.database.atomic():
+                conv_db.save()
+                self._record_writes(events)
+                change_counter.bump(CONVERSATION)
+            self._event_mapper.snapshot_if_needed([event.sid for event in events])
             
             # 返回更新后的对话记录
             updated_conv = Conversation(
@@ -149,12 +240,175 @@ class ConversationMapper(ConversationMapperInterface):
         try:
             # 获取并删除记录
             conv_db = Conversation2db.get_by_id(conversation_id)
-            conv_db.delete_instance()
+            with Conversation2db._meta.database.atomic():
+                conv_db.delete_instance()
+                self._record_writes([_event(DELETE, conversation_id, conv_db.sid)])
+                change_counter.bump(CONVERSATION)
+            self._event_mapper.snapshot_if_needed([conv_db.sid])
             return True
         except Exception as e:
             print(f"删除对话记录失败: {e}")
             return False
 
+    def create_conversations(self, convs: List[Conversation]) -> bool:
+        """
+        在同一个事务中创建多条对话记录，任意一条失败则全部回滚
+        :param convs: Conversation对象列表，创建成功后会回填id
+        :return: 创建成功返回True，失败返回False
+        """
+        try:
+            for sid in {conv.sid for conv in convs}:
+                conversation_archive.rehydrate(sid)
+            with Conversation2db._meta.database.atomic():
+                for conv in convs:
+                    conversation_db = Conversation2db.create(
+                        message=conv.message,
+                        sid=conv.sid,
+                        role=conv.role,
+                        sender=conv.sender_id
+                    )
+                    conv.id = conversation_db.id
+                self._record_writes([
+                    _event(CREATE, conv.id, conv.sid, conv.message, conv.role, conv.sender_id) for conv in convs
+                ])
+                change_counter.bump(CONVERSATION)
+            self._event_mapper.snapshot_if_needed([conv.sid for conv in convs])
+            return True
+        except Exception as e:
+            for conv in convs:
+                conv.id = None
+            logger.error(f"批量创建对话记录失败: {e}")
+            return False
+
+    def get_latest_conversation_id(self) -> int:
+        """
+        获取当前最大的对话记录ID，用作读取历史记录时的水位线
+        :return: 最大的对话ID，没有记录时返回0
+        """
+        latest_id = Conversation2db.select(fn.MAX(Conversation2db.id)).scalar()
+        return latest_id or 0
+
+    def iter_conversations_by_scene_id(self, sid: str) -> Iterator[Conversation]:
+        """
+        按id顺序流式遍历场景的对话记录，逐行读取游标，不缓存整个结果集
+        :param sid: 场景ID
+        :return: 对话记录迭代器
+        """
+        conversation_archive.rehydrate(sid)
+        query = (Conversation2db.select()
+                 .where(Conversation2db.sid == sid)
+                 .order_by(Conversation2db.id))
+        for conv_db in query.iterator():
+            yield Conversation(
+                message=conv_db.message,
+                sid=conv_db.sid,
+                # 直接读取外键列，避免逐条查询角色表
+                sender_id=conv_db.sender_id,
+                role=conv_db.role,
+                conversation_id=conv_db.id
+            )
+
+    def insert_conversations(self, convs: List[Conversation], batch_size: int = 500) -> int:
+        """
+        批量写入对话记录，每batch_size条一条INSERT语句，全部在同一个事务中，不回填id
+        :param convs: Conversation对象列表
+        :return: 写入的记录数，失败时全部回滚并返回0
+        """
+        if not convs:
+            return 0
+        try:
+            rows = [
+                {"message": conv.message, "sid": conv.sid, "role": conv.role, "sender": conv.sender_id}
+                for conv in convs
+            ]
+            with Conversation2db._meta.database.atomic():
+                for sid in {conv.sid for conv in convs}:
+                    conversation_archive.rehydrate(sid)
+                events = []
+                for start in range(0, len(rows), batch_size):
+                    batch = convs[start:start + batch_size]
+                    last_id = Conversation2db.insert_many(rows[start:start + batch_size]).execute()
+                    # 同一条INSERT语句写入的行id连续
+                    events.extend(
+                        _event(CREATE, conversation_id, conv.sid, conv.message, conv.role, conv.sender_id)
+                        for conversation_id, conv in enumerate(batch, last_id - len(batch) + 1)
+                    )
+                self._record_writes(events, batch_size)
+                change_counter.bump(CONVERSATION)
+            self._event_mapper.snapshot_if_needed({conv.sid for conv in convs})
+            return len(rows)
+        except Exception as e:
+            logger.error(f"批量写入对话记录失败: {e}")
+            return 0
+
+    def search_conversations(self, query: str, sids: Optional[List[str]] = None, sender_id: Optional[int] = None,
+                             limit: int = 20, offset: int = 0) -> List[ConversationSearchHit]:
+        """
+        在对话全文索引conversation_fts中搜索
+        查询按空白拆分为多个词，全部命中才返回。长度不少于3的词走FTS5 MATCH并按bm25排序，
+        短于3的词用LIKE过滤；全是短词时不排序，按对话id倒序返回。
+        :param query: 搜索词
+        :param sids: 限定的场景ID列表，为空不限定
+        :param sender_id: 限定的发送者角色ID，为空不限定
+        :param limit: 返回条数
+        :param offset: 跳过条数
+        :return: 搜索结果
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        long_terms = [term for term in terms if len(term) >= _TRIGRAM_MIN_LENGTH]
+        short_terms = [term for term in terms if len(term) < _TRIGRAM_MIN_LENGTH]
+
+        where, params = [], []
+        if long_terms:
+            # 每个词作为短语加引号，避免用户输入被解析为FTS5查询语法
+            where.append("conversation_fts MATCH ?")
+            params.append(" AND ".join('"' + term.replace('"', '""') + '"' for term in long_terms))
+        for term in short_terms:
+            where.append("f.message LIKE ? ESCAPE '\\'")
+            params.append(f"%{_escape_like(term)}%")
+        if sids is not None:
+            # 场景列表以一个JSON参数传入，不受SQLite参数个数上限的影响
+            where.append("f.sid IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(sids))
+        if sender_id is not None:
+            where.append("f.sender_id = ?")
+            params.append(sender_id)
+
+        if long_terms:
+            columns = (f"snippet(conversation_fts, 0, '{_SNIPPET_OPEN}', '{_SNIPPET_CLOSE}', "
+                       f"'{_SNIPPET_ELLIPSIS}', {_SNIPPET_CHARS // 2}), bm25(conversation_fts)")
+            order_by = "bm25(conversation_fts)"
+        else:
+            columns = "f.message, NULL"
+            order_by = "f.rowid DESC"
+
+        sql = f"""
+            SELECT f.rowid, f.sid, f.sender_id, ch.name, c.role, {columns}
+            FROM conversation_fts AS f
+            JOIN conversation2db AS c ON c.id = f.rowid
+            LEFT JOIN character2db AS ch ON ch.id = f.sender_id
+            WHERE {" AND ".join(where)}
+            ORDER BY {order_by}
+            LIMIT ? OFFSET ?
+        """
+        params.extend([limit, offset])
+
+        hits = []
+        for conversation_id, sid, hit_sender_id, sender_name, role, text, score in \
+                Conversation2db._meta.database.execute_sql(sql, params):
+            hits.append(ConversationSearchHit(
+                conversation_id=conversation_id,
+                sid=sid,
+                sender_id=hit_sender_id,
+                sender_name=sender_name,
+                role=role,
+                snippet=text if long_terms else _like_snippet(text, short_terms),
+                score=score
+            ))
+        return hits
+
 
 if __name__ == "__main__":
     # 测试代码
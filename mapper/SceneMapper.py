@@ -1,12 +1,35 @@
+import time
 from abc import ABC
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
 
-from neomodel import db
+from neo4j import READ_ACCESS
+from neomodel import config, db
 
 from config.Logger import logger
 from entity.BaseModel import CharacterScene, CharacterSceneRecord
-from entity.Scene import Scene4db, Scene, Graph
-from mapper.config.LoadDB import load_neo4j_config
+from entity.Scene import Scene4db, Scene, SceneProjection, Graph
+from mapper.config.LoadDB import CYPHER_QUERIES, CYPHER_SECONDS, load_neo4j_config
+from utils.ChangeCounter import change_counter, SCENE
+from utils.GraphJournal import ADDED, REMOVED, UPDATED, Change, edge_change, graph_journal, node_change
+from utils.Metrics import histogram
+
+_ANCESTOR_SECONDS = histogram("treenovel_scene_ancestor_seconds", "查找情景到根情景的全部父节点路径的耗时（秒）")
+
+
+def _scene_changed(changes: List[Change]):
+    """
+    Neo4j写入成功（或已写入部分数据）后，在一个SQLite事务中记录情景图的变更并递增情景的计数器
+    Neo4j的写入已经提交，写入SQLite失败（如数据库被锁）时只记录日志，不影响写入结果，
+    也不掩盖调用方正在处理的异常；各进程的缓存最迟在下一次情景写入时失效，增量日志在下一次写入时重置
+    :param changes: 本次写入的节点和边的变更
+    """
+    try:
+        with graph_journal.database.atomic():
+            graph_journal.record(changes)
+            change_counter.bump(SCENE)
+    except Exception as e:
+        graph_journal.mark_lost()
+        logger.error(f"记录情景变更失败: {e}")
 
 
 class SceneMapperInterface(ABC):
@@ -38,6 +61,79 @@ class SceneMapperInterface(ABC):
     def get_characters_by_scene(self, scene_id, include_invisible=False) -> List[CharacterSceneRecord]:
         raise NotImplementedError
 
+    def get_neighborhood(self, sid: str, hops: int = 1) -> Graph:
+        raise NotImplementedError
+
+    def get_descendants(self, sid: str, depth: int = 1) -> Graph:
+        raise NotImplementedError
+
+    def get_ancestors(self, sid: str, depth: Optional[int] = None) -> Graph:
+        raise NotImplementedError
+
+    def get_main_line(self, skip: int = 0, limit: int = 200) -> Graph:
+        raise NotImplementedError
+
+    def create_scene_with_parents(self, scene: Scene, parent_sids: Optional[List[str]] = None) -> Scene:
+        raise NotImplementedError
+
+    def iter_story_scenes(self, root_sid: str) -> Iterator[Scene]:
+        raise NotImplementedError
+
+    def iter_story_edges(self, root_sid: str) -> Iterator[Tuple[str, str]]:
+        raise NotImplementedError
+
+    def merge_scenes(self, scenes: List[Scene]) -> int:
+        raise NotImplementedError
+
+    def connect_scenes_by_ids(self, edges: List[Tuple[str, str]]) -> int:
+        raise NotImplementedError
+
+    def get_subtree_sids(self, root_sid: str) -> List[str]:
+        raise NotImplementedError
+
+
+# 可变长度路径的最大深度，避免一次展开整张图
+MAX_TRAVERSAL_DEPTH = 10
+# 主线分页每页的最大情景数
+MAX_PAGE_SIZE = 1000
+
+# 投影查询的公共尾部：对节点集合ns中的每个节点，返回投影字段和集合内的子节点
+_PROJECTION_RETURN = """
+UNWIND ns AS n
+OPTIONAL MATCH (n)-[:HAS_CHILD]->(c:Scene4db) WHERE c IN ns
+RETURN n.sid, n.name, n.is_main, n.is_root, collect(c.sid)
+"""
+
+
+def _check_depth(name: str, value: int) -> int:
+    """
+    校验遍历深度，深度会直接拼接进Cypher（可变长度路径不支持参数化）
+    """
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 < value <= MAX_TRAVERSAL_DEPTH:
+        raise ValueError(f"{name}必须是1到{MAX_TRAVERSAL_DEPTH}之间的整数")
+    return value
+
+
+def _iter_query(query: str, params: Optional[dict] = None) -> Iterator[Tuple]:
+    """
+    直接从驱动逐行读取只读查询的结果
+    不经过neomodel的结果解析和节点实例化，每行是一个纯元组，读完一行处理一行
+
+    :param query: Cypher查询
+    :param params: 查询参数
+    :return: 结果行的迭代器
+    """
+    load_neo4j_config()
+    if db.driver is not config.DRIVER:
+        db.set_connection(driver=config.DRIVER)
+    start = time.perf_counter()
+    try:
+        with db.driver.session(database=db._database_name, default_access_mode=READ_ACCESS) as session:
+            yield from session.run(query, params or {})
+    finally:
+        CYPHER_QUERIES.labels("stream").inc()
+        CYPHER_SECONDS.labels("stream").observe(time.perf_counter() - start)
+
 
 class SceneMapper(SceneMapperInterface):
     def __init__(self):
@@ -54,16 +150,74 @@ class SceneMapper(SceneMapperInterface):
                      is_root=scene4db.is_root)
 
     def create_scene(self, scene: Scene, prev_scene4db: Optional[List[Scene4db]] = None) -> Scene4db:
-        scene4db = self.convert(scene)
-        scene4db.save()
-        if prev_scene4db:
-            for prev in prev_scene4db:
-                prev.children.connect(scene4db)
+        changes = []
+        try:
+            scene4db = self.convert(scene)
+            scene4db.save()
+            changes.append(node_change(ADDED, scene4db.sid, vars(self.reverse(scene4db))))
+            if prev_scene4db:
+                for prev in prev_scene4db:
+                    prev.children.connect(scene4db)
+                    changes.append(edge_change(ADDED, prev.sid, scene4db.sid))
+        except BaseException:
+            # 每次写入单独提交，失败前已写入的部分仍然有效
+            if changes:
+                _scene_changed(changes)
+            raise
+        _scene_changed(changes)
         return scene4db
 
+    def create_scene_with_parents(self, scene: Scene, parent_sids: Optional[List[str]] = None) -> Scene:
+        """
+        用一条Cypher语句创建情景并连接到全部前情景
+        前情景任意一个不存在时不创建，整条语句在同一个事务中执行
+
+        :param scene: 新情景
+        :param parent_sids: 前情景id列表，可为空
+        :return: 创建的情景
+        """
+        parent_sids = list(dict.fromkeys(parent_sids or []))
+        query = """
+        OPTIONAL MATCH (p:Scene4db) WHERE p.sid IN $parent_sids
+        WITH collect(p) AS ps
+        WHERE size(ps) = $parent_count
+        CREATE (s:Scene4db {sid: $sid, name: $name, is_main: $is_main, summary: $summary, is_root: $is_root})
+        FOREACH (p IN ps | CREATE (p)-[:HAS_CHILD]->(s))
+        RETURN s.sid, s.name, s.is_main, s.summary, s.is_root
+        """
+        results, _ = db.cypher_query(query, {
+            "parent_sids": parent_sids,
+            "parent_count": len(parent_sids),
+            "sid": scene.sid,
+            "name": scene.name,
+            "is_main": int(scene.is_main),
+            "summary": scene.summary,
+            "is_root": int(scene.is_root),
+        })
+        if not results:
+            raise ValueError(f"前情景不存在: {parent_sids}")
+        sid, name, is_main, summary, is_root = results[0]
+        _scene_changed(
+            [node_change(ADDED, sid, {"sid": sid, "name": name, "is_main": is_main, "summary": summary,
+                                      "is_root": is_root})]
+            + [edge_change(ADDED, parent_sid, sid) for parent_sid in parent_sids]
+        )
+
+        # 与create_scene一致，返回调用方传入的属性值
+        return Scene(sid=scene.sid, name=scene.name, is_main=scene.is_main, summary=scene.summary,
+                     is_root=scene.is_root)
+
     def connect_scenes(self, target_scene4db: Scene4db, prev_scene4db: Optional[List[Scene4db]]) -> Scene4db:
-        for prev in prev_scene4db:
-            prev.children.connect(target_scene4db)
+        changes = []
+        try:
+            for prev in prev_scene4db:
+                prev.children.connect(target_scene4db)
+                changes.append(edge_change(ADDED, prev.sid, target_scene4db.sid))
+        except BaseException:
+            if changes:
+                _scene_changed(changes)
+            raise
+        _scene_changed(changes)
         return target_scene4db
 
     def update_scene_by_id(self, sid: str, scene: Scene) -> Scene4db:
@@ -74,6 +228,7 @@ class SceneMapper(SceneMapperInterface):
         scene_to_update.is_main = scene.is_main
 
         scene_to_update.save()
+        _scene_changed([node_change(UPDATED, sid, vars(self.reverse(scene_to_update)))])
 
         return scene_to_update
 
@@ -94,12 +249,13 @@ class SceneMapper(SceneMapperInterface):
         :param sid: 场景的唯一标识符。
         :return: 一个包含所有父节点路径的列表。每条路径都是一个从当前场景到根场景的节点列表。
         """
-        current_node = Scene4db.nodes.get(sid=sid)
+        with _ANCESTOR_SECONDS.time():
+            current_node = Scene4db.nodes.get(sid=sid)
 
-        # 路径列表，用来存储所有完整的父节点路径
-        all_paths = []
-        # 递归查找的起始调用，传入当前节点和初始路径
-        self._find_parent_paths(current_node, [current_node], all_paths)
+            # 路径列表，用来存储所有完整的父节点路径
+            all_paths = []
+            # 递归查找的起始调用，传入当前节点和初始路径
+            self._find_parent_paths(current_node, [current_node], all_paths)
 
         # 遍历所有找到的路径，并将其反转
         for path in all_paths:
@@ -138,28 +294,34 @@ class SceneMapper(SceneMapperInterface):
 
     def delete_scene(self, scene_id: str) -> bool:
         scene_to_delete = Scene4db.nodes.get(sid=scene_id)
-        return scene_to_delete.delete()
+        # 删除节点会同时删除相连的边，先查出来记录到变更日志
+        incident_edges, _ = db.cypher_query(
+            """
+            MATCH (a:Scene4db)-[:HAS_CHILD]->(b:Scene4db)
+            WHERE a.sid = $sid OR b.sid = $sid
+            RETURN a.sid, b.sid
+            """,
+            {"sid": scene_id}
+        )
+        deleted = scene_to_delete.delete()
+        _scene_changed([edge_change(REMOVED, source, target) for source, target in incident_edges]
+                       + [node_change(REMOVED, scene_id)])
+        return deleted
 
     def get_all_scenes_graph(self) -> Graph:
-        query = """
-        MATCH (s:Scene4db)
-        OPTIONAL MATCH (s)-[r:HAS_CHILD]->(c:Scene4db)
-        RETURN s, collect({rel:r, target:c}) as relations
         """
-        results, _ = db.cypher_query(query)
-
+        获取整张情景图
+        节点只取需要的属性，边只取两端的sid，结果从驱动流式读取，不实例化Scene4db
+        """
         graph = Graph()
 
-        for row in results:
-            scene_node = Scene4db.inflate(row[0])
-            scene = self.reverse(scene_node)
-            graph.add_node(scene)
+        for sid, name, is_main, summary, is_root in _iter_query(
+                "MATCH (s:Scene4db) RETURN s.sid, s.name, s.is_main, s.summary, s.is_root"):
+            graph.add_node(Scene(sid=sid, name=name, is_main=is_main, summary=summary, is_root=is_root))
 
-            relations = row[1]
-            for rel in relations:
-                if rel["rel"] is not None and rel["target"] is not None:
-                    child_node = Scene4db.inflate(rel["target"])
-                    graph.add_edge(scene.sid, child_node.sid)
+        for source, target in _iter_query(
+                "MATCH (s:Scene4db)-[:HAS_CHILD]->(c:Scene4db) RETURN s.sid, c.sid"):
+            graph.add_edge(source, target)
 
         return graph
 
@@ -188,6 +350,182 @@ class SceneMapper(SceneMapperInterface):
                     character_scene_id=result.id))
         return character_scene_record
 
+    @staticmethod
+    def _projection_graph(query: str, params: dict) -> Graph:
+        """
+        执行投影查询，只取sid、名称和标记，不实例化Scene4db
+        """
+        graph = Graph()
+        for sid, name, is_main, is_root, child_sids in _iter_query(query, params):
+            graph.add_node(SceneProjection(sid=sid, name=name, is_main=is_main, is_root=is_root))
+            for child_sid in child_sids:
+                graph.add_edge(sid, child_sid)
+        return graph
+
+    def get_neighborhood(self, sid: str, hops: int = 1) -> Graph:
+        """
+        获取情景周围hops跳以内的子图（不区分方向）
+
+        :param sid: 中心情景id
+        :param hops: 跳数
+        :return: 投影节点及其之间的边，情景不存在时为空图
+        """
+        query = f"""
+        MATCH (s:Scene4db {{sid: $sid}})-[:HAS_CHILD*0..{_check_depth("hops", hops)}]-(n:Scene4db)
+        WITH collect(DISTINCT n) AS ns
+        """ + _PROJECTION_RETURN
+        return self._projection_graph(query, {"sid": sid})
+
+    def get_descendants(self, sid: str, depth: int = 1) -> Graph:
+        """
+        获取情景及其depth层以内的后续情景
+
+        :param sid: 起始情景id
+        :param depth: 向下的层数
+        :return: 投影节点及其之间的边，情景不存在时为空图
+        """
+        query = f"""
+        MATCH (s:Scene4db {{sid: $sid}})-[:HAS_CHILD*0..{_check_depth("depth", depth)}]->(n:Scene4db)
+        WITH collect(DISTINCT n) AS ns
+        """ + _PROJECTION_RETURN
+        return self._projection_graph(query, {"sid": sid})
+
+    def get_ancestors(self, sid: str, depth: Optional[int] = None) -> Graph:
+        """
+        获取情景及其全部前情景，只沿父节点方向查找
+
+        :param sid: 起始情景id
+        :param depth: 向上的层数，为空时一直找到根情景
+        :return: 投影节点及其之间的边，情景不存在时为空图
+        """
+        bound = "" if depth is None else str(_check_depth("depth", depth))
+        query = f"""
+        MATCH (s:Scene4db {{sid: $sid}})<-[:HAS_CHILD*0..{bound}]-(n:Scene4db)
+        WITH collect(DISTINCT n) AS ns
+        """ + _PROJECTION_RETURN
+        return self._projection_graph(query, {"sid": sid})
+
+    def get_main_line(self, skip: int = 0, limit: int = 200) -> Graph:
+        """
+        分页获取主线情景，按sid排序
+        边包含指向其他页主线情景的边，前端逐页加载后即可连成完整的主线
+
+        :param skip: 跳过的情景数
+        :param limit: 本页情景数
+        :return: 投影节点及主线情景之间的边
+        """
+        if skip < 0:
+            raise ValueError("skip不能小于0")
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit必须是1到{MAX_PAGE_SIZE}之间的整数")
+        query = """
+        MATCH (n:Scene4db) WHERE n.is_main = 1
+        WITH n ORDER BY n.sid SKIP $skip LIMIT $limit
+        OPTIONAL MATCH (n)-[:HAS_CHILD]->(c:Scene4db) WHERE c.is_main = 1
+        RETURN n.sid AS sid, n.name, n.is_main, n.is_root, collect(c.sid)
+        ORDER BY sid
+        """
+        return self._projection_graph(query, {"skip": skip, "limit": limit})
+
+    def iter_story_scenes(self, root_sid: str) -> Iterator[Scene]:
+        """
+        流式遍历从根情景出发可到达的全部情景（包括根情景本身）
+
+        :param root_sid: 根情景id
+        :return: 情景迭代器，根情景不存在时为空
+        """
+        query = """
+        MATCH (r:Scene4db {sid: $sid})-[:HAS_CHILD*0..]->(n:Scene4db)
+        WITH DISTINCT n
+        RETURN n.sid, n.name, n.is_main, n.summary, n.is_root
+        """
+        for sid, name, is_main, summary, is_root in _iter_query(query, {"sid": root_sid}):
+            yield Scene(sid=sid, name=name, is_main=is_main, summary=summary, is_root=is_root)
+
+    def iter_story_edges(self, root_sid: str) -> Iterator[Tuple[str, str]]:
+        """
+        流式遍历从根情景出发可到达的全部边
+
+        :param root_sid: 根情景id
+        :return: (父情景id, 子情景id)迭代器
+        """
+        query = """
+        MATCH (r:Scene4db {sid: $sid})-[:HAS_CHILD*0..]->(a:Scene4db)-[:HAS_CHILD]->(b:Scene4db)
+        WITH DISTINCT a, b
+        RETURN a.sid, b.sid
+        """
+        yield from _iter_query(query, {"sid": root_sid})
+
+    def get_subtree_sids(self, root_sid: str) -> List[str]:
+        """
+        获取从根情景出发可到达的全部情景id（包括根情景本身），只返回sid不加载节点
+
+        :param root_sid: 根情景id
+        :return: 情景id列表，根情景不存在时为空
+        """
+        query = """
+        MATCH (r:Scene4db {sid: $sid})-[:HAS_CHILD*0..]->(n:Scene4db)
+        RETURN DISTINCT n.sid
+        """
+        return [sid for sid, in _iter_query(query, {"sid": root_sid})]
+
+    def merge_scenes(self, scenes: List[Scene]) -> int:
+        """
+        批量写入情景，一条UNWIND语句完成；sid已存在的情景会被覆盖，在变更日志中记为更新
+
+        :param scenes: 情景列表
+        :return: 写入的情景数
+        """
+        if not scenes:
+            return 0
+        # is_main和is_root以整数保存，与Scene4db的IntegerProperty一致
+        rows = [
+            {
+                "sid": scene.sid,
+                "name": scene.name,
+                "is_main": None if scene.is_main is None else int(scene.is_main),
+                "summary": scene.summary,
+                "is_root": None if scene.is_root is None else int(scene.is_root),
+            }
+            for scene in scenes
+        ]
+        results, _ = db.cypher_query(
+            """
+            UNWIND $rows AS row
+            OPTIONAL MATCH (e:Scene4db {sid: row.sid})
+            WITH row, e IS NOT NULL AS existed
+            MERGE (s:Scene4db {sid: row.sid})
+            SET s.name = row.name, s.is_main = row.is_main, s.summary = row.summary, s.is_root = row.is_root
+            RETURN row.sid, existed
+            """,
+            {"rows": rows}
+        )
+        existing = {sid for sid, existed in results if existed}
+        _scene_changed([node_change(UPDATED if row["sid"] in existing else ADDED, row["sid"], row) for row in rows])
+        return len(rows)
+
+    def connect_scenes_by_ids(self, edges: List[Tuple[str, str]]) -> int:
+        """
+        按sid批量连接情景，一条UNWIND语句完成，已存在的边不会重复创建
+
+        :param edges: (父情景id, 子情景id)列表
+        :return: 两端情景都存在、成功连接的边数
+        """
+        if not edges:
+            return 0
+        results, _ = db.cypher_query(
+            """
+            UNWIND $edges AS edge
+            MATCH (a:Scene4db {sid: edge[0]}), (b:Scene4db {sid: edge[1]})
+            MERGE (a)-[:HAS_CHILD]->(b)
+            RETURN a.sid, b.sid
+            """,
+            {"edges": [list(edge) for edge in edges]}
+        )
+        if results:
+            _scene_changed([edge_change(ADDED, source, target) for source, target in results])
+        return len(results)
+
 
 def create_graph():
     scene_mapper = SceneMapper()
@@ -1,14 +1,178 @@
+import functools
 import os
+import re
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
 
 from dotenv import load_dotenv
+from neo4j import GraphDatabase, basic_auth
 from neomodel import config
-from peewee import SqliteDatabase
+from neomodel.sync_.core import Database
+from peewee import SqliteDatabase, _savepoint
 
+from config.Logger import logger
 
+from utils.Metrics import counter, histogram
+from utils.TextCompression import tn_text
+
+_SQL_STATEMENT = re.compile(r"\s*(\w+)")
+_SQL_QUERIES = counter("treenovel_sqlite_queries_total", "SQLite执行的语句数", ("statement",))
+_SQL_SECONDS = histogram("treenovel_sqlite_query_seconds", "SQLite执行语句的耗时（秒），不含逐行读取结果的时间",
+                         ("statement",))
+# 按语句类型提前取出子指标，其余语句（事务、建表等）归为OTHER
+_SQL_METRICS = {
+    statement: (_SQL_QUERIES.labels(statement), _SQL_SECONDS.labels(statement))
+    for statement in ("SELECT", "INSERT", "UPDATE", "DELETE", "OTHER")
+}
+CYPHER_QUERIES = counter("treenovel_cypher_queries_total", "Cypher查询次数", ("path",))
+CYPHER_SECONDS = histogram("treenovel_cypher_query_seconds",
+                           "Cypher查询耗时（秒），stream为逐行读取到结束的时间", ("path",))
+
+
+class _HookedSavepoint(_savepoint):
+    """
+    保存点回滚时丢弃其中登记的提交后回调
+    """
+
+    def _begin(self):
+        self._mark = len(self.db._pending_callbacks())
+        super()._begin()
+
+    def rollback(self):
+        super().rollback()
+        del self.db._pending_callbacks()[self._mark:]
+
+
+class MeteredSqliteDatabase(SqliteDatabase):
+    """
+    统计每条SQL的执行次数和耗时，并支持在事务提交后执行回调
+    peewee按线程各自打开连接，这里记录所有线程的连接，退出时由close_all统一关闭
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 事务按线程隔离，待执行的回调也按线程保存
+        self._callbacks = threading.local()
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        # close_all后递增，线程发现自己的连接属于旧的一代时重新连接
+        self._generation = 0
+
+    def _pending_callbacks(self) -> list:
+        if not hasattr(self._callbacks, "pending"):
+            self._callbacks.pending = []
+        return self._callbacks.pending
+
+    def after_commit(self, callback):
+        """
+        在当前线程最外层事务提交后执行callback，事务回滚时丢弃；不在事务中时立即执行
+        """
+        if self.in_transaction():
+            self._pending_callbacks().append(callback)
+        else:
+            callback()
+
+    def _connect(self):
+        conn = super()._connect()
+        with self._connections_lock:
+            self._connections.add(conn)
+        self._state.generation = self._generation
+        return conn
+
+    def _close(self, conn):
+        with self._connections_lock:
+            self._connections.discard(conn)
+        super()._close(conn)
+
+    def is_closed(self):
+        if not self._state.closed and getattr(self._state, "generation", None) != self._generation:
+            # 连接已被close_all关闭
+            self._state.reset()
+        return self._state.closed
+
+    def close_all(self) -> int:
+        """
+        关闭所有线程（包括线程池中的请求线程）打开的连接，应用退出时调用
+        :return: 关闭的连接数
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, set()
+            self._generation += 1
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"关闭SQLite连接失败: {e}")
+        return len(connections)
+
+    def savepoint(self, sid=None):
+        return _HookedSavepoint(self, sid)
+
+    def commit(self):
+        super().commit()
+        callbacks, self._callbacks.pending = self._pending_callbacks(), []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"执行事务提交后的回调失败: {e}")
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._callbacks.pending = []
+
+    def execute_sql(self, sql, params=None, commit=None):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, commit)
+        finally:
+            match = _SQL_STATEMENT.match(sql)
+            queries, seconds = _SQL_METRICS.get(match.group(1).upper() if match else "OTHER", _SQL_METRICS["OTHER"])
+            queries.inc()
+            seconds.observe(time.perf_counter() - start)
+
+
+def install_cypher_metrics():
+    """
+    统计neomodel发出的全部Cypher查询（节点读写、关系遍历、cypher_query），由应用启动时显式调用；
+    替换的是neomodel的Database.cypher_query，对进程内所有neomodel查询生效，重复调用只替换一次
+    """
+    cypher_query = Database.cypher_query
+    if getattr(cypher_query, "metered", False):
+        return
+    queries, seconds = CYPHER_QUERIES.labels("neomodel"), CYPHER_SECONDS.labels("neomodel")
+
+    @functools.wraps(cypher_query)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return cypher_query(*args, **kwargs)
+        finally:
+            queries.inc()
+            seconds.observe(time.perf_counter() - start)
+
+    wrapper.metered = True
+    Database.cypher_query = wrapper
+
+
+def uninstall_cypher_metrics():
+    """
+    恢复neomodel原来的Database.cypher_query，应用退出时调用
+    """
+    if getattr(Database.cypher_query, "metered", False):
+        Database.cypher_query = Database.cypher_query.__wrapped__
+
+
+@lru_cache(maxsize=None)
 def load_neo4j_config():
     """
-    加载neo数据库
+    加载neo数据库，每个进程只执行一次
+    neomodel的db按线程保存驱动，只配置DATABASE_URL时每个请求线程会各自创建驱动和连接池；
+    这里创建一个驱动（线程安全，自带连接池）放在config.DRIVER中，所有线程共享
     :return:
     """
     load_dotenv()
@@ -17,19 +181,49 @@ def load_neo4j_config():
     host = os.getenv('NEO4J_HOST')
     port = os.getenv('NEO4J_PORT')
 
-    # 格式化数据库连接 URL
-    config.DATABASE_URL = f'bolt://{username}:{password}@{host}:{port}'
     config.ENCRYPTED = False
+    # 创建驱动不会立即连接数据库
+    config.DRIVER = GraphDatabase.driver(
+        f'bolt://{host}:{port}',
+        auth=basic_auth(username, password),
+        encrypted=config.ENCRYPTED,
+        connection_timeout=config.CONNECTION_TIMEOUT,
+        max_connection_pool_size=config.MAX_CONNECTION_POOL_SIZE,
+        keep_alive=config.KEEP_ALIVE,
+        user_agent=config.USER_AGENT
+    )
+    # neomodel优先使用DATABASE_URL（有默认值），清空后各线程第一次查询时绑定config.DRIVER
+    config.DATABASE_URL = None
+
+
+def close_neo4j():
+    """
+    关闭共享的Neo4j驱动，应用退出时调用
+    """
+    if config.DRIVER is not None:
+        config.DRIVER.close()
+        config.DRIVER = None
+    load_neo4j_config.cache_clear()
 
 
+@lru_cache(maxsize=None)
 def load_sqlite_config():
+    """
+    加载SQLite数据库，每个进程只创建一个实例，所有模型和mapper共享
+    """
     load_dotenv()
     # relative_path = Path("../")
     # absolute_path = relative_path.resolve()
 
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
     DB_PATH = os.path.join(BASE_DIR, os.getenv('SQLITE_URL'))
-    return SqliteDatabase(DB_PATH, pragmas={'foreign_keys': 1})
+    # WAL模式下多个工作进程可以在写入的同时读取，写事务等待锁的时间由timeout控制
+    # 每个连接仍只由打开它的线程使用，允许跨线程只是为了退出时由close_all统一关闭
+    database = MeteredSqliteDatabase(DB_PATH, pragmas={'foreign_keys': 1, 'journal_mode': 'wal'}, timeout=10,
+                                     check_same_thread=False)
+    # 在SQL中读取压缩的消息原文时使用tn_text(字段)，每个连接都需要注册
+    database.register_function(tn_text, 'tn_text', 1, deterministic=True)
+    return database
 
 
 if __name__ == '__main__':
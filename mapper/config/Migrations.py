@@ -0,0 +1,243 @@
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+from peewee import Database
+
+from config.Logger import logger
+from entity.BaseModel import Character2db, CharacterScene, Conversation2db, Template2db, SceneActivity2db, \
+    ConversationArchive2db, ConversationEvent2db, ConversationSnapshot2db
+from mapper.config.SearchIndex import drop_conversation_fts_triggers, install_conversation_fts
+from utils.ChangeFeed import install_change_feed
+from utils.GraphJournal import install_scene_journal
+from utils.TextCompression import compress_text
+
+SCHEMA_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at REAL NOT NULL
+)
+"""
+
+
+@dataclass
+class Migration:
+    """
+    一次结构变更，version从1开始递增，已执行的版本记录在schema_version表中
+    新增变更只能追加到MIGRATIONS末尾，不要修改已发布的变更
+    """
+    version: int
+    name: str
+    apply: Callable[[Database], None]
+
+
+def _create_base_tables(database: Database):
+    # 旧版本的库中这些表已经存在，safe=True时跳过
+    with database.bind_ctx([Character2db, Conversation2db, CharacterScene, Template2db]):
+        database.create_tables([Character2db, Conversation2db, CharacterScene, Template2db], safe=True)
+
+
+def _create_conversation_fts(database: Database):
+    install_conversation_fts(database)
+
+
+def _execute_all(*statements: str) -> Callable[[Database], None]:
+    def apply(database: Database):
+        for sql in statements:
+            database.execute_sql(sql)
+    return apply
+
+
+def _compress_text_columns(database: Database):
+    # 触发器改为通过tn_text读取可能被压缩的消息
+    drop_conversation_fts_triggers(database)
+    install_conversation_fts(database)
+    # 已有的长文本按当前配置压缩，短文本和已压缩的保持不变
+    for table, column in (("conversation2db", "message"), ("character2db", "prompt")):
+        rows = database.execute_sql(f"SELECT id, {column} FROM {table} WHERE typeof({column}) = 'text'").fetchall()
+        updates = []
+        for row_id, text in rows:
+            value = compress_text(text)
+            if isinstance(value, bytes):
+                updates.append((value, row_id))
+        if updates:
+            database.cursor().executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", updates)
+            logger.info(f"{table}.{column} 压缩了{len(updates)}条记录，执行VACUUM后可回收空间")
+
+
+def _create_conversation_archive(database: Database):
+    with database.bind_ctx([SceneActivity2db, ConversationArchive2db]):
+        database.create_tables([SceneActivity2db, ConversationArchive2db], safe=True)
+    # 写入或修改对话时刷新情景的活跃时间
+    for event in ("INSERT", "UPDATE"):
+        database.execute_sql(f"""
+            CREATE TRIGGER IF NOT EXISTS scene_activity_{event.lower()} AFTER {event} ON conversation2db BEGIN
+                INSERT INTO sceneactivity2db (sid, last_active) VALUES (new.sid, CAST(strftime('%s', 'now') AS REAL))
+                ON CONFLICT (sid) DO UPDATE SET last_active = excluded.last_active;
+            END
+        """)
+    # 已有的情景没有活跃记录，从变更执行时开始计算
+    database.execute_sql(
+        "INSERT OR IGNORE INTO sceneactivity2db (sid, last_active) "
+        "SELECT DISTINCT sid, CAST(strftime('%s', 'now') AS REAL) FROM conversation2db"
+    )
+
+
+def _index_conversations_from_mapper(database: Database):
+    # 插入触发器调用tn_text，没有注册该函数的连接写入对话表会失败；改为由mapper写入索引行
+    drop_conversation_fts_triggers(database)
+    install_conversation_fts(database)
+
+
+def _conversation_ids_autoincrement(database: Database):
+    # SQLite不能给已有的主键加AUTOINCREMENT，重建对话表；没有其他表的外键引用conversation2db
+    (table_sql,) = database.execute_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'conversation2db'").fetchone()
+    if "AUTOINCREMENT" in table_sql.upper():
+        return
+    new_sql, replaced = re.subn(r'("id"\s+INTEGER\s+NOT\s+NULL\s+PRIMARY\s+KEY)', r"\1 AUTOINCREMENT", table_sql,
+                                count=1, flags=re.IGNORECASE)
+    if not replaced:
+        raise RuntimeError(f"无法识别conversation2db的主键定义: {table_sql}")
+    new_sql = new_sql.replace('"conversation2db"', '"conversation2db_new"', 1)
+    # 索引和触发器随旧表一起删除，重建后按原定义恢复
+    dependents = [sql for sql, in database.execute_sql(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = 'conversation2db' AND type IN ('index', 'trigger') "
+        "AND sql IS NOT NULL")]
+    database.execute_sql(new_sql)
+    database.execute_sql("INSERT INTO conversation2db_new SELECT * FROM conversation2db")
+    database.execute_sql("DROP TABLE conversation2db")
+    database.execute_sql("ALTER TABLE conversation2db_new RENAME TO conversation2db")
+    for sql in dependents:
+        database.execute_sql(sql)
+    # 已归档（不在表中）的对话也用过id，从事件日志中取出用过的最大id，之后分配的id都比它大
+    database.execute_sql("DELETE FROM sqlite_sequence WHERE name = 'conversation2db'")
+    database.execute_sql(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'conversation2db', MAX(used) FROM ("
+        "SELECT MAX(id) AS used FROM conversation2db UNION ALL "
+        "SELECT MAX(conversation_id) FROM conversationevent2db) HAVING MAX(used) IS NOT NULL"
+    )
+
+
+def _create_conversation_events(database: Database):
+    with database.bind_ctx([ConversationEvent2db, ConversationSnapshot2db]):
+        database.create_tables([ConversationEvent2db, ConversationSnapshot2db], safe=True)
+    # 按情景重放事件、按情景查找最近的快照
+    database.execute_sql("CREATE INDEX IF NOT EXISTS conversationevent2db_sid_id ON conversationevent2db (sid, id)")
+    database.execute_sql(
+        "CREATE INDEX IF NOT EXISTS conversationsnapshot2db_sid_event ON conversationsnapshot2db (sid, event_id)"
+    )
+    # 已有的对话作为create事件写入日志，重放结果与当前的对话表一致（已归档的对话不在其中）
+    database.execute_sql(
+        "INSERT INTO conversationevent2db (sid, conversation_id, op, message, role, sender_id, created_at) "
+        "SELECT sid, id, 'create', message, role, sender_id, CAST(strftime('%s', 'now') AS REAL) "
+        "FROM conversation2db ORDER BY id"
+    )
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "create_base_tables", _create_base_tables),
+    Migration(2, "create_conversation_fts", _create_conversation_fts),
+    Migration(3, "add_hot_query_indexes", _execute_all(
+        # 按情景读取对话并按id排序（聊天历史、导出）
+        "CREATE INDEX IF NOT EXISTS conversation2db_sid_id ON conversation2db (sid, id)",
+        # 按角色读取对话，同时用于删除角色时级联删除对话
+        "CREATE INDEX IF NOT EXISTS conversation2db_sender_id ON conversation2db (sender_id)",
+        # 按情景读取角色关联，覆盖可见性过滤和排序字段，查询不用回表
+        "CREATE INDEX IF NOT EXISTS characterscene_sid_visible "
+        "ON characterscene (sid, is_visible, sort_order, character_id)",
+        # 按角色查询所在情景、判断角色是否已在情景中
+        "CREATE INDEX IF NOT EXISTS characterscene_character_sid ON characterscene (character_id, sid)",
+    )),
+    Migration(4, "compress_text_columns", _compress_text_columns),
+    Migration(5, "create_conversation_archive", _create_conversation_archive),
+    Migration(6, "create_conversation_events", _create_conversation_events),
+    Migration(7, "create_change_feed", install_change_feed),
+    Migration(8, "index_conversations_from_mapper", _index_conversations_from_mapper),
+    Migration(9, "conversation_ids_autoincrement", _conversation_ids_autoincrement),
+    Migration(10, "create_scene_journal", install_scene_journal),
+]
+
+
+def _query_plan_checks() -> Dict[str, tuple]:
+    """
+    热点查询及期望使用的索引，查询与mapper中的写法保持一致
+    """
+    return {
+        "conversations_by_scene": (
+            Conversation2db.select().where(Conversation2db.sid == "").order_by(Conversation2db.id),
+            "conversation2db_sid_id",
+        ),
+        "conversations_by_character": (
+            Conversation2db.select().where(Conversation2db.sender == 0),
+            "conversation2db_sender_id",
+        ),
+        "characters_by_scene": (
+            CharacterScene.select().where((CharacterScene.sid == "") & (CharacterScene.is_visible == True)),
+            "characterscene_sid_visible",
+        ),
+        "scenes_by_character": (
+            CharacterScene.select().where((CharacterScene.character_id == 0) & (CharacterScene.sid == "")),
+            "characterscene_character_sid",
+        ),
+    }
+
+
+def current_version(database: Database) -> int:
+    """
+    :param database: 数据库
+    :return: 已执行到的版本号，未执行过任何变更时为0
+    """
+    database.execute_sql(SCHEMA_VERSION_DDL)
+    row = database.execute_sql("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def run_migrations(database: Database, migrations: List[Migration] = MIGRATIONS) -> int:
+    """
+    执行尚未执行的结构变更，每个变更和它的版本记录在同一个事务中提交
+    启动时调用，可重复调用
+    :param database: 数据库
+    :param migrations: 变更列表，按version递增
+    :return: 本次执行的变更数量
+    """
+    version = current_version(database)
+    pending = [migration for migration in migrations if migration.version > version]
+    applied = 0
+    for migration in pending:
+        start = time.perf_counter()
+        # 立即获取写锁，多个工作进程同时启动时其他进程等待后跳过已执行的变更
+        with database.atomic("IMMEDIATE"):
+            if current_version(database) >= migration.version:
+                continue
+            migration.apply(database)
+            database.execute_sql(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (migration.version, migration.name, time.time())
+            )
+        applied += 1
+        logger.info(f"数据库结构变更 {migration.version} {migration.name} 完成，"
+                    f"耗时{time.perf_counter() - start:.3f}s")
+    return applied
+
+
+def check_query_plans(database: Database) -> Dict[str, bool]:
+    """
+    对热点查询执行EXPLAIN QUERY PLAN，检查是否用上了对应的索引，未用上或需要额外排序时记录警告
+    :param database: 数据库
+    :return: 查询名 -> 是否使用了期望的索引
+    """
+    report = {}
+    for name, (query, index) in _query_plan_checks().items():
+        sql, params = query.sql()
+        plan = [row[-1] for row in database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)]
+        # 用上索引且不需要临时B树排序
+        report[name] = (any(index in detail for detail in plan)
+                        and not any("TEMP B-TREE" in detail for detail in plan))
+        if report[name]:
+            logger.debug(f"查询计划 {name}: {'; '.join(plan)}")
+        else:
+            logger.warning(f"查询计划 {name} 未使用索引 {index}: {'; '.join(plan)}")
+    return report
@@ -0,0 +1,80 @@
+from typing import Iterable, Tuple
+
+from peewee import Database
+
+from config.Logger import logger
+from utils.TextCompression import decompress_text
+
+# 对话全文索引：trigram分词，中文无需额外分词器，也能加速LIKE子串匹配
+# 索引自己保存一份消息原文（不使用external content），snippet直接从索引中截取
+# 消息可能是压缩保存的，索引行由mapper在写入对话的同一事务中用原文写入（index_conversations），
+# 触发器只负责删除，不调用自定义函数，没有注册tn_text的连接（sqlite3命令行、备份脚本等）也能正常写入对话表；
+# 绕过mapper写入的对话不会进入索引
+CONVERSATION_FTS_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS conversation_fts USING fts5(
+        message,
+        sid UNINDEXED,
+        sender_id UNINDEXED,
+        tokenize = 'trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS conversation_fts_delete AFTER DELETE ON conversation2db BEGIN
+        DELETE FROM conversation_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS conversation_fts_update AFTER UPDATE ON conversation2db BEGIN
+        DELETE FROM conversation_fts WHERE rowid = old.id;
+    END
+    """,
+]
+
+
+# 旧版本的插入触发器conversation_fts_insert也在其中，重建时一并删除
+CONVERSATION_FTS_TRIGGERS = ["conversation_fts_insert", "conversation_fts_delete", "conversation_fts_update"]
+
+
+def drop_conversation_fts_triggers(database: Database):
+    """
+    删除全文索引的同步触发器，触发器定义变化后先删除再调用install_conversation_fts重建
+    """
+    for trigger in CONVERSATION_FTS_TRIGGERS:
+        database.execute_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+
+
+def index_conversations(database: Database, rows: Iterable[Tuple[int, str, str, int]]):
+    """
+    写入对话的全文索引行，需要在写入对话的同一事务中调用；更新对话时触发器已删除旧的索引行
+    :param database: 对话表所在的数据库
+    :param rows: (对话id, 消息原文, 情景id, 发送者id)
+    """
+    database.cursor().executemany(
+        "INSERT INTO conversation_fts(rowid, message, sid, sender_id) VALUES (?, ?, ?, ?)",
+        ((conversation_id, str(message), sid, sender_id) for conversation_id, message, sid, sender_id in rows)
+    )
+
+
+def install_conversation_fts(database: Database) -> bool:
+    """
+    创建对话全文索引及同步触发器，首次创建时把已有的对话写入索引
+    可重复调用，缺少的触发器会补齐
+    :param database: 对话表所在的数据库
+    :return: 是否新建了索引
+    """
+    if not database.table_exists("conversation2db"):
+        logger.warning("conversation2db表不存在，跳过创建对话全文索引")
+        return False
+    created = not database.table_exists("conversation_fts")
+
+    with database.atomic():
+        for ddl in CONVERSATION_FTS_DDL:
+            database.execute_sql(ddl)
+        if created:
+            rows = database.execute_sql("SELECT id, message, sid, sender_id FROM conversation2db")
+            index_conversations(database, ((conversation_id, decompress_text(message), sid, sender_id)
+                                           for conversation_id, message, sid, sender_id in rows))
+    if created:
+        logger.info("对话全文索引创建完成")
+    return created
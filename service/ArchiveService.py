@@ -0,0 +1,54 @@
+import os
+import time
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from config.Logger import logger
+from mapper.ConversationArchive import ConversationArchive, conversation_archive
+
+load_dotenv()
+
+# 超过该天数没有写入对话的情景会被归档
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+
+
+class ArchiveService:
+    """
+    不活跃情景的对话归档
+    归档后的对话在情景被再次读取或写入时由ConversationMapper自动恢复，调用方无需感知。
+    """
+
+    def __init__(self, archive: Optional[ConversationArchive] = None):
+        self._archive = archive or conversation_archive
+
+    def archive_inactive_scenes(self, days: Optional[float] = None, limit: int = 100) -> Dict:
+        """
+        归档超过days天没有写入对话的情景
+        :param days: 不活跃天数，默认ARCHIVE_AFTER_DAYS
+        :param limit: 本次最多归档的情景数
+        :return: 归档的情景数、对话数和失败的情景
+        """
+        days = ARCHIVE_AFTER_DAYS if days is None else days
+        if days < 0 or limit <= 0:
+            raise ValueError("days不能小于0，limit必须大于0")
+
+        result = {"scenes": 0, "conversations": 0, "failed": []}
+        for sid in self._archive.inactive_scene_ids(time.time() - days * 86400, limit):
+            try:
+                count = self._archive.archive_scene(sid)
+            except Exception as e:
+                logger.error(f"归档情景 {sid} 失败: {e}")
+                result["failed"].append(sid)
+                continue
+            if count:
+                result["scenes"] += 1
+                result["conversations"] += count
+        logger.info(f"归档完成: {result}")
+        return result
+
+    def get_stats(self) -> Dict:
+        """
+        :return: 归档的情景数、对话数、段文件数量和大小
+        """
+        return self._archive.stats()
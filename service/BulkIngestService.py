@@ -0,0 +1,212 @@
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config.Logger import logger
+from entity.BaseModel import Character, CharacterSceneRecord, Conversation
+from entity.Scene import Scene
+from mapper.CharacterMapper import CharacterMapperInterface
+from mapper.CharacterSceneMapper import CharacterSceneMapperInterface
+from mapper.ConversationMapper import ConversationMapperInterface
+from mapper.SceneMapper import SceneMapperInterface
+
+# 记录类型
+SCENE = "scene"
+EDGE = "edge"
+CHARACTER = "character"
+MEMBERSHIP = "membership"
+CONVERSATION = "conversation"
+
+KINDS = (SCENE, EDGE, CHARACTER, MEMBERSHIP, CONVERSATION)
+
+
+class BulkIngestError(Exception):
+    """
+    批量写入中途失败
+    失败前已提交的批次不会回滚，stats中记录了已写入的数量
+    """
+
+    def __init__(self, message: str, stats: Dict, invalid: bool = False):
+        """
+        :param message: 错误描述
+        :param stats: 已提交的写入：counts为各类记录已写入的数量（每类都是输入中该类记录的前counts条），
+                      character_ids为已写入角色的 临时id -> 新id
+        :param invalid: 是否由输入数据错误（引用不存在的角色或情景、格式错误等）引起
+        """
+        super().__init__(message)
+        self.stats = stats
+        self.invalid = invalid
+
+
+class BulkIngestService:
+    """
+    批量写入情景、边、角色、角色关联和对话记录
+    记录按类型缓冲，满batch_size后一次写入：情景和边各用一条UNWIND语句，
+    角色关联和对话用insert_many。每批在各自的事务中提交，大批量导入期间不会长时间占用SQLite的写锁，
+    其他请求的写入可以在批次之间进行。
+    中途失败时已提交的批次保留，抛出BulkIngestError报告已写入的数量，去掉已写入的记录后重新提交剩余部分即可；
+    Neo4j的写入是幂等的（情景按sid MERGE，已存在的边不重复创建），重复写入同一批情景和边没有副作用。
+    """
+
+    def __init__(self, scene_mapper: SceneMapperInterface, character_mapper: CharacterMapperInterface,
+                 character_scene_mapper: CharacterSceneMapperInterface,
+                 conversation_mapper: ConversationMapperInterface, batch_size: int = 1000):
+        self._scene_mapper = scene_mapper
+        self._character_mapper = character_mapper
+        self._character_scene_mapper = character_scene_mapper
+        self._conversation_mapper = conversation_mapper
+        self.batch_size = batch_size
+
+    def ingest(self, records: Iterable[Tuple[str, Dict]],
+               progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """
+        批量写入记录
+        角色总是新建，记录中的character_id视为本批数据内的临时id并映射为新的id；
+        角色关联和对话引用了本批数据中未定义的character_id时，视为已存在的角色id并校验。
+
+        :param records: (类型, 数据)序列，类型见KINDS；边必须在两端情景之后
+        :param progress: 每写入一批后调用，参数为当前的统计信息
+        :return: 各类记录的写入数量、耗时和吞吐量
+        """
+        start = time.perf_counter()
+        counts = {kind: 0 for kind in KINDS}
+        # 每类记录读入的数量，结束时与写入数量核对
+        received = {kind: 0 for kind in KINDS}
+        character_ids: Dict[int, int] = {}
+        buffers: Dict[str, List] = {kind: [] for kind in KINDS}
+
+        def report():
+            if progress is not None:
+                progress(self._stats(counts, start))
+
+        def flush_scenes():
+            scenes = buffers[SCENE]
+            if scenes:
+                if self._scene_mapper.merge_scenes(scenes) != len(scenes):
+                    raise RuntimeError("写入情景失败")
+                counts[SCENE] += len(scenes)
+                scenes.clear()
+                report()
+
+        def flush_edges():
+            # 边的两端情景需要先写入
+            flush_scenes()
+            edges = buffers[EDGE]
+            if edges:
+                connected = self._scene_mapper.connect_scenes_by_ids(edges)
+                if connected != len(edges):
+                    raise ValueError(f"{len(edges) - connected}条边的两端情景不存在")
+                counts[EDGE] += len(edges)
+                edges.clear()
+                report()
+
+        def flush_characters():
+            characters = buffers[CHARACTER]
+            if not characters:
+                return
+            if not self._character_mapper.create_characters([character for _, character in characters]):
+                raise RuntimeError("写入角色失败")
+            for local_id, character in characters:
+                character_ids[local_id] = character.character_id
+            counts[CHARACTER] += len(characters)
+            characters.clear()
+            report()
+
+        def map_character_ids(items: List, attr: str):
+            # 本批数据中定义的角色id替换为新id，其余的必须是已存在的角色
+            flush_characters()
+            unknown = {getattr(item, attr) for item in items} - character_ids.keys()
+            if unknown:
+                missing = unknown - self._character_mapper.get_existing_character_ids(list(unknown))
+                if missing:
+                    raise ValueError(f"角色不存在: {sorted(missing)}")
+            for item in items:
+                setattr(item, attr, character_ids.get(getattr(item, attr), getattr(item, attr)))
+
+        def flush_memberships():
+            memberships = buffers[MEMBERSHIP]
+            if not memberships:
+                return
+            map_character_ids(memberships, "character_id")
+            if not self._character_scene_mapper.connect_characters_2_scenes(memberships, self.batch_size):
+                raise RuntimeError("写入角色关联失败")
+            counts[MEMBERSHIP] += len(memberships)
+            memberships.clear()
+            report()
+
+        def flush_conversations():
+            conversations = buffers[CONVERSATION]
+            if not conversations:
+                return
+            map_character_ids(conversations, "sender_id")
+            if self._conversation_mapper.insert_conversations(conversations, self.batch_size) != len(conversations):
+                raise RuntimeError("写入对话记录失败")
+            counts[CONVERSATION] += len(conversations)
+            conversations.clear()
+            report()
+
+        flushers = {
+            SCENE: flush_scenes,
+            EDGE: flush_edges,
+            CHARACTER: flush_characters,
+            MEMBERSHIP: flush_memberships,
+            CONVERSATION: flush_conversations,
+        }
+
+        try:
+            for kind, data in records:
+                if kind == CHARACTER:
+                    buffers[CHARACTER].append((data["character_id"], self._to_character(data)))
+                elif kind in flushers:
+                    buffers[kind].append(self._convert(kind, data))
+                else:
+                    raise ValueError(f"未知的记录类型: {kind}")
+                received[kind] += 1
+                if len(buffers[kind]) >= self.batch_size:
+                    flushers[kind]()
+
+            # 没有被角色关联和对话引用的角色只能在这里写入
+            flush_characters()
+            flush_edges()
+            flush_memberships()
+            flush_conversations()
+
+            if counts != received:
+                raise RuntimeError(f"写入数量与读入数量不一致: 写入{counts}，读入{received}")
+        except Exception as e:
+            stats = self._stats(counts, start)
+            stats["character_ids"] = dict(character_ids)
+            logger.error(f"批量写入中途失败: {e}，已写入: {stats}")
+            raise BulkIngestError(str(e), stats, invalid=isinstance(e, (ValueError, KeyError, TypeError))) from e
+
+        stats = self._stats(counts, start)
+        logger.info(f"批量写入完成: {stats}")
+        return stats
+
+    @staticmethod
+    def _stats(counts: Dict[str, int], start: float) -> Dict:
+        elapsed = time.perf_counter() - start
+        total = sum(counts.values())
+        return {
+            "counts": dict(counts),
+            "total": total,
+            "seconds": round(elapsed, 3),
+            "records_per_second": round(total / elapsed) if elapsed > 0 else total,
+        }
+
+    @staticmethod
+    def _to_character(data: Dict) -> Character:
+        return Character(name=data["name"], prompt=data["prompt"], is_visible=data.get("is_visible", True))
+
+    @staticmethod
+    def _convert(kind: str, data: Dict):
+        if kind == SCENE:
+            return Scene(sid=data["sid"], name=data["name"], is_main=data["is_main"],
+                         summary=data.get("summary", ""), is_root=data["is_root"])
+        if kind == EDGE:
+            return data["source"], data["target"]
+        if kind == MEMBERSHIP:
+            return CharacterSceneRecord(character_id=data["character_id"], sid=data["sid"],
+                                        sort_order=data.get("sort_order", 0),
+                                        is_visible=data.get("is_visible", True))
+        return Conversation(message=data["message"], sid=data["sid"],
+                            sender_id=data["sender_id"], role=data["role"])
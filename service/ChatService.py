@@ -1,7 +1,11 @@
+import queue
+import threading
 from abc import ABC
-from typing import Union, Generator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Union, Generator, Iterator, Optional, Tuple
 
 from config.Logger import logger
+from core.SceneTurnLock import SceneTurnLock
 from core.chat.ChatCore import ChatCore
 from entity.BaseModel import Conversation
 from mapper.CharacterSceneMapper import CharacterSceneMapper
@@ -34,18 +38,27 @@ class ChatService(ChatServiceInterface):
         self.character_mapper = character_mapper
         self.character_scene_mapper = character_scene_mapper
         self.scene_mapper = scene_mapper
+        # 写库线程池，使持久化与上下文组装、LLM请求并行
+        self._persist_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="chat-persist")
+        # 同一情景内的对话轮次串行执行，由控制器在调用chat前后获取和释放
+        self.scene_turn_lock = SceneTurnLock()
 
     def chat(self, roleplay_id: int, conversation: Conversation, stream: bool):
         """
         处理用户与角色的对话，并存储对话记录
 
+        用户对话与assistant占位记录的写库在后台线程中进行，与上下文组装和上游LLM请求并行，
+        生成失败时回滚本轮写入的记录
+
         Args:
             roleplay_id: LLM扮演的角色ID
             conversation: 用户发送的对话内容
             stream: 是否流式返回响应
 
         Returns:
-            dict: 包含响应内容、用户conversation_id和assistant conversation_id的字典
+            dict: 非流式时包含响应内容、用户conversation_id和assistant conversation_id；
+                  流式时包含stream生成器、conversation_ids（Future，结果为(用户id, assistant id)）
+                  和close（停止读取上游响应，响应结束或客户端断开时调用，stream未开始迭代时同样有效）
         """
         try:
             scenes_id = [scene.sid for scene in self.scene_mapper.get_all_parents_by_id(conversation.sid)[0]]
@@ -54,34 +67,16 @@ class ChatService(ChatServiceInterface):
                     self.character_scene_mapper.is_character_in_any_scenes(conversation.sender_id, scenes_id)):
                 raise ValueError("角色不在情景中！")
 
-            # 1. 首先存储用户的对话到数据库, 检查角色标签
+            # 1. 检查角色标签，标签会进入prompt，需要在组装上下文前完成
             conversation.message = normalize_role_prefix(
                 conversation.message,
                 role_name=self.character_mapper.get_character_by_id(conversation.sender_id).name)
 
-            user_conversation_saved = self.conversation_mapper.create_conversation(conversation)
-            if not user_conversation_saved:
-                error_msg = "存储用户对话失败"
-                if stream:
-                    def error_generator():
-                        yield error_msg
-                    return {"error": error_msg}
-                else:
-                    return {"error": error_msg}
-
-            # 保存用户conversation_id
-            user_conversation_id = conversation.id
-
-            # 2. 调用LLM生成回复
-            llm_response = self.group_agent_engine.generate_reply(
-                roleplay_character_id=roleplay_id,
-                conversation=conversation,
-                stream=stream
-            )
+            # 2. 记录历史水位线后在后台写库，上下文只读取水位线之前的记录，用户对话直接追加到上下文末尾
+            history_watermark = self.conversation_mapper.get_latest_conversation_id()
+            llm_conversation = None
             if stream:
-                # 3. 流式响应处理
-                # 预先创建assistant的conversation记录，获取conversation_id
-                assistant_conversation_id = None
+                # 流式响应预先创建assistant的conversation记录，获取conversation_id
                 llm_conversation = Conversation(
                     message="",  # 初始为空，流式更新
                     sid=conversation.sid,
@@ -89,52 +84,85 @@ class ChatService(ChatServiceInterface):
                     role="assistant",
                     conversation_id=None
                 )
-                saved = self.conversation_mapper.create_conversation(llm_conversation)
-                if saved:
-                    assistant_conversation_id = llm_conversation.id
+            persist_future = self._persist_executor.submit(self._persist_turn, conversation, llm_conversation)
+
+            # 3. 调用LLM生成回复（与写库并行）
+            try:
+                llm_response = self.group_agent_engine.generate_reply(
+                    roleplay_character_id=roleplay_id,
+                    conversation=conversation,
+                    stream=stream,
+                    persisted=False,
+                    history_watermark=history_watermark
+                )
+            except Exception:
+                self._rollback_turn(persist_future)
+                raise
+
+            if stream:
+                # 4. 流式响应处理，立即开始迭代上游响应，首个token不必等待写库和SSE建立
+                prefetched_response = PrefetchedStream(llm_response)
 
                 def stream_with_storage():
-                    nonlocal assistant_conversation_id
                     full_response = ""
                     try:
+                        _, assistant_conversation_id = persist_future.result()
+
                         # 收集完整的流式响应
-                        for chunk in llm_response:
+                        for chunk in prefetched_response:
                             full_response += chunk
                             yield chunk
 
-                        # 4. 存储LLM的完整回复到数据库
+                        # 5. 存储LLM的完整回复到数据库
                         if full_response:
                             full_response = normalize_role_prefix(
                                 full_response,
                                 role_name=self.character_mapper.get_character_by_id(roleplay_id).name)
 
                             # 更新已创建的conversation记录
-                            if assistant_conversation_id:
-                                updated_conv = Conversation(
-                                    message=full_response,
-                                    sid=conversation.sid,
-                                    sender_id=roleplay_id,
-                                    role="assistant",
-                                    conversation_id=assistant_conversation_id
-                                )
-                                self.conversation_mapper.update_conversation_by_id(assistant_conversation_id, updated_conv)
+                            updated_conv = Conversation(
+                                message=full_response,
+                                sid=conversation.sid,
+                                sender_id=roleplay_id,
+                                role="assistant",
+                                conversation_id=assistant_conversation_id
+                            )
+                            self.conversation_mapper.update_conversation_by_id(assistant_conversation_id, updated_conv)
 
                     except Exception as e:
+                        self._rollback_turn(persist_future)
                         error_msg = f"流式响应处理失败: {str(e)}"
                         yield error_msg
+                    finally:
+                        prefetched_response.close()
+
+                storage_stream = stream_with_storage()
+
+                def close():
+                    # 先通知后台线程停止读取，stream正在其他线程中迭代时无法关闭生成器
+                    prefetched_response.close()
+                    try:
+                        storage_stream.close()
+                    except ValueError:
+                        pass
 
                 # 返回生成器和conversation_id
                 return {
-                    "stream": stream_with_storage(),
-                    "user_conversation_id": user_conversation_id,
-                    "assistant_conversation_id": assistant_conversation_id
+                    "stream": storage_stream,
+                    "conversation_ids": persist_future,
+                    "close": close
                 }
 
             else:
-                # 3. 非流式响应处理
+                # 4. 非流式响应处理
+                try:
+                    user_conversation_id, _ = persist_future.result()
+                except Exception as e:
+                    return {"error": str(e)}
+
                 assistant_conversation_id = None
                 if isinstance(llm_response, str) and llm_response:
-                    # 4. 存储LLM的回复到数据库
+                    # 5. 存储LLM的回复到数据库
                     llm_conversation = Conversation(
                         message=llm_response,
                         sid=conversation.sid,
@@ -163,6 +191,111 @@ class ChatService(ChatServiceInterface):
             else:
                 return {"error": error_msg}
 
+    def get_connection_stats(self) -> dict:
+        """
+        获取与LLM服务商之间的连接指标（请求数、新建连接数、复用率等）
+        """
+        return self.group_agent_engine.connection_stats()
+
+    def _persist_turn(self, conversation: Conversation,
+                      llm_conversation: Optional[Conversation]) -> Tuple[int, Optional[int]]:
+        """
+        在同一个事务中写入用户对话和assistant占位记录
+
+        Returns:
+            (用户conversation_id, assistant conversation_id)
+        """
+        convs = [conversation] if llm_conversation is None else [conversation, llm_conversation]
+        if not self.conversation_mapper.create_conversations(convs):
+            raise RuntimeError("存储用户对话失败")
+        return conversation.id, llm_conversation.id if llm_conversation is not None else None
+
+    def _rollback_turn(self, persist_future: Future):
+        """
+        生成失败时删除本轮已写入的用户对话和assistant占位记录
+        """
+        try:
+            conversation_ids = persist_future.result()
+        except Exception:
+            # 写库本身失败，事务已回滚
+            return
+        for conversation_id in conversation_ids:
+            if conversation_id is not None:
+                self.conversation_mapper.delete_conversation_by_id(conversation_id)
+
+
+_STREAM_END = object()
+
+# 后台线程最多提前读取的chunk数，消费方跟不上或已断开时不再继续读取上游响应
+_PREFETCH_MAX_CHUNKS = 256
+
+# 缓冲区满（或空）时检查是否已停止的间隔（秒）
+_PREFETCH_POLL_INTERVAL = 0.1
+
+
+class PrefetchedStream:
+    """
+    在后台线程中提前迭代LLM的流式响应，使上游请求与写库、SSE连接建立并行进行
+    缓冲区有上限；close()通知后台线程停止读取并关闭上游响应，迭代尚未开始时调用同样有效。
+    上游在两个chunk之间阻塞时，后台线程读到下一个chunk后才能发现已停止。
+    迭代时按原顺序产出chunk，上游异常会在消费时重新抛出
+    """
+
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self._buffer = queue.Queue(maxsize=_PREFETCH_MAX_CHUNKS)
+        self._stopped = threading.Event()
+        threading.Thread(target=self._pump, name="chat-stream-prefetch", daemon=True).start()
+
+    def _put(self, item) -> bool:
+        """
+        :return: 是否放入缓冲区，已停止时返回False
+        """
+        while not self._stopped.is_set():
+            try:
+                self._buffer.put(item, timeout=_PREFETCH_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _pump(self):
+        try:
+            for chunk in self._chunks:
+                if not self._put((chunk, None)):
+                    break
+            else:
+                self._put((_STREAM_END, None))
+        except Exception as e:
+            self._put((None, e))
+        finally:
+            # 提前停止时关闭上游响应，释放连接（已读完时关闭没有影响）
+            close = getattr(self._chunks, "close", None)
+            if close is not None:
+                close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        while True:
+            try:
+                chunk, error = self._buffer.get(timeout=_PREFETCH_POLL_INTERVAL)
+            except queue.Empty:
+                if self._stopped.is_set():
+                    raise StopIteration
+                continue
+            if error is not None:
+                self._stopped.set()
+                raise error
+            if chunk is _STREAM_END:
+                self._stopped.set()
+                raise StopIteration
+            return chunk
+
+    def close(self):
+        self._stopped.set()
+
 
 if __name__ == "__main__":
     # 初始化依赖
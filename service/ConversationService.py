@@ -1,8 +1,16 @@
 from abc import ABC
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from entity.BaseModel import Conversation
+from entity.dto.ConversationSearchDTO import ConversationSearchHit
+from mapper.ConversationEventMapper import ConversationEventMapper, ConversationEventMapperInterface
 from mapper.ConversationMapper import ConversationMapper, ConversationMapperInterface
+from mapper.SceneMapper import SceneMapper, SceneMapperInterface
+
+# 对话搜索单页最多返回的条数
+MAX_SEARCH_LIMIT = 100
+# 事件流单次最多返回的事件数
+MAX_EVENT_LIMIT = 1000
 
 
 class ConversationServiceInterface(ABC):
@@ -71,14 +79,69 @@ class ConversationServiceInterface(ABC):
         """
         raise NotImplementedError
 
+    def search_conversations(self, query: str, scene_id: Optional[str] = None, sender_id: Optional[int] = None,
+                             limit: int = 20, offset: int = 0) -> List[ConversationSearchHit]:
+        """
+        全文搜索对话
+
+        Args:
+            query: 搜索词，多个词用空格分隔，全部命中才返回
+            scene_id: 限定在该场景及其全部后继场景中搜索
+            sender_id: 限定发送者角色ID
+            limit: 返回条数
+            offset: 跳过条数
+
+        Return:
+            按相关度排序的搜索结果
+
+        Raises:
+            ValueError: 搜索词为空或分页参数无效
+        """
+        raise NotImplementedError
+
+    def get_conversation_events(self, after_event_id: int = 0, limit: int = 500,
+                                scene_id: Optional[str] = None) -> Dict:
+        """
+        按顺序读取对话事件流
+
+        Args:
+            after_event_id: 上次读到的事件id，从头读取时为0
+            limit: 最多返回的事件数
+            scene_id: 只读取该场景的事件
+
+        Return:
+            events: 事件列表；next: 下次请求使用的after_event_id；latest: 当前最新的事件id
+
+        Raises:
+            ValueError: 分页参数无效
+        """
+        raise NotImplementedError
+
+    def get_scene_history(self, scene_id: str, at_event_id: Optional[int] = None) -> List[Conversation]:
+        """
+        重建场景在某个事件之后的对话列表
+
+        Args:
+            scene_id: 场景ID
+            at_event_id: 事件id，为空时重建到最新
+
+        Return:
+            对话列表
+        """
+        raise NotImplementedError
+
 
 class ConversationService(ConversationServiceInterface):
     """
     对话相关的service
     """
 
-    def __init__(self, conversation_mapper: ConversationMapperInterface):
+    def __init__(self, conversation_mapper: ConversationMapperInterface,
+                 scene_mapper: Optional[SceneMapperInterface] = None,
+                 event_mapper: Optional[ConversationEventMapperInterface] = None):
         self._conversation_mapper = conversation_mapper
+        self._scene_mapper = scene_mapper or SceneMapper()
+        self._event_mapper = event_mapper or ConversationEventMapper()
 
     def create_conversation(self, conversation: Conversation) -> Conversation:
         """
@@ -154,6 +217,77 @@ class ConversationService(ConversationServiceInterface):
         """
         return self._conversation_mapper.delete_conversation_by_id(conversation_id)
 
+    def search_conversations(self, query: str, scene_id: Optional[str] = None, sender_id: Optional[int] = None,
+                             limit: int = 20, offset: int = 0) -> List[ConversationSearchHit]:
+        """
+        全文搜索对话
+
+        Args:
+            query: 搜索词，多个词用空格分隔，全部命中才返回
+            scene_id: 限定在该场景及其全部后继场景中搜索
+            sender_id: 限定发送者角色ID
+            limit: 返回条数
+            offset: 跳过条数
+
+        Return:
+            按相关度排序的搜索结果
+
+        Raises:
+            ValueError: 搜索词为空或分页参数无效
+        """
+        if not query or not query.strip():
+            raise ValueError("搜索词不能为空")
+        if not 0 < limit <= MAX_SEARCH_LIMIT or offset < 0:
+            raise ValueError(f"limit必须在1到{MAX_SEARCH_LIMIT}之间，offset不能小于0")
+
+        sids = None
+        if scene_id is not None:
+            sids = self._scene_mapper.get_subtree_sids(scene_id)
+            if not sids:
+                return []
+
+        return self._conversation_mapper.search_conversations(query, sids, sender_id, limit, offset)
+
+    def get_conversation_events(self, after_event_id: int = 0, limit: int = 500,
+                                scene_id: Optional[str] = None) -> Dict:
+        """
+        按顺序读取对话事件流
+
+        Args:
+            after_event_id: 上次读到的事件id，从头读取时为0
+            limit: 最多返回的事件数
+            scene_id: 只读取该场景的事件
+
+        Return:
+            events: 事件列表；next: 下次请求使用的after_event_id；latest: 当前最新的事件id
+
+        Raises:
+            ValueError: 分页参数无效
+        """
+        if not 0 < limit <= MAX_EVENT_LIMIT or after_event_id < 0:
+            raise ValueError(f"limit必须在1到{MAX_EVENT_LIMIT}之间，after不能小于0")
+
+        latest = self._event_mapper.get_latest_event_id()
+        events = self._event_mapper.get_events_since(after_event_id, limit, scene_id)
+        return {
+            "events": events,
+            "next": events[-1].event_id if events else after_event_id,
+            "latest": latest,
+        }
+
+    def get_scene_history(self, scene_id: str, at_event_id: Optional[int] = None) -> List[Conversation]:
+        """
+        重建场景在某个事件之后的对话列表
+
+        Args:
+            scene_id: 场景ID
+            at_event_id: 事件id，为空时重建到最新
+
+        Return:
+            对话列表
+        """
+        return self._event_mapper.get_scene_state(scene_id, at_event_id)
+
 
 if __name__ == '__main__':
     conversation_service = ConversationService(ConversationMapper())
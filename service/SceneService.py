@@ -1,10 +1,13 @@
-from typing import List
+from typing import Dict, List, Optional
 
+from config.Logger import logger
+from entity.BaseModel import CharacterSceneRecord
 from entity.Scene import Scene, Graph
 from entity.dto.CharacterSceneDTO import CharacterSceneDto
 from mapper.CharacterMapper import CharacterMapper
 from mapper.CharacterSceneMapper import CharacterSceneMapperInterface, CharacterSceneMapper
 from mapper.SceneMapper import SceneMapperInterface, SceneMapper
+from utils.GraphJournal import graph_journal
 
 
 class SceneService:
@@ -53,41 +56,36 @@ class SceneService:
         :param character_ids: 角色id列表，可为空。如果为空且提供了current_scenes_id，则继承当前场景的角色列表
         :return: 创建的新场景
         """
-        # 创建场景
-        if current_scenes_id is not None:
-            if isinstance(current_scenes_id, str):
-                current_scenes_id = [current_scenes_id]
+        if isinstance(current_scenes_id, str):
+            current_scenes_id = [current_scenes_id]
 
-            prev_scenes = [
-                self._scene_mapper.get_scene_by_id(current_scene_id) for current_scene_id in current_scenes_id]
-
-            current_scene_db = self._scene_mapper.create_scene(
-                new_scene,
-                prev_scenes)
-        else:
-            current_scene_db = self._scene_mapper.create_scene(new_scene)
-
-        # 处理角色连接
-        new_scene_instance = SceneMapper.reverse(current_scene_db)
+        # 一条Cypher语句创建场景并连接全部前情景
+        new_scene_instance = self._scene_mapper.create_scene_with_parents(new_scene, current_scenes_id)
 
         # 如果没有提供角色列表且提供了current_scenes_id，则继承当前场景的角色列表
-        if character_ids is None and current_scenes_id is not None:
-            if isinstance(current_scenes_id, str):
-                current_scenes_id = [current_scenes_id]
-
+        if character_ids is None and current_scenes_id:
             # 从第一个场景获取角色列表（假设多个场景的角色列表相同）
             character_scenes = self._scene_mapper.get_characters_by_scene(current_scenes_id[0], include_invisible=False)
             character_ids = [character_scene.character_id for character_scene in character_scenes]
 
-        # 如果有角色列表，则连接角色到新场景
+        # 如果有角色列表，则一次批量插入连接角色到新场景
         if character_ids:
-            for idx, character_id in enumerate(character_ids):
-                self.connect_character_2_scene(
+            connected = self._character_scene_mapper.connect_characters_2_scenes([
+                CharacterSceneRecord(
                     character_id=character_id,
-                    scene_id=new_scene_instance.sid,
+                    sid=new_scene_instance.sid,
                     sort_order=idx,
                     is_visible=True
                 )
+                for idx, character_id in enumerate(character_ids)
+            ])
+            if not connected:
+                # 情景和前情景的边已经写入Neo4j，删除情景（连同边）避免留下没有角色的孤立情景
+                try:
+                    self._scene_mapper.delete_scene(new_scene_instance.sid)
+                except Exception as e:
+                    logger.error(f"删除角色连接失败的情景 {new_scene_instance.sid} 失败: {e}")
+                raise RuntimeError(f"连接角色到场景 {new_scene_instance.sid} 失败")
 
         return new_scene_instance
 
@@ -98,26 +96,19 @@ class SceneService:
         :param include_invisible: 是否包含不可见角色
         :return: CharacterSceneDto列表，包含角色信息和关联信息
         """
-        character_scenes = self._scene_mapper.get_characters_by_scene(scene_id, include_invisible)
-        character_scene_dtos = []
-
-        for character_scene in character_scenes:
-            # 获取角色信息
-            character = self._character_mapper.get_character_by_id(character_scene.character_id)
-
-            # 创建CharacterSceneDto，包含角色信息和关联信息
-            character_scene_dto = CharacterSceneDto(
-                character_id=character_scene.character_id,
-                sid=character_scene.sid,
-                sort_order=character_scene.sort_order,
-                is_visible=character_scene.is_visible,
-                parent_id=character_scene.parent_id,
-                character_scene_id=character_scene.character_scene_id,
-                character=character
-            )
-            character_scene_dtos.append(character_scene_dto)
+        return self.get_characters_by_scenes([scene_id], include_invisible).get(scene_id, [])
 
-        return character_scene_dtos
+    def get_characters_by_scenes(self, scene_ids: List[str],
+                                 include_invisible: bool = False) -> Dict[str, List[CharacterSceneDto]]:
+        """
+        批量获取多个场景的角色信息，一次JOIN查询完成
+        :param scene_ids: 场景id列表
+        :param include_invisible: 是否包含不可见角色
+        :return: 场景id -> CharacterSceneDto列表，没有角色的场景对应空列表
+        """
+        character_scenes = self._character_scene_mapper.get_character_scenes_with_characters(
+            scene_ids, include_invisible)
+        return {scene_id: character_scenes.get(scene_id, []) for scene_id in scene_ids}
 
     def delete_scene_by_id(self, scene_id: str):
         """
@@ -158,6 +149,64 @@ class SceneService:
     def get_all_scenes_graph(self) -> Graph:
         return self._scene_mapper.get_all_scenes_graph()
 
+    def get_neighborhood(self, scene_id: str, hops: int = 1) -> Graph:
+        """
+        获取情景周围hops跳以内的子图，节点只包含sid、名称和标记
+        :param scene_id: 中心情景id
+        :param hops: 跳数
+        :return: 子图
+        """
+        return self._scene_mapper.get_neighborhood(scene_id, hops)
+
+    def get_descendants(self, scene_id: str, depth: int = 1) -> Graph:
+        """
+        获取情景depth层以内的后续情景
+        :param scene_id: 起始情景id
+        :param depth: 层数
+        :return: 子图
+        """
+        return self._scene_mapper.get_descendants(scene_id, depth)
+
+    def get_ancestors(self, scene_id: str, depth: Optional[int] = None) -> Graph:
+        """
+        获取情景的前情景，depth为空时一直找到根情景
+        :param scene_id: 起始情景id
+        :param depth: 层数
+        :return: 子图
+        """
+        return self._scene_mapper.get_ancestors(scene_id, depth)
+
+    def get_main_line(self, skip: int = 0, limit: int = 200) -> Graph:
+        """
+        分页获取主线情景
+        :param skip: 跳过的情景数
+        :param limit: 本页情景数
+        :return: 子图
+        """
+        return self._scene_mapper.get_main_line(skip, limit)
+
+    def get_scene_graph_changes(self, since: Optional[int] = None, epoch: Optional[str] = None) -> Dict:
+        """
+        获取情景图自某个版本以来的增量变更
+        版本号缺失、过旧或epoch不一致（数据库重建）时返回全图，reset为True
+        :param since: 客户端上次同步到的版本号
+        :param epoch: 客户端上次同步时的epoch
+        :return: 增量变更或全图，都带有新的version和epoch
+        """
+        changes = None
+        if since is not None and epoch == graph_journal.epoch:
+            changes = graph_journal.changes_since(since)
+        if changes is None:
+            # 先取版本号再查全图，期间发生的变更会在下次增量中重复下发，客户端按upsert处理即可
+            version = graph_journal.version
+            changes = {
+                "version": version,
+                "epoch": graph_journal.epoch,
+                "reset": True,
+                "graph": self._scene_mapper.get_all_scenes_graph(),
+            }
+        return changes
+
 
 if __name__ == '__main__':
     scene_service = SceneService(
@@ -0,0 +1,171 @@
+import queue
+import threading
+from typing import Callable, Dict, Generator, Iterable, Iterator, Optional, Tuple
+
+import orjson
+
+from entity.Scene import Scene4db
+from mapper.CharacterMapper import CharacterMapperInterface
+from mapper.CharacterSceneMapper import CharacterSceneMapperInterface
+from mapper.ConversationMapper import ConversationMapperInterface
+from mapper.SceneMapper import SceneMapperInterface
+from service.BulkIngestService import BulkIngestService, KINDS
+from utils.FastResponse import dumps
+
+# 导出文件格式标识与版本
+STORY_FORMAT = "treenovel-story"
+STORY_FORMAT_VERSION = 1
+
+_EXPORT_END = object()
+
+
+def _line(kind: str, data) -> bytes:
+    """
+    生成一行NDJSON：{"type": 类型, "data": 数据}
+    """
+    return dumps({"type": kind, "data": data}) + b"\n"
+
+
+class StoryService:
+    """
+    故事（以某个情景为根的情景DAG）的导出与导入
+    导出为NDJSON，每行一条记录：header、scene、character、membership、conversation、edge，
+    情景和对话都是流式读取的，服务端内存占用与故事大小无关。
+    """
+
+    def __init__(self, scene_mapper: SceneMapperInterface, character_mapper: CharacterMapperInterface,
+                 character_scene_mapper: CharacterSceneMapperInterface,
+                 conversation_mapper: ConversationMapperInterface, bulk_ingest_service: BulkIngestService):
+        self._scene_mapper = scene_mapper
+        self._character_mapper = character_mapper
+        self._character_scene_mapper = character_scene_mapper
+        self._conversation_mapper = conversation_mapper
+        self._bulk_ingest_service = bulk_ingest_service
+
+    def has_scene(self, scene_id: str) -> bool:
+        """
+        判断情景是否存在
+        :param scene_id: 情景id
+        :return: bool
+        """
+        try:
+            self._scene_mapper.get_scene_by_id(scene_id)
+            return True
+        except Scene4db.DoesNotExist:
+            return False
+
+    def export_story(self, root_sid: str) -> Generator[bytes, None, None]:
+        """
+        以NDJSON流式导出从根情景出发可到达的全部情景
+        每个情景后紧跟它的角色关联和对话记录，角色在第一次被引用前输出且只输出一次，最后输出全部的边。
+        所有数据库读取都在同一个后台线程中完成（SQLite游标和Neo4j会话不能跨线程使用），
+        中途出错时输出一行type为error的记录后结束。
+
+        :param root_sid: 根情景id
+        :return: NDJSON行的生成器
+        """
+        return self._iter_in_thread(self._export_lines(root_sid))
+
+    def _export_lines(self, root_sid: str) -> Iterator[bytes]:
+        yield _line("header", {"format": STORY_FORMAT, "version": STORY_FORMAT_VERSION, "root": root_sid})
+
+        exported_character_ids = set()
+
+        def character_lines(character_id: int) -> Iterator[bytes]:
+            if character_id in exported_character_ids:
+                return
+            exported_character_ids.add(character_id)
+            character = self._character_mapper.get_character_by_id(character_id)
+            if character is not None:
+                yield _line("character", character)
+
+        for scene in self._scene_mapper.iter_story_scenes(root_sid):
+            yield _line("scene", scene)
+            for record in self._character_scene_mapper.iter_character_scenes_by_scene_id(scene.sid):
+                yield from character_lines(record.character_id)
+                yield _line("membership", record)
+            for conversation in self._conversation_mapper.iter_conversations_by_scene_id(scene.sid):
+                yield from character_lines(conversation.sender_id)
+                yield _line("conversation", conversation)
+
+        for source, target in self._scene_mapper.iter_story_edges(root_sid):
+            yield _line("edge", {"source": source, "target": target})
+
+    @staticmethod
+    def _iter_in_thread(lines: Iterator[bytes], maxsize: int = 256) -> Generator[bytes, None, None]:
+        """
+        在单独的线程中迭代lines，通过有界队列交给调用方
+        队列满时后台线程等待，调用方关闭生成器后后台线程停止读取并释放游标
+        """
+        buffer = queue.Queue(maxsize)
+        stopped = threading.Event()
+
+        def put(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    buffer.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def pump():
+            try:
+                for line in lines:
+                    if not put(line):
+                        return
+                put(_EXPORT_END)
+            except Exception as e:
+                put(_line("error", {"message": str(e)}))
+                put(_EXPORT_END)
+            finally:
+                lines.close()
+
+        threading.Thread(target=pump, name="story-export", daemon=True).start()
+
+        def drain():
+            try:
+                while True:
+                    line = buffer.get()
+                    if line is _EXPORT_END:
+                        return
+                    yield line
+            finally:
+                stopped.set()
+
+        return drain()
+
+    def import_story(self, lines: Iterable[bytes],
+                     progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """
+        导入export_story导出的NDJSON，解析后交给BulkIngestService批量写入
+        角色总是新建，导出文件中的角色id会映射为新的id；情景按sid合并（已存在则覆盖）。
+        角色关联的parent_id不导入。每批单独提交，中途失败时抛出BulkIngestError，已导入的部分保留。
+
+        :param lines: NDJSON行
+        :param progress: 每写入一批后调用，参数为当前的统计信息
+        :return: 各类记录的导入数量、耗时和吞吐量
+        """
+        return self._bulk_ingest_service.ingest(self._parse_lines(lines), progress)
+
+    @staticmethod
+    def _parse_lines(lines: Iterable[bytes]) -> Iterator[Tuple[str, Dict]]:
+        for line_no, raw in enumerate(lines, 1):
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                item = orjson.loads(raw)
+                kind, data = item["type"], item["data"]
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                raise ValueError(f"第{line_no}行不是有效的导出记录")
+
+            if kind == "header":
+                if data.get("format") != STORY_FORMAT or data.get("version") != STORY_FORMAT_VERSION:
+                    raise ValueError(f"不支持的导出格式: {data.get('format')} v{data.get('version')}")
+            elif kind == "error":
+                raise ValueError(f"导出文件不完整: {data.get('message')}")
+            elif kind not in KINDS:
+                raise ValueError(f"第{line_no}行的记录类型未知: {kind}")
+            else:
+                yield kind, data
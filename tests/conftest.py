@@ -0,0 +1,43 @@
+"""
+测试的公共配置：项目根目录加入sys.path，数据库等共享文件放在临时目录中，不读写.env中配置的数据库
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_TEST_DIR = tempfile.mkdtemp(prefix="treenovel-tests-")
+# 在导入任何项目模块之前设置，load_dotenv不会覆盖已有的环境变量
+os.environ["SQLITE_URL"] = os.path.join(_TEST_DIR, "test.db")
+os.environ["CHANGE_FEED_DIR"] = os.path.join(_TEST_DIR, "feed")
+os.environ["SCENE_LOCK_DIR"] = os.path.join(_TEST_DIR, "turns")
+
+
+@pytest.fixture
+def database():
+    """
+    每个测试使用一个执行过全部结构变更的空数据库
+    """
+    from entity.BaseModel import BaseDtoModel
+    from mapper.ConversationArchive import conversation_archive
+    from mapper.config.Migrations import run_migrations
+    from utils.ChangeFeed import change_feed
+
+    db = BaseDtoModel._meta.database
+    change_feed.stop()
+    db.close_all()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db.database + suffix):
+            os.remove(db.database + suffix)
+    # 序号、epoch和归档缓存都属于上一个数据库
+    change_feed._seqs.clear()
+    change_feed._epoch = None
+    conversation_archive._archived_version = None
+    run_migrations(db)
+    yield db
+    change_feed.stop()
+    db.close_all()
@@ -0,0 +1,19 @@
+"""
+CharacterSceneMapper.get_character_scenes_with_characters：角色已被删除的关联记录保留，character为None
+"""
+
+from entity.BaseModel import Character2db, CharacterScene
+from mapper.CharacterSceneMapper import CharacterSceneMapper
+
+
+def test_memberships_of_deleted_characters_are_kept(database):
+    kept = Character2db.create(name="留下", prompt="p", is_visible=True)
+    gone = Character2db.create(name="删除", prompt="p", is_visible=True)
+    for sort_order, character in enumerate((kept, gone)):
+        CharacterScene.create(character_id=character.id, sid="s", sort_order=sort_order, is_visible=True)
+    Character2db.delete().where(Character2db.id == gone.id).execute()
+
+    dtos = CharacterSceneMapper().get_character_scenes_with_characters(["s", "empty"])["s"]
+    assert [dto.character_id for dto in dtos] == [kept.id, gone.id]
+    assert dtos[0].character.name == "留下"
+    assert dtos[1].character is None
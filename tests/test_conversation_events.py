@@ -0,0 +1,109 @@
+"""
+ConversationEventMapper：事件id回填、删除事件的重放、快照阈值，以及跨快照在任意事件时刻重建情景
+"""
+
+import random
+
+import pytest
+
+from entity.BaseModel import Character2db, Conversation, ConversationEvent, ConversationEvent2db, \
+    ConversationSnapshot2db
+from mapper.ConversationEventMapper import ConversationEventMapper, CREATE, DELETE, UPDATE
+from mapper.ConversationMapper import ConversationMapper
+
+
+@pytest.fixture
+def sender(database):
+    return Character2db.create(name="旁白", prompt="p", is_visible=True).id
+
+
+def _create(sid, conversation_id, message, sender_id=1):
+    return ConversationEvent(sid=sid, conversation_id=conversation_id, op=CREATE, message=message, role="user",
+                             sender_id=sender_id)
+
+
+def _state(conversations):
+    return [(c.conversation_id, c.message, c.role, c.sender_id) for c in conversations]
+
+
+def test_append_events_assigns_contiguous_ids(database):
+    mapper = ConversationEventMapper()
+    # 已有事件时新事件的id不从1开始
+    mapper.append_events([_create("s", 1, "first")])
+    events = mapper.append_events([_create("s", i, f"m{i}") for i in range(2, 7)], batch_size=2)
+
+    rows = list(ConversationEvent2db.select().where(ConversationEvent2db.id > 1).order_by(ConversationEvent2db.id))
+    assert [event.event_id for event in events] == [row.id for row in rows]
+    assert [event.conversation_id for event in events] == [row.conversation_id for row in rows]
+    assert all(event.created_at == rows[0].created_at for event in events)
+    assert mapper.get_latest_event_id() == events[-1].event_id
+
+
+def test_replay_applies_updates_and_deletes(database):
+    mapper = ConversationEventMapper()
+    created = mapper.append_events([_create("s", 1, "a"), _create("s", 2, "b"), _create("other", 3, "c")])
+    updated, deleted = mapper.append_events([
+        ConversationEvent(sid="s", conversation_id=1, op=UPDATE, message="a2", role="assistant", sender_id=2),
+        ConversationEvent(sid="s", conversation_id=2, op=DELETE),
+    ])
+    # 删除从未创建过的对话不影响重放
+    mapper.append_events([ConversationEvent(sid="s", conversation_id=99, op=DELETE)])
+
+    assert _state(mapper.get_scene_state("s", created[1].event_id)) == [(1, "a", "user", 1), (2, "b", "user", 1)]
+    assert _state(mapper.get_scene_state("s", updated.event_id)) == [(1, "a2", "assistant", 2), (2, "b", "user", 1)]
+    assert _state(mapper.get_scene_state("s", deleted.event_id)) == [(1, "a2", "assistant", 2)]
+    assert _state(mapper.get_scene_state("s")) == [(1, "a2", "assistant", 2)]
+    assert _state(mapper.get_scene_state("other")) == [(3, "c", "user", 1)]
+
+
+def test_snapshot_if_needed_thresholds(database):
+    mapper = ConversationEventMapper(snapshot_interval=3)
+    mapper.append_events([_create("s", 1, "a"), _create("s", 2, "b"), _create("other", 3, "c")])
+    # 其他情景的事件不计入
+    assert mapper.snapshot_if_needed(["s", "other"]) == 0
+
+    mapper.append_events([_create("s", 4, "d")])
+    assert mapper.snapshot_if_needed(["s", "s"]) == 1
+    snapshot = ConversationSnapshot2db.get(ConversationSnapshot2db.sid == "s")
+    assert (snapshot.event_id, snapshot.count) == (4, 3)
+
+    # 计数从上一个快照之后重新开始
+    mapper.append_events([_create("s", 5, "e"), ConversationEvent(sid="s", conversation_id=1, op=DELETE)])
+    assert mapper.snapshot_if_needed(["s"]) == 0
+    mapper.append_events([_create("s", 6, "f")])
+    assert mapper.snapshot_if_needed(["s"]) == 1
+    latest = ConversationSnapshot2db.select().order_by(ConversationSnapshot2db.event_id.desc()).first()
+    assert (latest.event_id, latest.count) == (7, 4)
+
+
+def test_rebuild_at_any_event_matches_live_table(database, sender):
+    """
+    通过ConversationMapper随机写入，记录每次写入后的对话表，再从快照和事件重建每个时刻并比较
+    """
+    other = Character2db.create(name="角色", prompt="p", is_visible=True).id
+    events = ConversationEventMapper(snapshot_interval=4)
+    mapper = ConversationMapper(events)
+    rng = random.Random(44)
+    history = []
+    for step in range(60):
+        live = {sid: mapper.get_conversation_by_scene_id(sid) for sid in ("s1", "s2")}
+        existing = [c for conversations in live.values() for c in conversations]
+        action = rng.choice(["create", "create", "update", "move", "delete"]) if existing else "create"
+        if action == "create":
+            assert mapper.create_conversation(Conversation(f"m{step}", rng.choice(["s1", "s2"]), sender, "user"))
+        elif action == "delete":
+            assert mapper.delete_conversation_by_id(rng.choice(existing).conversation_id)
+        else:
+            target = rng.choice(existing)
+            sid = target.sid if action == "update" else ("s2" if target.sid == "s1" else "s1")
+            assert mapper.update_conversation_by_id(target.conversation_id,
+                                                    Conversation(f"u{step}", sid, other, "assistant"))
+        history.append((events.get_latest_event_id(),
+                        {sid: _state(mapper.get_conversation_by_scene_id(sid)) for sid in ("s1", "s2")}))
+
+    # 重建需要跨越多个快照
+    for sid in ("s1", "s2"):
+        assert ConversationSnapshot2db.select().where(ConversationSnapshot2db.sid == sid).count() >= 2
+    for event_id, expected in history:
+        for sid in ("s1", "s2"):
+            assert _state(events.get_scene_state(sid, event_id)) == expected[sid], (event_id, sid)
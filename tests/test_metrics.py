@@ -0,0 +1,112 @@
+"""
+Registry多进程模式：已退出进程的文件在share时合并到aggregate.json，合计值不回退；clear清空目录
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from utils.Metrics import Counter, Gauge, Histogram, Registry
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="Windows没有fcntl，不合并指标文件")
+
+
+def _registry(jobs: int = 0, busy: int = 0) -> Registry:
+    registry = Registry()
+    registry.register(Counter("jobs_total", "任务数", ["kind"])).labels("a").inc(jobs)
+    registry.register(Gauge("busy", "忙碌的线程数")).set(busy)
+    registry.register(Histogram("latency_seconds", "耗时", buckets=(1,))).observe(0.5)
+    return registry
+
+
+def _write(directory, name: str, pid: int, live: bool, registry: Registry):
+    with open(os.path.join(directory, name), "w", encoding="utf-8") as file:
+        json.dump({"pid": pid, "live": live, "written_at": time.time(), "interval": 1,
+                   "metrics": registry.snapshot()}, file)
+
+
+def _dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def _sample(text: str, prefix: str) -> float:
+    return sum(float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(prefix))
+
+
+def _files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+
+
+def test_share_compacts_exited_workers(tmp_path):
+    directory = str(tmp_path)
+    crashed = _dead_pid()
+    _write(directory, "101.json", 101, False, _registry(jobs=2, busy=7))
+    _write(directory, f"{crashed}.json", crashed, True, _registry(jobs=3, busy=7))
+    # 进程id被复用时改名保存的文件
+    _write(directory, "102-1.json", 102, True, _registry(jobs=4))
+    # 仍在运行的进程
+    parent = os.getppid()
+    _write(directory, f"{parent}.json", parent, True, _registry(jobs=5, busy=1))
+
+    worker = _registry(jobs=1)
+    worker.share(directory, interval=60)
+    try:
+        assert _files(directory) == sorted(["aggregate.json", f"{os.getpid()}.json", f"{parent}.json"])
+        text = worker.render()
+        assert _sample(text, 'jobs_total{kind="a"}') == 15
+        assert _sample(text, "latency_seconds_count") == 5
+        # 已退出进程的瞬时值被丢弃，运行中的进程照常输出
+        assert _sample(text, "busy{") == 1
+    finally:
+        worker.unshare()
+
+    # 工作进程重启：上一个进程的文件合并后合计值不变
+    restarted = _registry()
+    restarted.share(directory, interval=60)
+    try:
+        assert _files(directory) == sorted(["aggregate.json", f"{os.getpid()}.json", f"{parent}.json"])
+        assert _sample(restarted.render(), 'jobs_total{kind="a"}') == 15
+    finally:
+        restarted.unshare()
+
+
+def test_interrupted_compaction_is_not_counted_twice(tmp_path):
+    directory = str(tmp_path)
+    # 合并文件已写入、旧文件尚未删除时进程退出
+    _write(directory, "101.json", 101, False, _registry(jobs=2))
+    with open(os.path.join(directory, "aggregate.json"), "w", encoding="utf-8") as file:
+        json.dump({"pid": "aggregate", "live": False, "metrics": _registry(jobs=2).snapshot(),
+                   "compacted": ["101.json"]}, file)
+
+    worker = _registry()
+    worker._directory = directory
+    assert _sample(worker.render(), 'jobs_total{kind="a"}') == 2
+
+    worker.share(directory, interval=60)
+    try:
+        assert "101.json" not in _files(directory)
+        assert _sample(worker.render(), 'jobs_total{kind="a"}') == 2
+    finally:
+        worker.unshare()
+
+
+def test_clear_removes_previous_run(tmp_path):
+    directory = str(tmp_path)
+    worker = _registry(jobs=3)
+    worker.share(directory, interval=60)
+    worker.unshare()
+    Registry.clear(directory)
+    assert _files(directory) == []
+
+    worker = _registry()
+    worker.share(directory, interval=60)
+    try:
+        assert _sample(worker.render(), 'jobs_total{kind="a"}') == 0
+    finally:
+        worker.unshare()
@@ -0,0 +1,84 @@
+"""
+run_migrations：从版本8的旧库升级时，变更9把对话表重建为AUTOINCREMENT，数据、索引、触发器和id序列都保留
+"""
+
+import pytest
+
+from mapper.config.LoadDB import MeteredSqliteDatabase
+from mapper.config.Migrations import MIGRATIONS, current_version, run_migrations
+from mapper.config.SearchIndex import index_conversations
+
+# 变更9之前的对话表定义，主键没有AUTOINCREMENT
+_LEGACY_CONVERSATION_DDL = (
+    'CREATE TABLE "conversation2db" ("id" INTEGER NOT NULL PRIMARY KEY, "message" TEXT NOT NULL, '
+    '"sid" VARCHAR(255) NOT NULL, "role" VARCHAR(255) NOT NULL, "sender_id" INTEGER NOT NULL, '
+    'FOREIGN KEY ("sender_id") REFERENCES "character2db" ("id") ON DELETE CASCADE)'
+)
+
+
+def _schema(db, table):
+    return sorted(db.execute_sql(
+        "SELECT type, name, sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+        "AND sql IS NOT NULL", (table,)).fetchall())
+
+
+def _search(db, text):
+    return sorted(rowid for rowid, in db.execute_sql(
+        "SELECT rowid FROM conversation_fts WHERE conversation_fts MATCH ?", (f'"{text}"',)))
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    db = MeteredSqliteDatabase(str(tmp_path / "legacy.db"), pragmas={"foreign_keys": 1})
+    db.execute_sql(_LEGACY_CONVERSATION_DDL)
+    run_migrations(db, MIGRATIONS[:8])
+    db.execute_sql("INSERT INTO character2db (id, name, prompt, is_visible) VALUES (1, 'a', 'p', 1)")
+    rows = [(i, f"消息内容{i}", "live" if i % 2 else "other", 1) for i in range(1, 7)]
+    with db.atomic():
+        db.cursor().executemany(
+            "INSERT INTO conversation2db (id, message, sid, role, sender_id) VALUES (?, ?, ?, 'user', ?)", rows)
+        index_conversations(db, rows)
+        # id为7、8的对话已归档，只留在事件日志中
+        db.execute_sql(
+            "INSERT INTO conversationevent2db (sid, conversation_id, op, message, role, sender_id, created_at) "
+            "VALUES ('old', 8, 'create', 'x', 'user', 1, 0)")
+    yield db
+    db.close_all()
+
+
+def test_autoincrement_migration_keeps_rows_indexes_and_triggers(legacy_db):
+    db = legacy_db
+    assert current_version(db) == 8
+    rows = db.execute_sql("SELECT * FROM conversation2db ORDER BY id").fetchall()
+    schema = _schema(db, "conversation2db")
+    assert {name for kind, name, _ in schema if kind == "trigger"} >= {
+        "conversation_fts_delete", "conversation_fts_update", "scene_activity_insert", "scene_activity_update"}
+
+    assert run_migrations(db) == len(MIGRATIONS) - 8
+    (table_sql,) = db.execute_sql("SELECT sql FROM sqlite_master WHERE name = 'conversation2db'").fetchone()
+    assert "AUTOINCREMENT" in table_sql
+    assert db.execute_sql("SELECT * FROM conversation2db ORDER BY id").fetchall() == rows
+    assert _schema(db, "conversation2db") == schema
+    assert not db.table_exists("conversation2db_new")
+    # 序列从事件日志中用过的最大id继续
+    assert db.execute_sql("SELECT seq FROM sqlite_sequence WHERE name = 'conversation2db'").fetchone() == (8,)
+
+    # 重建后的触发器和全文索引照常工作
+    assert _search(db, "消息内容3") == [3]
+    db.execute_sql("DELETE FROM conversation2db WHERE id = 6")
+    assert _search(db, "消息内容") == [1, 2, 3, 4, 5]
+    cursor = db.execute_sql(
+        "INSERT INTO conversation2db (message, sid, role, sender_id) VALUES ('n', 'live', 'user', 1)")
+    assert cursor.lastrowid == 9
+
+
+def test_second_run_is_noop(legacy_db):
+    db = legacy_db
+    run_migrations(db)
+    tables = db.execute_sql("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+    sequence = db.execute_sql("SELECT * FROM sqlite_sequence ORDER BY name").fetchall()
+
+    assert run_migrations(db) == 0
+    assert current_version(db) == MIGRATIONS[-1].version
+    assert db.execute_sql("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall() == tables
+    assert db.execute_sql("SELECT * FROM sqlite_sequence ORDER BY name").fetchall() == sequence
@@ -0,0 +1,18 @@
+"""
+启动导入预算：导入Start的耗时不超过STARTUP_IMPORT_BUDGET_MS，且不导入按需加载的重量级依赖
+与 python -m utils.ImportProfile 使用同一个检查
+"""
+
+from utils.ImportProfile import LAZY_MODULES, STARTUP_IMPORT_BUDGET_MS, check
+
+
+def test_start_import_within_budget():
+    total, children, problems = check("Start", STARTUP_IMPORT_BUDGET_MS)
+    slowest = sorted(children, key=lambda child: -child[2])[:10]
+    assert not problems, "\n".join(problems + [f"{cumulative:.1f}ms  {name}" for name, _, cumulative in slowest])
+
+
+def test_lazy_modules_not_imported_at_startup():
+    # 预算放宽到无限，只检查按需加载的依赖
+    _, _, problems = check("Start", float("inf"), repeat=1)
+    assert not problems, f"{problems}（按需加载的依赖: {', '.join(LAZY_MODULES)}）"
@@ -0,0 +1,75 @@
+"""
+MeteredSqliteDatabase.after_commit：最外层事务提交后执行回调，回滚（包括回滚到保存点）时丢弃
+"""
+
+import pytest
+
+from mapper.config.LoadDB import MeteredSqliteDatabase
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = MeteredSqliteDatabase(str(tmp_path / "callbacks.db"))
+    database.execute_sql("CREATE TABLE t (v INTEGER)")
+    yield database
+    database.close_all()
+
+
+def test_runs_immediately_outside_transaction(db):
+    calls = []
+    db.after_commit(lambda: calls.append("now"))
+    assert calls == ["now"]
+
+
+def test_commit_runs_callbacks_after_commit(db):
+    calls = []
+    with db.atomic():
+        db.execute_sql("INSERT INTO t VALUES (1)")
+        db.after_commit(lambda: calls.append(db.execute_sql("SELECT count(*) FROM t").fetchone()[0]))
+        db.after_commit(lambda: calls.append("second"))
+        assert calls == []
+    # 回调执行时事务已提交，按登记顺序执行
+    assert calls == [1, "second"]
+    assert not db.in_transaction()
+
+
+def test_rollback_drops_callbacks(db):
+    calls = []
+    with pytest.raises(RuntimeError):
+        with db.atomic():
+            db.after_commit(lambda: calls.append("dropped"))
+            raise RuntimeError
+    assert calls == []
+    # 丢弃的回调不会在下一个事务提交时执行
+    with db.atomic():
+        db.after_commit(lambda: calls.append("next"))
+    assert calls == ["next"]
+
+
+def test_savepoint_rollback_drops_only_its_callbacks(db):
+    calls = []
+    with db.atomic():
+        db.after_commit(lambda: calls.append("outer"))
+        with db.atomic():
+            db.after_commit(lambda: calls.append("released"))
+        with pytest.raises(RuntimeError):
+            with db.atomic():
+                db.after_commit(lambda: calls.append("rolled back"))
+                with db.atomic():
+                    db.after_commit(lambda: calls.append("inner of rolled back"))
+                raise RuntimeError
+        db.after_commit(lambda: calls.append("after"))
+    assert calls == ["outer", "released", "after"]
+
+
+def test_failing_callback_does_not_stop_others(db):
+    calls = []
+
+    def fail():
+        raise ValueError("boom")
+
+    with db.atomic():
+        db.after_commit(fail)
+        db.after_commit(lambda: calls.append("ok"))
+    assert calls == ["ok"]
+    assert db.execute_sql("SELECT 1").fetchone() == (1,)
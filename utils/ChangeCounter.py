@@ -0,0 +1,53 @@
+from typing import Tuple
+
+from utils.ChangeFeed import ChangeFeed, change_feed
+
+# 实体名称，mapper在写操作后递增对应实体的计数器
+SCENE = "scene"
+CHARACTER = "character"
+CHARACTER_SCENE = "character_scene"
+CONVERSATION = "conversation"
+
+
+class ChangeCounter:
+    """
+    按实体维护的变更计数器
+    每次写操作后递增，读接口据此生成ETag：计数器不变说明数据未变，可直接返回304或缓存的响应。
+    计数器即ChangeFeed中的全局序号，多个工作进程共享，一个进程的写入会使所有进程的缓存失效；
+    epoch随数据库生成，同一份数据在不同进程、重启前后的ETag一致。
+    """
+
+    def __init__(self, feed: ChangeFeed = change_feed):
+        self._feed = feed
+
+    @property
+    def epoch(self) -> str:
+        return self._feed.epoch
+
+    def bump(self, *entities: str):
+        """
+        标记实体已发生变更，并通知其他工作进程
+        :param entities: 实体名称
+        """
+        self._feed.publish(*entities)
+
+    def versions(self, *entities: str) -> Tuple[int, ...]:
+        """
+        获取实体当前的版本号
+        :param entities: 实体名称
+        :return: 与entities顺序一致的版本号
+        """
+        return self._feed.versions(*entities)
+
+    def etag(self, entities: Tuple[str, ...], versions: Tuple[int, ...]) -> str:
+        """
+        根据实体版本生成弱ETag，格式为 W/"<实体>-<epoch>-<版本>"
+        :param entities: 实体名称
+        :param versions: 与entities对应的版本号
+        :return: ETag
+        """
+        return f'W/"{".".join(entities)}-{self.epoch}-{".".join(map(str, versions))}"'
+
+
+# 全局单例，mapper与controller共享
+change_counter = ChangeCounter()
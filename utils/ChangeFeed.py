@@ -0,0 +1,260 @@
+import hashlib
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from peewee import OperationalError
+
+from config.Logger import logger
+from entity.BaseModel import BaseDtoModel
+
+load_dotenv()
+
+# 没有收到通知时重新读取序号的间隔（秒），也是通知丢失时的最长延迟
+CHANGE_FEED_POLL_INTERVAL = float(os.getenv("CHANGE_FEED_POLL_INTERVAL", "1"))
+
+# change_feed表中保存epoch的保留行
+EPOCH_KEY = "__epoch__"
+
+CHANGE_FEED_DDL = """
+CREATE TABLE IF NOT EXISTS change_feed (
+    entity TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+)
+"""
+
+# 收到通知但还没读到新序号时（写入方的事务尚未提交），隔这么久再读一次
+_RECHECK_DELAY = 0.05
+
+
+def install_change_feed(database) -> None:
+    """
+    创建change_feed表，epoch在建表时随机生成，所有进程共享
+    """
+    database.execute_sql(CHANGE_FEED_DDL)
+    database.execute_sql("INSERT OR IGNORE INTO change_feed (entity, seq) VALUES (?, ?)",
+                         (EPOCH_KEY, random.getrandbits(48)))
+
+
+class ChangeFeed:
+    """
+    跨进程的实体变更序号
+    序号保存在SQLite的change_feed表中，mapper写入后递增对应实体的序号，
+    再通过Unix数据报套接字通知同一台机器上的其他工作进程；各进程的监听线程收到通知
+    （或每隔CHANGE_FEED_POLL_INTERVAL秒）重新读取序号，发现其他进程的变更时回调订阅者。
+    不支持Unix套接字的平台只靠轮询。
+    """
+
+    def __init__(self, poll_interval: float = CHANGE_FEED_POLL_INTERVAL, directory: Optional[str] = None):
+        self.poll_interval = poll_interval
+        self._directory = directory
+        self._seqs: Dict[str, int] = {}
+        self._epoch: Optional[str] = None
+        self._callbacks: List[Callable[[Set[str]], None]] = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._socket: Optional[socket.socket] = None
+        self._socket_path: Optional[str] = None
+        # 发送通知用非阻塞套接字，对方缓冲区满时不阻塞写请求
+        self._sender: Optional[socket.socket] = None
+        self._stopped = threading.Event()
+
+    @property
+    def database(self):
+        return BaseDtoModel._meta.database
+
+    @property
+    def epoch(self) -> str:
+        self.start()
+        return self._epoch
+
+    @property
+    def directory(self) -> str:
+        # 默认按数据库文件区分，连接同一个数据库的进程互相通知
+        if self._directory is None:
+            digest = hashlib.sha1(os.path.abspath(self.database.database).encode("utf-8")).hexdigest()[:12]
+            self._directory = os.getenv("CHANGE_FEED_DIR") or os.path.join(tempfile.gettempdir(),
+                                                                           f"treenovel-feed-{digest}")
+        return self._directory
+
+    def start(self):
+        """
+        读取当前序号并启动监听线程，第一次使用时自动调用
+        """
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self._stopped.clear()
+        self._refresh(notify=False)
+        self._open_socket()
+        threading.Thread(target=self._listen, name="change-feed", daemon=True).start()
+
+    def stop(self):
+        """
+        停止监听并删除本进程的套接字文件
+        """
+        self._stopped.set()
+        with self._lock:
+            self._started = False
+            for sock in (self._socket, self._sender):
+                if sock is not None:
+                    sock.close()
+            self._socket = self._sender = None
+            if self._socket_path is not None:
+                try:
+                    os.unlink(self._socket_path)
+                except OSError:
+                    pass
+                self._socket_path = None
+
+    def subscribe(self, callback: Callable[[Set[str]], None]):
+        """
+        订阅其他进程的变更，回调在监听线程中执行，参数为发生变更的实体
+        """
+        self._callbacks.append(callback)
+
+    def versions(self, *entities: str) -> Tuple[int, ...]:
+        """
+        :return: 与entities顺序一致的序号
+        """
+        self.start()
+        return tuple(self._seqs.get(entity, 0) for entity in entities)
+
+    def publish(self, *entities: str):
+        """
+        递增实体的序号并通知其他进程
+        在调用方的事务中执行时，序号随事务一起提交；提交后才更新本进程的序号并通知其他进程，
+        事务回滚时两者都不做
+        """
+        self.start()
+        database = self.database
+        try:
+            with database.atomic():
+                for entity in entities:
+                    database.execute_sql(
+                        "INSERT INTO change_feed (entity, seq) VALUES (?, 1) "
+                        "ON CONFLICT (entity) DO UPDATE SET seq = seq + 1", (entity,)
+                    )
+                placeholders = ", ".join("?" for _ in entities)
+                # 写事务持有数据库的写锁，读到的就是本次递增后的序号
+                rows = database.execute_sql(
+                    f"SELECT entity, seq FROM change_feed WHERE entity IN ({placeholders})", entities
+                ).fetchall()
+        except OperationalError as e:
+            # change_feed表不存在（未执行结构变更的脚本等），只在本进程内递增
+            logger.debug(f"change_feed不可用，只在本进程内记录变更: {e}")
+            with self._lock:
+                for entity in entities:
+                    self._seqs[entity] = self._seqs.get(entity, 0) + 1
+            self._notify_peers()
+            return
+        database.after_commit(lambda: self._committed(rows))
+
+    def _committed(self, rows: List[Tuple[str, int]]):
+        """
+        publish写入的序号提交后，记入本进程并通知其他进程
+        """
+        with self._lock:
+            for entity, seq in rows:
+                self._seqs[entity] = max(self._seqs.get(entity, 0), seq)
+        self._notify_peers()
+
+    def _refresh(self, notify: bool = True) -> Set[str]:
+        """
+        重新读取全部序号，回调订阅者
+        :param notify: 是否回调订阅者，启动时读取初始序号不回调
+        :return: 被其他进程修改过的实体
+        """
+        try:
+            rows = self.database.execute_sql("SELECT entity, seq FROM change_feed").fetchall()
+        except OperationalError:
+            rows = []
+        changed = set()
+        with self._lock:
+            for entity, seq in rows:
+                if entity == EPOCH_KEY:
+                    self._epoch = f"{seq:x}"
+                elif seq > self._seqs.get(entity, 0):
+                    self._seqs[entity] = seq
+                    changed.add(entity)
+            if self._epoch is None:
+                # 没有change_feed表时退化为进程内的epoch，重启后ETag失效
+                self._epoch = f"{os.getpid():x}{time.time_ns():x}"
+        if changed and notify:
+            for callback in list(self._callbacks):
+                try:
+                    callback(changed)
+                except Exception as e:
+                    logger.error(f"处理变更通知失败: {e}")
+        return changed
+
+    def _open_socket(self):
+        if not hasattr(socket, "AF_UNIX"):
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{os.getpid()}.sock")
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+            sock.settimeout(self.poll_interval)
+            sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sender.setblocking(False)
+            self._socket, self._socket_path, self._sender = sock, path, sender
+        except OSError as e:
+            logger.warning(f"无法创建变更通知套接字，改为每{self.poll_interval}秒轮询: {e}")
+
+    def _notify_peers(self):
+        sender = self._sender
+        if sender is None:
+            return
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".sock") or path == self._socket_path:
+                continue
+            try:
+                sender.sendto(b"1", path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 进程已退出，清理遗留的套接字文件
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError:
+                # 对方接收缓冲区已满，说明它已有未处理的通知
+                pass
+
+    def _listen(self):
+        while not self._stopped.is_set():
+            woken = False
+            sock = self._socket
+            if sock is not None:
+                try:
+                    sock.recv(64)
+                    woken = True
+                except (socket.timeout, OSError):
+                    pass
+            else:
+                self._stopped.wait(self.poll_interval)
+            if self._stopped.is_set():
+                return
+            if not self._refresh() and woken:
+                time.sleep(_RECHECK_DELAY)
+                self._refresh()
+
+
+# 全局单例，ChangeCounter和GraphJournal共享
+change_feed = ChangeFeed()
@@ -0,0 +1,109 @@
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+
+from fastapi import Request
+from starlette.responses import Response
+
+from entity.ResponseEntity import ResponseEntity
+from utils.ChangeCounter import ChangeCounter, change_counter
+from utils.FastResponse import dumps
+
+# 响应缓存的有效期（秒），过期后返回完整响应时重新查询数据库
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "2"))
+
+
+@dataclass
+class CachedResponse:
+    versions: Tuple[int, ...]
+    etag: str
+    body: bytes
+    expires_at: float
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    按弱比较规则判断If-None-Match是否命中当前ETag
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+class ResponseCache:
+    """
+    基于实体变更计数器的条件GET与短时响应缓存
+    ETag只由计数器决定：If-None-Match与当前版本的ETag相同时直接返回304，不访问数据库；
+    计数器未变化且缓存未过期时直接返回缓存的响应体，过期后重新查询。
+    绕过mapper（不递增计数器）的外部修改不会使ETag失效，只在缓存过期后的完整响应中体现。
+    只缓存成功的响应。
+    """
+
+    def __init__(self, counter: ChangeCounter = change_counter, ttl: float = RESPONSE_CACHE_TTL,
+                 max_entries: int = 256):
+        self._counter = counter
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+
+    def respond(self, request: Request, key: str, entities: Tuple[str, ...],
+                build: Callable[[], ResponseEntity]):
+        """
+        返回带ETag的响应
+        :param request: 当前请求，用于读取If-None-Match
+        :param key: 缓存键，需区分路由和查询参数
+        :param entities: 响应所依赖的实体
+        :param build: 查询数据库并构造响应的函数
+        :return: 304响应、缓存的响应，或build的原始结果（不成功时）
+        """
+        if_none_match = request.headers.get("if-none-match")
+        versions = self._counter.versions(*entities)
+        entry = self._entries.get(key)
+
+        # 客户端持有当前版本的内容，无论缓存是否过期都不需要查询
+        etag = self._counter.etag(entities, versions)
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+        if entry is not None and entry.versions == versions and time.monotonic() < entry.expires_at:
+            self._entries.move_to_end(key)
+            return self._render(entry, if_none_match)
+
+        result = build()
+        if not isinstance(result, ResponseEntity) or not result.is_success():
+            return result
+
+        entry = CachedResponse(
+            versions=versions,
+            etag=etag,
+            body=dumps(result),
+            expires_at=time.monotonic() + self._ttl
+        )
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return self._render(entry, if_none_match)
+
+    @staticmethod
+    def _render(entry: CachedResponse, if_none_match: Optional[str]) -> Response:
+        # no-cache让浏览器每次都带If-None-Match重新验证
+        headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+        if _etag_matches(if_none_match, entry.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry.body, media_type="application/json", headers=headers)
+
+    def clear(self):
+        """
+        清空缓存
+        """
+        self._entries.clear()
+
+
+# 全局单例，各controller共享
+response_cache = ResponseCache()
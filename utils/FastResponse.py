@@ -0,0 +1,86 @@
+import dataclasses
+import functools
+import inspect
+from typing import Any, Callable, Dict, Tuple
+
+import orjson
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from starlette.responses import Response
+
+from entity.Scene import Node, Scene, SceneProjection, Edge, Graph
+
+# orjson默认会直接序列化dataclass和datetime，交给_encode_default处理以保持与jsonable_encoder一致的输出
+_ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+# 普通类按vars()序列化（与jsonable_encoder的行为一致）
+_PLAIN_CLASSES = (Node, Scene, SceneProjection, Edge, Graph)
+
+# dataclass类型 -> 字段名，按类型缓存，只输出声明的字段（实例上动态添加的属性不输出）
+_DATACLASS_FIELDS: Dict[type, Tuple[str, ...]] = {}
+
+
+def _encode_default(obj: Any) -> Any:
+    """
+    orjson无法直接处理的对象的转换函数
+    dataclass和实体类走按类型缓存的快速路径，其他对象交给jsonable_encoder
+    """
+    cls = type(obj)
+    names = _DATACLASS_FIELDS.get(cls)
+    if names is None and dataclasses.is_dataclass(cls):
+        names = _DATACLASS_FIELDS[cls] = tuple(field.name for field in dataclasses.fields(cls))
+    if names is not None:
+        return {name: getattr(obj, name) for name in names}
+    if cls in _PLAIN_CLASSES:
+        return vars(obj)
+    return jsonable_encoder(obj)
+
+
+def dumps(content: Any) -> bytes:
+    """
+    使用orjson序列化ResponseEntity及其数据，除浮点数外输出与FastAPI默认的JSONResponse逐字节一致
+    浮点数的科学计数法写法不同（1e16与1e+16、1e-7与1e-07），NaN和Infinity输出为null而不是报错；
+    超出64位的整数会报错
+    """
+    return orjson.dumps(content, default=_encode_default, option=_ORJSON_OPTIONS)
+
+
+class EntityJSONResponse(JSONResponse):
+    """
+    直接使用orjson序列化的JSON响应
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def _wrap_endpoint(endpoint: Callable, status_code: int) -> Callable:
+    def to_response(result):
+        if isinstance(result, Response):
+            return result
+        return EntityJSONResponse(result, status_code=status_code)
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            return to_response(await endpoint(*args, **kwargs))
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            return to_response(endpoint(*args, **kwargs))
+    return wrapper
+
+
+class EntityRoute(APIRoute):
+    """
+    控制器返回的对象直接用EntityJSONResponse序列化，跳过FastAPI逐层遍历的jsonable_encoder
+    声明了response_model的路由保持FastAPI默认的校验和序列化流程
+    """
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any):
+        response_model = kwargs.get("response_model")
+        if response_model is None or isinstance(response_model, DefaultPlaceholder):
+            endpoint = _wrap_endpoint(endpoint, kwargs.get("status_code") or 200)
+        super().__init__(path, endpoint, **kwargs)
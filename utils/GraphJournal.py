@@ -0,0 +1,193 @@
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from peewee import OperationalError
+
+from config.Logger import logger
+from entity.BaseModel import BaseDtoModel
+from utils.ChangeFeed import ChangeFeed, change_feed
+
+NODE = "node"
+EDGE = "edge"
+# 日志中的重置标记，早于它的客户端需要重新拉取全图
+RESET = "reset"
+
+ADDED = "added"
+UPDATED = "updated"
+REMOVED = "removed"
+
+SCENE_JOURNAL_DDL = """
+CREATE TABLE IF NOT EXISTS scene_journal (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    op TEXT NOT NULL,
+    key TEXT,
+    data TEXT
+)
+"""
+
+# (类型, 操作, 键, 节点数据)，节点的键为sid，边的键为(父情景id, 子情景id)
+Change = Tuple[str, str, object, Optional[Dict]]
+
+
+def install_scene_journal(database) -> None:
+    """
+    创建scene_journal表，所有进程共享
+    """
+    database.execute_sql(SCENE_JOURNAL_DDL)
+
+
+def node_change(op: str, sid: str, scene: Optional[Dict] = None) -> Change:
+    """
+    :param op: ADDED/UPDATED/REMOVED
+    :param sid: 情景id
+    :param scene: 节点数据，删除时为空
+    """
+    return NODE, op, sid, scene
+
+
+def edge_change(op: str, source: str, target: str) -> Change:
+    """
+    :param op: ADDED/REMOVED
+    :param source: 父情景id
+    :param target: 子情景id
+    """
+    return EDGE, op, (source, target), None
+
+
+class GraphJournal:
+    """
+    情景图的变更日志
+    SceneMapper在节点和边写入成功后记录变更，前端带上次同步的版本号拉取增量，
+    不必每次刷新都重新获取整张图。
+    日志保存在SQLite的scene_journal表中，所有工作进程共享：版本号即表的自增id，epoch即ChangeFeed的epoch
+    （随数据库生成），请求落到任何进程都能返回增量。只保留最近max_entries条记录，版本号过旧时需要重新拉取全图。
+    本进程有变更未能写入日志时（如数据库被锁），下一次写入前先写入重置标记。
+    """
+
+    def __init__(self, max_entries: int = 10000, feed: ChangeFeed = change_feed):
+        self.max_entries = max_entries
+        self._feed = feed
+        self._lost = False
+        self._lock = threading.Lock()
+
+    @property
+    def database(self):
+        return BaseDtoModel._meta.database
+
+    @property
+    def epoch(self) -> str:
+        return self._feed.epoch
+
+    @property
+    def version(self) -> int:
+        try:
+            row = self.database.execute_sql(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'scene_journal'"
+            ).fetchone()
+        except OperationalError:
+            return 0
+        return row[0] if row else 0
+
+    def record(self, changes: List[Change]):
+        """
+        写入一组变更，在调用方的事务中执行时随事务一起提交
+        :param changes: node_change/edge_change生成的变更
+        """
+        with self._lock:
+            lost = self._lost
+        rows = [(RESET, RESET, None, None)] if lost else []
+        rows.extend(
+            (kind, op, json.dumps(key, ensure_ascii=False),
+             None if data is None else json.dumps(data, ensure_ascii=False))
+            for kind, op, key, data in changes
+        )
+        if not rows:
+            return
+        database = self.database
+        with database.atomic():
+            database.cursor().executemany(
+                "INSERT INTO scene_journal (kind, op, key, data) VALUES (?, ?, ?, ?)", rows
+            )
+            database.execute_sql(
+                "DELETE FROM scene_journal WHERE version <= "
+                "(SELECT seq FROM sqlite_sequence WHERE name = 'scene_journal') - ?", (self.max_entries,)
+            )
+        if lost:
+            database.after_commit(self._recovered)
+
+    def _recovered(self):
+        with self._lock:
+            self._lost = False
+
+    def mark_lost(self):
+        """
+        记录本进程有变更未能写入日志，下一次写入时先写入重置标记
+        """
+        with self._lock:
+            self._lost = True
+        logger.warning("情景图变更未能写入日志，客户端下次拉取增量时将重新获取全图")
+
+    def changes_since(self, since: int) -> Optional[Dict]:
+        """
+        获取某个版本之后的净变更
+        同一节点或边的多次变更会被合并：先添加后删除的不返回，删除后重新添加的按更新返回。
+        :param since: 客户端上次同步到的版本号
+        :return: 净变更；版本号已超出保留范围、无效或之后有重置标记时返回None，需要重新拉取全图
+        """
+        database = self.database
+        try:
+            # 在同一个读事务中读取，版本号与记录一致
+            with database.atomic():
+                version = self.version
+                if since > version:
+                    return None
+                oldest = database.execute_sql("SELECT MIN(version) FROM scene_journal").fetchone()[0]
+                entries = database.execute_sql(
+                    "SELECT kind, op, key, data FROM scene_journal WHERE version > ? ORDER BY version", (since,)
+                ).fetchall()
+        except OperationalError:
+            return None
+        if since < (oldest if oldest is not None else version + 1) - 1:
+            return None
+
+        # 键 -> [客户端是否已有, 当前是否存在, 最新数据]
+        nodes: Dict[str, List] = {}
+        edges: Dict[Tuple[str, str], List] = {}
+        for kind, op, key, data in entries:
+            if kind == RESET:
+                return None
+            key = json.loads(key)
+            states = nodes if kind == NODE else edges
+            if kind == EDGE:
+                key = tuple(key)
+            state = states.get(key)
+            if state is None:
+                state = states[key] = [op != ADDED, True, None]
+            state[1] = op != REMOVED
+            if data is not None:
+                state[2] = json.loads(data)
+
+        result = {
+            "version": version,
+            "epoch": self.epoch,
+            "reset": False,
+            "nodes": {ADDED: [], UPDATED: [], REMOVED: []},
+            "edges": {ADDED: [], REMOVED: []},
+        }
+        for sid, (existed, present, data) in nodes.items():
+            if present:
+                result["nodes"][UPDATED if existed else ADDED].append(data)
+            elif existed:
+                result["nodes"][REMOVED].append(sid)
+        for (source, target), (existed, present, _) in edges.items():
+            if present and not existed:
+                result["edges"][ADDED].append({"source": source, "target": target})
+            elif existed and not present:
+                result["edges"][REMOVED].append({"source": source, "target": target})
+        return result
+
+
+# 全局单例，SceneMapper写入，SceneService读取
+graph_journal = GraphJournal()
@@ -0,0 +1,102 @@
+"""
+启动导入耗时分析
+python -m utils.ImportProfile [--module Start] [--top 20] [--budget-ms 1500]
+
+在新的解释器中以 -X importtime 导入模块（不会执行数据库连接等启动逻辑），按累计耗时列出最慢的直接导入。
+总耗时超过预算、或导入了只应在具体功能中按需加载的重量级依赖时以非零状态退出；
+tests/test_startup_budget.py 用同一个检查（check）在pytest中防止启动变慢。
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 启动时导入耗时上限（毫秒），新的工作进程启动、平滑重启都要付出这部分时间
+STARTUP_IMPORT_BUDGET_MS = float(os.getenv("STARTUP_IMPORT_BUDGET_MS", "1500"))
+
+# 只在对应功能中按需导入的依赖：LLM客户端（第一次对话时）、autogen群聊、PyQt5可视化工具
+LAZY_MODULES = ("langchain_openai", "openai", "langchain_community", "autogen", "PyQt5")
+
+
+def _parse(stderr: str, module: str) -> Tuple[float, List[Tuple[str, float, float]]]:
+    """
+    解析 -X importtime 的输出
+    :return: (模块的累计耗时ms, [(直接导入的模块, 自身耗时ms, 累计耗时ms)])
+    """
+    total = 0.0
+    children = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        # 名称前每两个空格表示一层嵌套
+        name = name[1:]
+        level = (len(name) - len(name.lstrip(" "))) // 2
+        name = name.strip()
+        if level == 1:
+            children.append((name, int(self_us) / 1000, int(cumulative_us) / 1000))
+        elif level == 0 and name == module:
+            total = int(cumulative_us) / 1000
+            break
+        elif level == 0:
+            children.clear()
+    return total, children
+
+
+def profile(module: str) -> Tuple[float, List[Tuple[str, float, float]], List[str]]:
+    """
+    在新的解释器中导入模块
+    :return: (累计耗时ms, 直接导入的模块耗时, 已导入的按需加载依赖)
+    """
+    code = f"import sys, json; import {module}; print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=ROOT_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"导入{module}失败:\n{result.stderr[-2000:]}")
+    total, children = _parse(result.stderr, module)
+    return total, children, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def check(module: str = "Start", budget_ms: float = STARTUP_IMPORT_BUDGET_MS,
+          repeat: int = 3) -> Tuple[float, List[Tuple[str, float, float]], List[str]]:
+    """
+    导入模块并检查启动预算，重复导入取最快的一次，排除磁盘缓存的影响
+    :return: (累计耗时ms, 直接导入的模块耗时, 未通过的检查项)
+    """
+    runs = [profile(module) for _ in range(max(1, repeat))]
+    total, children, loaded = min(runs, key=lambda run: run[0])
+    problems = []
+    if total > budget_ms:
+        problems.append(f"导入耗时超出预算 {total - budget_ms:.1f}ms")
+    if loaded:
+        problems.append(f"启动时不应导入的依赖被导入了: {', '.join(loaded)}，"
+                        f"可用 python -X importtime -c \"import {module}\" 查看导入链")
+    return total, children, problems
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="分析启动时的导入耗时")
+    parser.add_argument("--module", default="Start")
+    parser.add_argument("--top", type=int, default=20, help="列出最慢的直接导入数")
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_IMPORT_BUDGET_MS)
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快的一次，排除磁盘缓存的影响")
+    args = parser.parse_args(argv)
+
+    total, children, problems = check(args.module, args.budget_ms, args.repeat)
+
+    print(f"导入 {args.module} 累计耗时 {total:.1f}ms（预算 {args.budget_ms:.0f}ms）")
+    print(f"{'累计ms':>10} {'自身ms':>10}  模块")
+    for name, self_ms, cumulative_ms in sorted(children, key=lambda child: -child[2])[:args.top]:
+        print(f"{cumulative_ms:>10.1f} {self_ms:>10.1f}  {name}")
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,543 @@
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，不合并已退出进程的文件
+    fcntl = None
+
+from config.Logger import logger
+
+load_dotenv()
+
+# 延迟类直方图的默认分桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# 多进程部署时各进程把指标写入共享目录的间隔（秒），也是/metrics中其他进程数据的最长延迟
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+
+# 超过这么多个写入间隔没有更新的进程视为已退出，不再输出它的瞬时值
+_STALE_INTERVALS = 10
+
+# 已退出进程的计数和直方图合并到这个文件中
+_AGGREGATE_NAME = "aggregate.json"
+
+# 合并已退出进程的文件时加排他锁，读取所有文件时加共享锁
+_LOCK_NAME = ".lock"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+class _Metric:
+    """
+    指标基类，按标签值缓存子指标
+    """
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # 无标签的指标从0开始输出，不必等第一次记录
+            self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        """
+        :param values: 与labelnames顺序一致的标签值
+        :return: 对应标签值的子指标，同一组标签值总是返回同一个对象，热点路径可以提前取出
+        """
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name}需要标签 {self.labelnames}，实际为 {key}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name}有标签，需要先调用labels()")
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def snapshot(self) -> Dict:
+        """
+        :return: 可序列化为JSON的当前值，用于输出和在进程间合并
+        """
+        with self._lock:
+            children = list(self._children.items())
+        return {
+            "type": self.type_name,
+            "documentation": self.documentation,
+            "labelnames": list(self.labelnames),
+            "children": [[list(key), child.value()] for key, child in children],
+        }
+
+
+class _CounterChild:
+    __slots__ = ("_value", "_lock")
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def value(self) -> float:
+        return self._value
+
+
+class Counter(_Metric):
+    """
+    只增不减的计数，名称以_total结尾
+    """
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ("_value", "_function", "_lock")
+
+    def __init__(self):
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        self._value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        采集时调用function取值，用于从已有的统计（如连接池）中读取
+        """
+        self._function = function
+
+    def value(self) -> float:
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception:
+                return math.nan
+        return self._value
+
+
+class Gauge(_Metric):
+    """
+    可增可减的瞬时值
+    """
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default().set_function(function)
+
+
+class _HistogramChild:
+    __slots__ = ("_upper_bounds", "_counts", "_sum", "_lock")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self._upper_bounds = upper_bounds
+        self._counts = [0] * (len(upper_bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        记录代码块的耗时（秒），代码块抛出异常时同样记录
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def value(self) -> List:
+        """
+        :return: [各分桶（不累计）的次数, 总和]
+        """
+        with self._lock:
+            return [list(self._counts), self._sum]
+
+
+class Histogram(_Metric):
+    """
+    分桶统计的分布，输出累计桶计数、总和与次数
+    """
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(bucket) for bucket in buckets if bucket != math.inf))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def snapshot(self) -> Dict:
+        snapshot = super().snapshot()
+        snapshot["buckets"] = list(self.buckets)
+        return snapshot
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+def _merge(merged: Dict[str, Dict], snapshot: Dict[str, Dict], worker: str):
+    """
+    把一个进程的指标合并到merged中：计数和直方图按标签求和，瞬时值加worker标签按进程分别保留
+    """
+    for name, metric in snapshot.items():
+        target = merged.get(name)
+        if target is None:
+            target = merged[name] = {key: value for key, value in metric.items() if key != "children"}
+            target["children"] = {}
+        elif (target["type"], target["labelnames"], target.get("buckets")) != \
+                (metric["type"], metric["labelnames"], metric.get("buckets")):
+            # 平滑重启期间新旧代码的同名指标定义不同，只保留先读到的一份
+            continue
+        children = target["children"]
+        for key, value in metric["children"]:
+            key = tuple(key)
+            if metric["type"] == "gauge":
+                children[key + (worker,)] = value
+            elif metric["type"] == "counter":
+                children[key] = children.get(key, 0) + value
+            else:
+                existing = children.setdefault(key, [[0] * len(value[0]), 0.0])
+                existing[0] = [a + b for a, b in zip(existing[0], value[0])]
+                existing[1] += value[1]
+
+
+def _to_snapshot(merged: Dict[str, Dict]) -> Dict[str, Dict]:
+    """
+    把_merge的结果转换回snapshot的格式，用于写入合并文件
+    """
+    snapshot = {}
+    for name, metric in merged.items():
+        snapshot[name] = {key: value for key, value in metric.items() if key != "children"}
+        snapshot[name]["children"] = [[list(key), value] for key, value in metric["children"].items()]
+    return snapshot
+
+
+def _exited(name: str, data: Dict) -> bool:
+    """
+    :return: 写入该文件的进程是否已退出：正常退出时写入了live=False，异常退出时进程已不存在；
+             进程id被复用时改名保存的文件也属于已退出的进程
+    """
+    pid = data.get("pid")
+    if not data.get("live") or name != f"{pid}.json":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # 进程存在但属于其他用户
+        pass
+    return False
+
+
+def _render(merged: Dict[str, Dict]) -> str:
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append(f"# HELP {name} {metric['documentation']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = tuple(metric["labelnames"])
+        if metric["type"] == "gauge":
+            labelnames += ("worker",)
+        for key, value in metric["children"].items():
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(labelnames, key)} {_format_value(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + [math.inf], counts):
+                cumulative += count
+                labels = _format_labels(labelnames + ("le",), key + (_format_value(bound),))
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labelnames, key)} {_format_value(total)}")
+            lines.append(f"{name}_count{_format_labels(labelnames, key)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+class Registry:
+    """
+    指标注册表，按Prometheus文本格式输出
+    单进程时只输出本进程的指标。多工作进程时各进程调用share，定期把自己的指标写入共享目录的文件
+    （类似prometheus_client的multiprocess模式），render合并所有进程：计数和直方图求和；
+    瞬时值（gauge）带worker标签，只输出存活的进程。
+    工作进程启动时把已退出进程的计数和直方图合并到aggregate.json并删除它们的文件，
+    合计值不会因工作进程重启而回退，目录中的文件数也不随重启次数增长；主进程冷启动时调用clear从0开始计数。
+    其他进程的数据最多延迟一个写入间隔，处理采集请求的进程先写入自己的文件再合并。
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+        self._directory: Optional[str] = None
+        self._interval = METRICS_FLUSH_INTERVAL
+        self._stopped = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self._flush_lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # 模块被重复导入时复用已注册的指标
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"指标 {metric.name} 已注册为不同的类型或标签")
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """
+        :return: 本进程全部指标的当前值
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def share(self, directory: str, interval: float = METRICS_FLUSH_INTERVAL):
+        """
+        多进程部署时在每个工作进程启动时调用，定期把本进程的指标写入directory
+        :param directory: 所有工作进程共用的目录
+        :param interval: 写入间隔（秒）
+        """
+        self.unshare()
+        os.makedirs(directory, exist_ok=True)
+        self._directory, self._interval = directory, interval
+        path = self._path(os.getpid())
+        if os.path.exists(path):
+            # 进程id被复用，保留上一个同id进程的计数
+            os.replace(path, os.path.join(directory, f"{os.getpid()}-{time.time_ns()}.json"))
+        self._compact()
+        self._stopped.clear()
+        self._flush()
+        self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+        self._flusher.start()
+
+    def unshare(self):
+        """
+        停止写入，并写入最后一次的计数（标记进程已退出），工作进程退出时调用
+        """
+        if self._flusher is None:
+            return
+        self._stopped.set()
+        self._flusher.join()
+        self._flusher = None
+        self._flush(live=False)
+        self._directory = None
+
+    @staticmethod
+    def clear(directory: str):
+        """
+        删除上一次运行留下的指标文件，主进程冷启动、尚未创建工作进程时调用
+        平滑重启工作进程时不要调用，否则合计值会回退
+        :param directory: 工作进程共用的指标目录
+        """
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith((".json", ".tmp")):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self._directory, f"{pid}.json")
+
+    @contextmanager
+    def _directory_lock(self, shared: bool = False):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self._directory, _LOCK_NAME), "a") as file:
+            # 关闭文件时释放
+            fcntl.flock(file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _write(path: str, data: Dict):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False)
+        # 替换是原子的，读取方不会读到写了一半的文件
+        os.replace(temp_path, path)
+
+    def _flush(self, live: bool = True):
+        pid = os.getpid()
+        # 写入线程和render可能同时写入，加锁保证文件中的计数只增不减
+        with self._flush_lock:
+            data = {"pid": pid, "live": live, "written_at": time.time(), "interval": self._interval,
+                    "metrics": self.snapshot()}
+            try:
+                self._write(self._path(pid), data)
+            except OSError:
+                pass
+
+    def _compact(self):
+        """
+        把已退出进程的计数和直方图合并到aggregate.json并删除它们的文件，瞬时值丢弃
+        aggregate.json中记录已合并的文件名，写入后再删除这些文件；中途退出时读取方跳过已合并的文件，
+        由下一个启动的进程删除
+        """
+        if fcntl is None:
+            return
+        path = os.path.join(self._directory, _AGGREGATE_NAME)
+        try:
+            with self._directory_lock():
+                files = self._read_all()
+                aggregate = files.pop(_AGGREGATE_NAME, None) or {"metrics": {}, "compacted": []}
+                compacted = set(aggregate.get("compacted", []))
+                exited = {name: data for name, data in files.items()
+                          if name not in compacted and _exited(name, data)}
+                if exited:
+                    merged: Dict[str, Dict] = {}
+                    _merge(merged, aggregate["metrics"], "")
+                    for data in exited.values():
+                        _merge(merged, {name: metric for name, metric in data.get("metrics", {}).items()
+                                        if metric["type"] != "gauge"}, "")
+                    compacted.update(exited)
+                    aggregate = {"pid": "aggregate", "live": False, "metrics": _to_snapshot(merged)}
+                    self._write(path, dict(aggregate, compacted=sorted(compacted)))
+                if compacted:
+                    for name in compacted:
+                        try:
+                            os.remove(os.path.join(self._directory, name))
+                        except FileNotFoundError:
+                            pass
+                    self._write(path, dict(aggregate, compacted=[]))
+        except OSError as e:
+            logger.warning(f"合并已退出进程的指标文件失败: {e}")
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self._interval):
+            self._flush()
+
+    def _read_all(self) -> Dict[str, Dict]:
+        """
+        :return: 文件名 -> 文件内容
+        """
+        directory = self._directory
+        snapshots = {}
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return {}
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name), encoding="utf-8") as file:
+                    snapshots[name] = json.load(file)
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self) -> str:
+        """
+        :return: Prometheus文本格式（0.0.4）的全部指标，多进程时为所有进程合并后的结果
+        """
+        merged: Dict[str, Dict] = {}
+        if self._directory is None:
+            # fork出的工作进程沿用父进程的注册表，进程id在输出时取
+            _merge(merged, self.snapshot(), str(os.getpid()))
+            return _render(merged)
+        # 本进程也从文件读取：每个文件的计数只增不减，无论请求落到哪个进程，先后两次采集的合计都不会回退
+        self._flush()
+        now = time.time()
+        # 共享锁：不会读到合并了一半的目录
+        with self._directory_lock(shared=True):
+            files = self._read_all()
+        aggregate = files.get(_AGGREGATE_NAME, {})
+        for name in aggregate.get("compacted", []):
+            files.pop(name, None)
+        for data in files.values():
+            metrics = data.get("metrics", {})
+            alive = data.get("live") and now - data.get("written_at", 0) < _STALE_INTERVALS * data.get("interval", 1)
+            if not alive:
+                metrics = {name: metric for name, metric in metrics.items() if metric["type"] != "gauge"}
+            _merge(merged, metrics, str(data.get("pid")))
+        return _render(merged)
+
+
+# 全局注册表，/metrics接口输出
+registry = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
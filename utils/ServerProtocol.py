@@ -0,0 +1,35 @@
+import asyncio
+import socket
+
+from uvicorn.protocols.http.h11_impl import H11Protocol
+
+try:
+    from uvicorn.protocols.http.httptools_impl import HttpToolsProtocol
+except ImportError:  # httptools未安装时只能使用h11
+    HttpToolsProtocol = None
+
+
+def _set_nodelay(transport: asyncio.Transport):
+    """
+    关闭Nagle算法
+    多工作进程时监听套接字由uvicorn主进程创建（proto为0），asyncio不会为接受的连接设置TCP_NODELAY，
+    小响应会被延迟确认拖慢约40ms
+    """
+    sock = transport.get_extra_info("socket")
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class NoDelayH11Protocol(H11Protocol):
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        _set_nodelay(transport)
+        super().connection_made(transport)
+
+
+if HttpToolsProtocol is not None:
+    class NoDelayHttpToolsProtocol(HttpToolsProtocol):
+
+        def connection_made(self, transport: asyncio.Transport) -> None:
+            _set_nodelay(transport)
+            super().connection_made(transport)
@@ -0,0 +1,82 @@
+import os
+import zlib
+from typing import Optional, Union
+
+from dotenv import load_dotenv
+
+try:
+    import zstandard
+except ImportError:  # zstandard未安装时只能使用zlib
+    zstandard = None
+
+load_dotenv()
+
+# 压缩后的数据以1字节的格式标记开头，未压缩的文本直接以TEXT保存
+_ZLIB = b"\x01"
+_ZSTD = b"\x02"
+
+# 压缩算法：zstd、zlib或none，默认优先使用zstd
+TEXT_COMPRESSION = os.getenv("TEXT_COMPRESSION", "zstd" if zstandard is not None else "zlib").lower()
+# UTF-8编码后不少于该字节数的文本才压缩，短文本压缩收益小
+TEXT_COMPRESSION_THRESHOLD = int(os.getenv("TEXT_COMPRESSION_THRESHOLD", "1024"))
+
+if TEXT_COMPRESSION not in ("zstd", "zlib", "none"):
+    raise ValueError(f"不支持的TEXT_COMPRESSION: {TEXT_COMPRESSION}")
+if TEXT_COMPRESSION == "zstd" and zstandard is None:
+    raise ValueError("TEXT_COMPRESSION=zstd需要安装zstandard")
+
+
+def compress_bytes(data: bytes) -> bytes:
+    """
+    压缩二进制数据，不受阈值限制；TEXT_COMPRESSION=none时使用zlib
+    :param data: 数据
+    :return: 带格式标记的压缩数据
+    """
+    if TEXT_COMPRESSION == "zstd":
+        return _ZSTD + zstandard.ZstdCompressor(level=3).compress(data)
+    return _ZLIB + zlib.compress(data, 6)
+
+
+def decompress_bytes(value: bytes) -> bytes:
+    """
+    还原compress_bytes的结果，与当前配置无关，按数据自带的格式标记解压
+    """
+    marker, payload = value[:1], value[1:]
+    if marker == _ZSTD:
+        if zstandard is None:
+            raise ValueError("数据使用zstd压缩，需要安装zstandard")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if marker == _ZLIB:
+        return zlib.decompress(payload)
+    raise ValueError("无法识别的压缩数据格式")
+
+
+def compress_text(text: str) -> Union[str, bytes]:
+    """
+    按配置压缩文本
+    :param text: 文本
+    :return: 未达到阈值或未开启压缩时原样返回文本，否则返回带格式标记的压缩数据
+    """
+    if TEXT_COMPRESSION == "none":
+        return text
+    data = text.encode("utf-8")
+    if len(data) < TEXT_COMPRESSION_THRESHOLD:
+        return text
+    return compress_bytes(data)
+
+
+def decompress_text(value: Union[str, bytes, None]) -> Optional[str]:
+    """
+    还原compress_text的结果，与当前配置无关，按数据自带的格式标记解压
+    """
+    if value is None or isinstance(value, str):
+        return value
+    return decompress_bytes(bytes(value)).decode("utf-8")
+
+
+def tn_text(value: Union[str, bytes, None]) -> Optional[str]:
+    """
+    注册到SQLite的函数，在SQL中读取压缩字段（如全文索引的触发器）：tn_text(message)
+    """
+    return decompress_text(value)
+
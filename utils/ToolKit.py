@@ -1,5 +1,8 @@
 import re
 
+# 中日韩文字，大致每个字一个token
+_CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
 
 def normalize_role_prefix(text: str, role_name: str, *, keep_other_role=False) -> str:
     """
@@ -121,4 +124,16 @@ if __name__ == "__main__":
         result = normalize_role_prefix(t, role_name="小红", keep_other_role=True)
         print(f"原始    → {repr(t)}")
         print(f"处理后  → {result}")
-        print("-" * 60)
\ No newline at end of file
+        print("-" * 60)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的token数，不依赖具体模型的分词器：中日韩文字每字约1个token，其余字符约4个一个token
+    :param text: 文本
+    :return: 估算的token数
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
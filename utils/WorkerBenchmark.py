@@ -0,0 +1,176 @@
+"""
+多工作进程吞吐量测试
+python -m utils.WorkerBenchmark --workers 1 2 4 --duration 10
+
+依次以不同的工作进程数启动Start.py，由多个压测进程并发请求只读接口（只用到SQLite，不需要Neo4j），
+输出每秒请求数、延迟和相对第一组的加速比。数据库使用.env中的SQLITE_URL，首次运行时写入一个测试情景。
+压测进程与服务器在同一台机器上时会争用CPU，核数不少于 工作进程数 + 压测进程数 时结果才有参考意义。
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 测试数据所在的情景
+BENCHMARK_SID = "worker-benchmark"
+
+
+def _seed(base_url: str, messages: int):
+    """
+    测试情景没有对话时通过批量写入接口写入一个角色和messages条对话
+    """
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        if client.get(f"/api/conversations/scene/{BENCHMARK_SID}").json()["data"]:
+            return
+        body = {
+            "characters": [{"character_id": -1, "name": "benchmark", "prompt": "压测角色", "is_visible": False}],
+            "conversations": [
+                {"message": f"第{i}条测试对话。" * 8, "sid": BENCHMARK_SID, "sender_id": -1,
+                 "role": "assistant" if i % 2 else "user"}
+                for i in range(messages)
+            ],
+        }
+        response = client.post("/api/bulk/ingest", json=body).json()
+        if response["code"] != 200:
+            raise RuntimeError(f"写入测试数据失败: {response['message']}")
+
+
+def _start_server(workers: int, port: int) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "Start.py", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT_DIR
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"服务器启动失败，退出码 {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/api/characters", timeout=1).status_code == 200:
+                # 等待其余工作进程也完成启动
+                time.sleep(1 + 0.2 * workers)
+                return process
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    _stop_server(process)
+    raise RuntimeError("等待服务器启动超时")
+
+
+def _stop_server(process: subprocess.Popen):
+    process.send_signal(signal.SIGINT if os.name != "nt" else signal.CTRL_C_EVENT)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def _load(args: Tuple[str, List[str], float, int]) -> Tuple[int, int, List[float]]:
+    """
+    压测进程：connections个线程各自保持一个连接，轮流请求paths直到时间结束
+    :return: (成功数, 失败数, 每个请求的延迟)
+    """
+    base_url, paths, duration, connections = args
+    deadline = time.monotonic() + duration
+    results = []
+
+    def run():
+        ok = failed = 0
+        latencies = []
+        with httpx.Client(base_url=base_url, timeout=30) as client:
+            i = 0
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    if client.get(paths[i % len(paths)]).status_code == 200:
+                        ok += 1
+                    else:
+                        failed += 1
+                except httpx.HTTPError:
+                    failed += 1
+                latencies.append(time.perf_counter() - start)
+                i += 1
+        results.append((ok, failed, latencies))
+
+    threads = [threading.Thread(target=run) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (sum(ok for ok, _, _ in results), sum(failed for _, failed, _ in results),
+            [latency for _, _, latencies in results for latency in latencies])
+
+
+def run_benchmark(workers: int, port: int, paths: List[str], duration: float,
+                  load_processes: int, connections: int) -> Dict:
+    """
+    以指定的工作进程数启动服务器并压测
+    :return: 每秒请求数、失败数和延迟分位数（毫秒）
+    """
+    base_url = f"http://127.0.0.1:{port}"
+    process = _start_server(workers, port)
+    try:
+        # 预热：每个工作进程建立连接、填充缓存
+        _load((base_url, paths, 1, connections))
+        with multiprocessing.Pool(load_processes) as pool:
+            results = pool.map(_load, [(base_url, paths, duration, connections)] * load_processes)
+    finally:
+        _stop_server(process)
+
+    ok = sum(result[0] for result in results)
+    latencies = sorted(latency for result in results for latency in result[2])
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else 0
+
+    return {
+        "workers": workers,
+        "rps": round(ok / duration, 1),
+        "failed": sum(result[1] for result in results),
+        "p50_ms": percentile(0.5),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="比较不同工作进程数下的吞吐量")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--duration", type=float, default=10, help="每组压测的秒数")
+    parser.add_argument("--load-processes", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="压测进程数")
+    parser.add_argument("--connections", type=int, default=8, help="每个压测进程的并发连接数")
+    parser.add_argument("--messages", type=int, default=200, help="测试情景中的对话条数")
+    args = parser.parse_args(argv)
+
+    paths = [f"/api/conversations/scene/{BENCHMARK_SID}", "/api/characters"]
+    process = _start_server(1, args.port)
+    try:
+        _seed(f"http://127.0.0.1:{args.port}", args.messages)
+    finally:
+        _stop_server(process)
+
+    print(f"CPU核数 {os.cpu_count()}，压测进程 {args.load_processes} x {args.connections} 个连接，"
+          f"每组 {args.duration}s")
+    print(f"{'workers':>8} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'failed':>7} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        report = run_benchmark(workers, args.port, paths, args.duration, args.load_processes, args.connections)
+        baseline = baseline or report["rps"] / report["workers"]
+        speedup = report["rps"] / baseline if baseline else 0
+        print(f"{report['workers']:>8} {report['rps']:>10} {report['p50_ms']:>8} {report['p99_ms']:>8} "
+              f"{report['failed']:>7} {speedup:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()